@@ -1,17 +1,137 @@
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, g, has_app_context, jsonify, request, abort, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import DDL, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased,joinedload,selectinload
+from werkzeug.http import quote_etag
 from werkzeug.security import generate_password_hash,check_password_hash
-from flask_login import LoginManager,login_required,current_user
+from flask_login import LoginManager,UserMixin,login_required,login_user,current_user
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+from cache import MemoryCache,ResponseCache,make_etag
+import planner
+import export
+import road_graph
+from distance_matrix import DistanceMatrixStore
+from metrics import RequestMetrics
+from ratelimit import ConcurrencyGate,MemoryRateLimitBackend,RateLimiter
+from serializer import JSONProvider,record
+from geocoder import FakeGeocoder,geocode_concurrently,normalize_address
+from jobs import JobError,JobQueue
+from sqlalchemy.exc import IntegrityError
+import click
+import cProfile
+import datetime
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import random
+import re
+import sqlite3
+import time
 
 app=Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
+#JSONの書き出しはorjsonがあればそれを使う(serializer.py)
+app.json = JSONProvider(app)
+#DB設定(DATABASE_URLでPostgreSQLも指定可能。差分同期のカーソルはSQLiteとPostgreSQLでのみ正しく動く)
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///test.db').replace('postgres://', 'postgresql://', 1)
+def engine_options(database_url):
+    options = {
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+    if not database_url.startswith('sqlite'):
+        options['pool_size'] = int(os.environ.get('DB_POOL_SIZE', 10))
+        options['max_overflow'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+        options['pool_timeout'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    return options
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DATABASE_URL)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+#SQLiteは接続ごとにWALとbusy_timeoutを設定し、複数ワーカーからの書き込みで即ロックエラーにならないようにする
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % SQLITE_BUSY_TIMEOUT)
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+#全文検索のFTS5テーブル(point_search*)はモデルに無いので、autogenerateの比較から外す
+def include_name(name, type_, parent_names):
+    return not (type_ == 'table' and name.startswith('point_search'))
+migrate = Migrate(app, db, include_name=include_name)
 login_manager = LoginManager()
 login_manager.init_app(app)
+#読み取りAPIのレスポンスキャッシュ(書き込み時にnamespace単位で無効化)
+response_cache = ResponseCache(MemoryCache(int(os.environ.get('CACHE_MAX_SIZE', 1024))),
+                               ttl=int(os.environ.get('CACHE_TTL', 60)))
+def cached_response(namespace):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.args.get('format') == 'ndjson':
+                return f(*args, **kwargs)
+            key = response_cache.key(namespace(**kwargs), request.full_path)
+            entry = response_cache.get(key)
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = (body, response.mimetype, response.headers.get('X-Next-After-Id'),
+                         response.headers.get('ETag') or quote_etag(make_etag(body)))
+                response_cache.set(key, entry)
+            body, mimetype, next_after_id, etag = entry
+            response = Response(body, mimetype=mimetype)
+            if next_after_id:
+                response.headers['X-Next-After-Id'] = next_after_id
+            response.headers['ETag'] = etag
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def invalidate(*namespaces):
+    for namespace in namespaces:
+        response_cache.invalidate(namespace)
+
+def route_namespaces_for_point(point_id):
+    route_ids = {row.id for row in db.session.query(Route.id).filter(
+        db.or_(Route.start_point_id == point_id, Route.end_point_id == point_id))}
+    route_ids.update(row.route_id for row in db.session.query(Waypoint.route_id).filter_by(waypoint_id=point_id))
+    return ['route:%d' % route_id for route_id in route_ids] + route_list_namespaces(route_ids)
+
+#経路が載る一覧(お気に入りしたユーザーのお気に入り一覧と人気順)
+def route_list_namespaces(route_ids):
+    if not route_ids:
+        return []
+    user_ids = {row.user_id for row in db.session.query(RouteFavorite.user_id).filter(
+        RouteFavorite.route_id.in_(list(route_ids))).distinct()}
+    return ['favorites:%d' % user_id for user_id in user_ids] + ['popular']
+
+#保存地点間の距離行列(地点の登録・変更・削除のたびに差分更新)
+distance_matrices = DistanceMatrixStore(os.environ.get('DISTANCE_MATRIX_DIR', os.path.join(app.instance_path, 'distance_matrix')),
+                                        int(os.environ.get('DISTANCE_MATRIX_MAX_POINTS', 5000)))
+def point_rows_loader(user_id):
+    def load(point_ids=None):
+        query = db.session.query(Point.id, Point.latitude, Point.longitude).filter_by(user_id=user_id)
+        if point_ids is not None:
+            query = query.filter(Point.id.in_(list(point_ids)))
+        return query.order_by(Point.id).all()
+    return load
+
+@app.route('/cache/stats',methods=['GET'])
+@login_required
+def get_cache_stats():
+    return jsonify(response_cache.stats()), 200
 #Access-Control-Allow-Credentials
 ALLOWED_ORIGINS = ['http://example.com']
 @app.after_request
@@ -23,59 +143,385 @@ def after_request_func(response):
         response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     return response
+#リクエストごとの計測(レイテンシ・SQL回数/時間・レスポンスサイズ)
+request_metrics = RequestMetrics()
+REQUEST_METRICS = os.environ.get('REQUEST_METRICS', '1') == '1'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 1.0))
+PROFILE_ON_REQUEST = os.environ.get('PROFILE_ON_REQUEST') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+#/metricsと?profile=1は Authorization: Bearer <METRICS_TOKEN> のリクエストだけに許す(未設定なら誰にも許さない)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+def metrics_authorized():
+    return bool(METRICS_TOKEN) and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + METRICS_TOKEN)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += time.perf_counter() - conn.info.get('query_started', time.perf_counter())
+
+@app.before_request
+def start_request_metrics():
+    if not REQUEST_METRICS:
+        return
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.profile_requested = PROFILE_ON_REQUEST and request.args.get('profile') == '1' and metrics_authorized()
+    if g.profile_requested or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+#?profile=1(PROFILE_ON_REQUEST=1でトークンを付けた時)かサンプリングされた遅いリクエストはcProfileの結果を保存する
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if g.profile_requested or elapsed >= PROFILE_SLOW_SECONDS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, '%d_%s.prof' % (time.time() * 1000, request.endpoint)))
+    request_metrics.observe(request.endpoint or 'unknown', request.method, response.status_code, elapsed,
+                            g.sql_queries, g.sql_seconds, None if response.is_streamed else response.content_length)
+    return response
+
+#レート制限と同時実行数の制限。読み取りと書き込みで別のバケットを使い、ログイン中はユーザー、未ログインは接続元アドレスごとに数える
+#バケットが空なら429、このプロセスで処理中のリクエストが上限なら503を、どちらもRetry-After付きで返す
+RATE_LIMIT_EXEMPT = {'static'}
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+READ_ENDPOINTS = {'batch_get_routes'}
+rate_limiter = RateLimiter(MemoryRateLimitBackend(int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))),
+                           {'read': (float(os.environ.get('RATE_LIMIT_READ_RATE', 20)), int(os.environ.get('RATE_LIMIT_READ_BURST', 40))),
+                            'write': (float(os.environ.get('RATE_LIMIT_WRITE_RATE', 5)), int(os.environ.get('RATE_LIMIT_WRITE_BURST', 10)))})
+admission_gate = ConcurrencyGate(int(os.environ.get('MAX_CONCURRENT_REQUESTS', 32)), float(os.environ.get('ADMISSION_TIMEOUT', 0.05)))
+def client_identity(user_id, address):
+    return 'user:%d' % user_id if user_id is not None else 'ip:%s' % address
+
+@app.before_request
+def admit_request():
+    if request.endpoint in RATE_LIMIT_EXEMPT:
+        return None
+    kind = 'read' if request.method in READ_METHODS or request.endpoint in READ_ENDPOINTS else 'write'
+    user_id = current_user.id if current_user.is_authenticated else None
+    retry_after = rate_limiter.check(client_identity(user_id, request.remote_addr), kind)
+    if retry_after:
+        return jsonify({'message': 'リクエストが多すぎます。'}), 429, {'Retry-After': str(retry_after)}
+    if not admission_gate.acquire():
+        return jsonify({'message': '混み合っています。'}), 503, {'Retry-After': '1'}
+    g.admitted = True
+    return None
+
+#ndjson等のストリーミングは書き出し終わるまで枠を持つ
+@app.teardown_request
+def release_admission(exception):
+    if g.pop('admitted', False):
+        admission_gate.release()
+
+#ジョブの状態ごとの件数はスクレイプのたびに数えず、METRICS_JOB_COUNTS_TTL秒だけ使い回す
+METRICS_JOB_COUNTS_TTL = float(os.environ.get('METRICS_JOB_COUNTS_TTL', 10))
+metrics_cache = MemoryCache(16)
+def job_status_counts():
+    counts = metrics_cache.get('job_counts')
+    if counts is None:
+        counts = dict(db.session.query(Job.status, db.func.count()).group_by(Job.status).all())
+        metrics_cache.set('job_counts', counts, METRICS_JOB_COUNTS_TTL)
+    return counts
+
+@app.route('/metrics',methods=['GET'])
+def get_metrics():
+    if not metrics_authorized():
+        abort(404)
+    stats = response_cache.stats()
+    jobs = job_status_counts()
+    return Response(request_metrics.render([('response_cache_hits', stats['hits']),
+                                            ('response_cache_misses', stats['misses']),
+                                            ('response_cache_hit_ratio', stats['hit_ratio']),
+                                            ('geocode_cache_hits', geocode_stats['hits']),
+                                            ('geocode_cache_misses', geocode_stats['misses']),
+                                            ('jobs_queued', jobs.get('queued', 0)),
+                                            ('jobs_running', jobs.get('running', 0)),
+                                            ('jobs_succeeded_total', job_queue.stats['succeeded']),
+                                            ('jobs_failed_total', job_queue.stats['failed']),
+                                            ('jobs_retried_total', job_queue.stats['retried']),
+                                            ('rate_limited_total', rate_limiter.limited),
+                                            ('admission_rejected_total', admission_gate.rejected),
+                                            ('requests_in_flight', admission_gate.active)]),
+                    mimetype='text/plain; version=0.0.4'), 200
 #ユーザー
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), nullable=False, unique=True)
-    password = db.Column(db.String(25))
+    password = db.Column(db.String(255))
+#空間インデックス用のグリッド(0.01度≒1km四方)
+GRID_SIZE = 0.01
+GRID_COLUMNS = int(360 / GRID_SIZE)
+EARTH_RADIUS = 6371000
+def grid_row(latitude):
+    return int((latitude + 90) / GRID_SIZE)
+def grid_column(longitude):
+    return int((longitude + 180) / GRID_SIZE)
+def grid_cell(latitude, longitude):
+    return grid_row(latitude) * GRID_COLUMNS + grid_column(longitude)
+def haversine(lat1, lng1, lat2, lng2):
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+#緯度経度を数値にして範囲を確かめる(不正ならValueError)
+def parse_coordinates(latitude, longitude):
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError('latitude and longitude must be numbers')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('latitude or longitude out of range')
+    return latitude, longitude
+#同じ場所かどうかの判定用(正規化した住所+丸めた緯度経度のハッシュ)
+COORDINATE_PRECISION = 6
+def point_hash(address, latitude, longitude):
+    content = '%s|%.*f|%.*f' % (normalize_address(address), COORDINATE_PRECISION, latitude, COORDINATE_PRECISION, longitude)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 #住所情報
 class Point(db.Model):
+    __table_args__ = (db.Index('ix_point_user_id_grid_cell', 'user_id', 'grid_cell'),
+                      db.Index('ix_point_user_id_content_hash', 'user_id', 'content_hash', unique=True),
+                      db.Index('ix_point_user_id_name', 'user_id', 'name'),
+                      db.Index('ix_point_user_id_address', 'user_id', 'address'))
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), nullable=False)
     address = db.Column(db.String(140), nullable=False)
-    latitude = db.Column(db.Float(140), nullable=False)
-    longitude = db.Column(db.Float(140), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    grid_cell = db.Column(db.Integer)
+    content_hash = db.Column(db.String(40), nullable=False)
+#名前・住所の全文検索用(SQLiteのみ)。trigramで分割するので日本語も3文字以上なら部分一致で引ける
+#本文は持たず(contentless)、ownerに'<user_id>'を入れてユーザーで絞り込む。pointの変更はトリガーで反映する
+POINT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE point_search USING fts5(owner, name, address, content='', tokenize='trigram')",
+    "CREATE TRIGGER point_search_insert AFTER INSERT ON point BEGIN "
+    "INSERT INTO point_search(rowid, owner, name, address) VALUES (new.id, '<' || new.user_id || '>', new.name, new.address); "
+    "END",
+    "CREATE TRIGGER point_search_delete AFTER DELETE ON point BEGIN "
+    "INSERT INTO point_search(point_search, rowid, owner, name, address) "
+    "VALUES ('delete', old.id, '<' || old.user_id || '>', old.name, old.address); "
+    "END",
+    "CREATE TRIGGER point_search_update AFTER UPDATE OF user_id, name, address ON point BEGIN "
+    "INSERT INTO point_search(point_search, rowid, owner, name, address) "
+    "VALUES ('delete', old.id, '<' || old.user_id || '>', old.name, old.address); "
+    "INSERT INTO point_search(rowid, owner, name, address) VALUES (new.id, '<' || new.user_id || '>', new.name, new.address); "
+    "END",
+]
+for statement in POINT_SEARCH_DDL:
+    event.listen(Point.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Point.__table__, 'after_drop', DDL('DROP TABLE IF EXISTS point_search').execute_if(dialect='sqlite'))
+point_search = db.table('point_search', db.column('rowid', db.Integer))
 #経路情報
 class Route(db.Model):
+    __table_args__ = (db.Index('ix_route_favorite_count', 'favorite_count', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    start_point = db.Column(db.String(128), nullable=False)
-    end_point = db.Column(db.String(128), nullable=False)
-    start_point_id = db.Column(db.Integer, db.ForeignKey('point.id'), nullable=False)  
-    end_point_id = db.Column(db.Integer, db.ForeignKey('point.id'), nullable=False)  
-    waypoints = db.relationship('Waypoint', backref='route', lazy=True)
-    favorited = db.Column(db.Boolean, default=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    start_point_id = db.Column(db.Integer, db.ForeignKey('point.id'), nullable=False, index=True)
+    end_point_id = db.Column(db.Integer, db.ForeignKey('point.id'), nullable=False, index=True)
+    waypoints = db.relationship('Waypoint', backref='route', lazy=True, order_by='Waypoint.position', cascade='all, delete-orphan')
+    #お気に入りしたユーザー数(route_favoriteの件数を登録・解除と同じトランザクションで増減する)
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    #楽観的排他制御用(経路・経由地を変更するたびに1増やす。PATCHはIf-Matchで指定されたversionと比べる)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     start_location = db.relationship('Point', foreign_keys=[start_point_id], uselist=False, backref='route_start')
     end_location = db.relationship('Point', foreign_keys=[end_point_id], uselist=False, backref='route_end')
 class Waypoint(db.Model):
+    __table_args__ = (db.Index('ix_waypoint_route_id_position', 'route_id', 'position'),)
     id = db.Column(db.Integer, primary_key=True)
     route_id = db.Column(db.Integer, db.ForeignKey('route.id'), nullable=False)
-    waypoint = db.Column(db.String(128), nullable=False)
-    waypoint_id = db.Column(db.Integer, db.ForeignKey('point.id'), nullable=False) 
+    waypoint_id = db.Column(db.Integer, db.ForeignKey('point.id'), nullable=False, index=True)
+    #経路内での順番(0から)
+    position = db.Column(db.Integer, nullable=False)
     way_location = db.relationship('Point', foreign_keys=[waypoint_id], uselist=False, backref='route_way')
+#お気に入り(ユーザーと経路の多対多)
+class RouteFavorite(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id'), primary_key=True, index=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+#差分同期用の変更履歴(追記のみ)。idが同期のカーソルになる(idの順にコミットされるようlock_change_logで書き込みを直列にする)
+#entityはpoint/route/favorite(favoriteのentity_idは経路のid)、opはupsert/delete
+class ChangeLog(db.Model):
+    __table_args__ = (db.Index('ix_change_log_user_id_id', 'user_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+#圧縮で古い削除履歴を消したユーザーの、消したところまでのカーソル(これより前からは同期できない)
+class SyncFloor(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    change_id = db.Column(db.Integer, nullable=False)
+#PostgreSQLのシーケンスは採番した順にコミットされるとは限らず、後から小さいidの履歴が見えるようになると
+#同期のカーソルがそれを飛ばしてしまう。履歴を書くトランザクションはコミットまでアドバイザリロックで直列にする
+#(SQLiteは書き込みが常に直列なので何もしない。他のDBには対応しない)
+CHANGE_LOG_LOCK = 7353
+def lock_change_log():
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK})
+#書き込みと同じトランザクションで変更履歴を追記する
+def log_changes(user_id, entity, op, entity_ids):
+    now = datetime.datetime.utcnow()
+    rows = [{'user_id': user_id, 'entity': entity, 'entity_id': entity_id, 'op': op, 'created_at': now}
+            for entity_id in entity_ids]
+    if rows:
+        lock_change_log()
+        db.session.execute(ChangeLog.__table__.insert(), rows)
+#削除する経路をお気に入りしていたユーザーそれぞれに、お気に入りの削除を記録する(route_favoriteを消す前に呼ぶ)
+def log_favorite_deletes(route_ids):
+    lock_change_log()
+    db.session.execute(ChangeLog.__table__.insert().from_select(
+        ['user_id', 'entity', 'entity_id', 'op', 'created_at'],
+        db.select(RouteFavorite.user_id, db.literal('favorite'), RouteFavorite.route_id, db.literal('delete'),
+                  db.literal(datetime.datetime.utcnow(), db.DateTime)).where(RouteFavorite.route_id.in_(route_ids))))
+#ジオコーディング結果のキャッシュ(正規化した住所ごと)
+class GeocodeCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    address = db.Column(db.String(140), nullable=False, unique=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+#バックグラウンドジョブ(statusはqueued/running/done/failed、payloadとresultはJSON)
+class Job(db.Model):
+    __table_args__ = (db.Index('ix_job_status_priority', 'status', 'priority', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+#JOB_WORKERSスレッドでジョブを実行し、経路計画などの計算はJOB_PROCESSESのプロセスで行う
+job_queue = JobQueue(app, db, Job,
+                     threads=int(os.environ.get('JOB_WORKERS', 2)),
+                     processes=int(os.environ.get('JOB_PROCESSES', 0)) or None,
+                     poll_interval=float(os.environ.get('JOB_POLL_INTERVAL', 0.5)),
+                     timeout=int(os.environ.get('JOB_TIMEOUT', 600)))
+#Prefer: respond-asyncが付いたリクエストはジョブにして202を返す
+def respond_async_requested():
+    return 'respond-async' in request.headers.get('Prefer', '')
+def job_accepted(job):
+    response = jsonify(job_to_dict(job))
+    response.headers['Location'] = '/jobs/%d' % job.id
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response, 202
+#住所だけで登録された地点の座標を解決する(GEOCODER=fakeでテスト用のジオコーダー)
+geocoder = FakeGeocoder(float(os.environ.get('GEOCODER_LATENCY', 0))) if os.environ.get('GEOCODER') == 'fake' else None
+GEOCODER_CONCURRENCY = int(os.environ.get('GEOCODER_CONCURRENCY', 8))
+GEOCODE_TTL = datetime.timedelta(days=int(os.environ.get('GEOCODE_TTL_DAYS', 30)))
+GEOCODE_LOOKUP_CHUNK = 500
+geocode_stats = {'hits': 0, 'misses': 0}
+def resolve_addresses(addresses):
+    if geocoder is None or not addresses:
+        return {}
+    normalized = {address: normalize_address(address) for address in addresses}
+    keys = sorted(set(normalized.values()))
+    now = datetime.datetime.utcnow()
+    resolved = {}
+    for i in range(0, len(keys), GEOCODE_LOOKUP_CHUNK):
+        rows = db.session.query(GeocodeCache.address, GeocodeCache.latitude, GeocodeCache.longitude).filter(
+            GeocodeCache.address.in_(keys[i:i + GEOCODE_LOOKUP_CHUNK]),
+            GeocodeCache.updated_at >= now - GEOCODE_TTL).all()
+        resolved.update((row.address, (row.latitude, row.longitude)) for row in rows)
+    missing = [key for key in keys if key not in resolved]
+    geocode_stats['hits'] += len(keys) - len(missing)
+    geocode_stats['misses'] += len(missing)
+    found = {key: coordinates for key, coordinates in geocode_concurrently(geocoder, missing, GEOCODER_CONCURRENCY).items()
+             if coordinates is not None}
+    if found:
+        found_keys = sorted(found)
+        try:
+            for i in range(0, len(found_keys), GEOCODE_LOOKUP_CHUNK):
+                GeocodeCache.query.filter(GeocodeCache.address.in_(found_keys[i:i + GEOCODE_LOOKUP_CHUNK])).delete(
+                    synchronize_session=False)
+            db.session.bulk_insert_mappings(GeocodeCache, [
+                {'address': key, 'latitude': found[key][0], 'longitude': found[key][1], 'updated_at': now}
+                for key in found_keys])
+            db.session.commit()
+        except IntegrityError:
+            #他のリクエストが同じ住所を先に保存した場合はそちらを使う
+            db.session.rollback()
+        resolved.update(found)
+    return {address: resolved.get(key) for address, key in normalized.items()}
+
+#ログイン中のユーザー情報(idとusernameだけ)をキャッシュし、リクエストごとのSELECTを省く
+class UserIdentity(UserMixin):
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+user_cache = MemoryCache(int(os.environ.get('USER_CACHE_MAX_SIZE', 10000)))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    identity = user_cache.get(user_id)
+    if identity is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        identity = (user.id, user.username)
+        user_cache.set(user_id, identity, USER_CACHE_TTL)
+    return UserIdentity(*identity)
+#パスワードのハッシュ化・照合はCPUを使うので別プロセスで行い、同時に走る数を制限する
+#(プロセスは最初の呼び出しで、スレッドやDB接続を持ったプロセスをforkしないようspawnで起動する)
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+password_executor = ProcessPoolExecutor(max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+                                        mp_context=multiprocessing.get_context('spawn'))
+def hash_password(password):
+    return password_executor.submit(generate_password_hash, password, method=PASSWORD_HASH_METHOD).result()
+def verify_password(password_hash, password):
+    return password_executor.submit(check_password_hash, password_hash, password).result()
+#ログイン
+@app.route('/login',methods=['POST'])
+def login():
+    data=request.get_json()
+    user=User.query.filter_by(username=data['username']).first()
+    if user is None or not user.password or not verify_password(user.password,data['password']):
+        return jsonify({'message': 'ユーザー名またはパスワードが違います。'}), 401
+    login_user(UserIdentity(user.id,user.username))
+    return jsonify({'id':user.id,'username':user.username}),200
 #ユーザー登録
 @app.route('/users',methods=['POST'])
 def create_user():
     data=request.get_json()
-    hashed_password = generate_password_hash(data['password'], method='sha256')
+    hashed_password = hash_password(data['password'])
     user=User(username=data['username'],password=hashed_password)
     db.session.add(user)
     db.session.commit()
     return jsonify({'id':user.id,'username':user.username}),201
 
-@app.route('/users',methods=['GET'])
+@app.route('/users/<int:user_id>',methods=['GET'])
 @login_required
 def get_user(user_id):
     user=User.query.get_or_404(user_id)
-    return jsonify({'username':user.username,
-                    'password':user.password})
+    return jsonify({'id':user.id,
+                    'username':user.username})
 @app.route('/users/<int:user_id>',methods=['PUT'])
 @login_required
 def update_user(user_id):
+    #変更できるのは自分のユーザーだけ
+    if user_id != current_user.id:
+        abort(403)
     user = User.query.get(user_id)
     if not user:
         abort(404)  
@@ -83,178 +529,1064 @@ def update_user(user_id):
     if 'username' in data:
         user.username=data['username']
     if 'password' in data:
-        user.password=generate_password_hash(data['password'], method='sha256')
+        user.password=hash_password(data['password'])
     db.session.commit()
+    user_cache.delete(user.id)
     return jsonify({'id': user.id, 'username': user.username}), 200
 #住所登録
 @app.route('/points',methods=['POST'])
 @login_required
 def create_point():
     data=request.get_json()
-    point=Point(name=data['name'],adress=data['address'],user_id=data['user_id'],latitude=data['latitude'],longitude=data['longitude'])
+    if 'latitude' not in data or 'longitude' not in data:
+        coordinates=resolve_addresses([data['address']]).get(data['address'])
+        if coordinates is None:
+            return jsonify({'message': '住所から緯度経度を取得できませんでした。'}), 400
+        data['latitude'],data['longitude']=coordinates
+    try:
+        data['latitude'],data['longitude']=parse_coordinates(data['latitude'],data['longitude'])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    content_hash=point_hash(data['address'],data['latitude'],data['longitude'])
+    #同じ場所が既に登録されていればそれを返す
+    existing=Point.query.filter_by(user_id=current_user.id,content_hash=content_hash).first()
+    if existing:
+        return jsonify(point_to_dict(existing)),200
+    point=Point(name=data['name'],address=data['address'],user_id=current_user.id,latitude=data['latitude'],longitude=data['longitude'])
+    point.grid_cell=grid_cell(point.latitude,point.longitude)
+    point.content_hash=content_hash
     db.session.add(point)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        existing=Point.query.filter_by(user_id=current_user.id,content_hash=content_hash).first_or_404()
+        return jsonify(point_to_dict(existing)),200
+    log_changes(point.user_id,'point','upsert',[point.id])
+    #コミットすると属性が失効して読み直しになるので、その前に辞書にしておく
+    body=point_to_dict(point)
     db.session.commit()
-    return jsonify({
-        'id':point.id,
-        'name':point.name,
-        'address':point.adress,
-        'latitude':point.latitude,
-        'longitude':point.longitude,
-        'user_id':point.user_id
-        }),201
+    invalidate('points:%d' % body['user_id'])
+    distance_matrices.add(body['user_id'], [(body['id'], body['latitude'], body['longitude'])])
+    return jsonify(body),201
+
+#一覧取得のページング(after_idより後のidをlimit件)、format=ndjsonでストリーミング
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+def list_response(query, id_column, to_dict):
+    after_id = request.args.get('after_id', 0, type=int)
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    query = query.filter(id_column > after_id).order_by(id_column)
+    if request.args.get('format') == 'ndjson':
+        if 'limit' in request.args:
+            query = query.limit(limit)
+        def generate():
+            rows = iter(query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE))
+            while batch := list(itertools.islice(rows, STREAM_BATCH_SIZE)):
+                yield app.json.dumps_lines(to_dict(row) for row in batch)
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    rows = query.limit(limit).all()
+    response = jsonify([to_dict(row) for row in rows])
+    if len(rows) == limit:
+        response.headers['X-Next-After-Id'] = str(rows[-1].id)
+    return response, 200
+
+def point_to_dict(point):
+    return {
+        'id': point.id,
+        'name': point.name,
+        'address': point.address,
+        'latitude': point.latitude,
+        'longitude': point.longitude,
+        'user_id': point.user_id,
+    }
 
 @app.route('/points',methods=['GET'])
 @login_required
-def get_point(user_id):
-    point=Point.query.filter_by(user_id=user_id).all()
-    point_data=[{
-        'id': point.id,
-        'name':point.name,
-        'address':point.adress,
-        'latitude':point.latitude,
-        'longitude':point.longitude,
-        'user_id':point.user_id,
-    } for point in point]
-    return jsonify(point_data),200
-
-@app.route('/points/<int:points_id>',methods=['PUT'])
+@cached_response(lambda: 'points:%d' % current_user.id)
+def get_point():
+    query=db.session.query(Point.id,Point.name,Point.address,Point.latitude,Point.longitude,Point.user_id).filter(
+        Point.user_id==current_user.id)
+    return list_response(query,Point.id,record)
+
+#矩形内の住所検索。min_lng > max_lngは日付変更線をまたぐ矩形として、東西の2つの範囲に分けて引く
+def query_points_in_bbox(user_id, min_lat, min_lng, max_lat, max_lng):
+    if min_lng > max_lng:
+        return (query_points_in_bbox(user_id, min_lat, min_lng, max_lat, 180) +
+                query_points_in_bbox(user_id, min_lat, -180, max_lat, max_lng))
+    first_row, last_row = grid_row(min_lat), grid_row(max_lat)
+    first_col, last_col = grid_column(min_lng), grid_column(max_lng)
+    if last_row - first_row < 64:
+        cells = db.or_(*[Point.grid_cell.between(row * GRID_COLUMNS + first_col, row * GRID_COLUMNS + last_col)
+                         for row in range(first_row, last_row + 1)])
+    else:
+        cells = Point.grid_cell.between(first_row * GRID_COLUMNS, (last_row + 1) * GRID_COLUMNS - 1)
+    return db.session.query(Point.id, Point.name, Point.address, Point.latitude, Point.longitude, Point.user_id).filter(
+        Point.user_id == user_id,
+        cells,
+        Point.latitude.between(min_lat, max_lat),
+        Point.longitude.between(min_lng, max_lng)).all()
+
+def get_float_arg(name, minimum, maximum):
+    value = request.args.get(name, type=float)
+    if value is None or not minimum <= value <= maximum:
+        abort(400)
+    return value
+
+@app.route('/points/bbox',methods=['GET'])
+@login_required
+def get_points_in_bbox():
+    min_lat = get_float_arg('min_lat', -90, 90)
+    min_lng = get_float_arg('min_lng', -180, 180)
+    max_lat = get_float_arg('max_lat', -90, 90)
+    max_lng = get_float_arg('max_lng', -180, 180)
+    if min_lat > max_lat:
+        abort(400)
+    points = query_points_in_bbox(current_user.id, min_lat, min_lng, max_lat, max_lng)
+    return jsonify([record(point) for point in points]), 200
+
+#保存地点間の距離行列(ids=1,2,3で一部のみ)
+@app.route('/points/distance-matrix',methods=['GET'])
+@login_required
+def get_distance_matrix():
+    point_ids = None
+    if request.args.get('ids'):
+        try:
+            point_ids = [int(point_id) for point_id in request.args['ids'].split(',')]
+        except ValueError:
+            abort(400)
+    result = distance_matrices.get(current_user.id, point_rows_loader(current_user.id), point_ids)
+    if result is None:
+        abort(404)
+    ids, matrix = result
+    return jsonify({'ids': ids.tolist(), 'matrix': matrix.tolist()}), 200
+
+#周辺の住所検索(radiusはメートル)
+@app.route('/points/nearby',methods=['GET'])
+@login_required
+def get_points_nearby():
+    lat = get_float_arg('lat', -90, 90)
+    lng = get_float_arg('lng', -180, 180)
+    radius = get_float_arg('radius', 0, 100000)
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlng = math.degrees(radius / (EARTH_RADIUS * max(math.cos(math.radians(lat)), 1e-6)))
+    #経度の範囲は日付変更線の反対側に折り返す(1周以上か、円が極を含むなら全経度)
+    if dlng >= 180 or lat + dlat >= 90 or lat - dlat <= -90:
+        min_lng, max_lng = -180, 180
+    else:
+        min_lng = lng - dlng + 360 if lng - dlng < -180 else lng - dlng
+        max_lng = lng + dlng - 360 if lng + dlng > 180 else lng + dlng
+    candidates = query_points_in_bbox(current_user.id, max(lat - dlat, -90), min_lng, min(lat + dlat, 90), max_lng)
+    nearby = []
+    for point in candidates:
+        distance = haversine(lat, lng, point.latitude, point.longitude)
+        if distance <= radius:
+            nearby.append((distance, point))
+    nearby.sort(key=lambda item: item[0])
+    return jsonify([dict(record(point), distance=distance) for distance, point in nearby]), 200
+
+#名前・住所の検索(q=キーワード、空白区切りでAND)。1語なら名前・住所の前方一致を先に返し、
+#3文字以上の語はFTS5で部分一致を探す(2文字以下の語は他の語で絞った結果をLIKEで確かめる)
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+MIN_NGRAM = 3
+def prefix_filter(column, prefix):
+    return db.and_(column >= prefix, column < prefix + '\U0010ffff')
+
+def fts_phrase(term):
+    return '"%s"' % term.replace('"', '""')
+
+def search_points(user_id, terms, limit):
+    points = []
+    if len(terms) == 1:
+        for column in (Point.name, Point.address):
+            points.extend(Point.query.filter(Point.user_id == user_id, prefix_filter(column, terms[0])).order_by(
+                column).limit(limit - len(points)).all())
+            if len(points) >= limit:
+                return points
+    query = Point.query.filter(Point.user_id == user_id)
+    long_terms = [term for term in terms if len(term) >= MIN_NGRAM]
+    if long_terms and db.engine.dialect.name == 'sqlite':
+        match = '{name address}:(%s) AND owner:"<%d>"' % (' AND '.join(fts_phrase(term) for term in long_terms), user_id)
+        query = query.join(point_search, point_search.c.rowid == Point.id).filter(
+            db.text('point_search MATCH :match').bindparams(match=match)).order_by(point_search.c.rowid.desc())
+        terms = [term for term in terms if len(term) < MIN_NGRAM]
+    elif len(terms) == 1 and len(terms[0]) < MIN_NGRAM:
+        return points
+    else:
+        query = query.order_by(Point.id.desc())
+    for term in terms:
+        query = query.filter(db.or_(Point.name.contains(term, autoescape=True), Point.address.contains(term, autoescape=True)))
+    seen = {point.id for point in points}
+    points.extend(point for point in query.limit(limit + len(seen)).all() if point.id not in seen)
+    return points[:limit]
+
+@app.route('/points/search',methods=['GET'])
+@login_required
+def get_points_search():
+    terms = request.args.get('q', '').split()
+    if not terms:
+        abort(400)
+    limit = max(1, min(request.args.get('limit', SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT))
+    return jsonify([point_to_dict(point) for point in search_points(current_user.id, terms, limit)]), 200
+
+@app.route('/points/<int:point_id>',methods=['PUT'])
 @login_required
 def update_point(point_id):
-    point = Point.query.get(point_id)
-    if not point:
-        abort(404)  
+    point = Point.query.filter_by(id=point_id, user_id=current_user.id).first_or_404()
     data = request.get_json()
     point.name=data.get('name',point.name)
-    point.adress=data.get('address',point.adress)
+    point.address=data.get('address',point.address)
+    moved = 'latitude' in data or 'longitude' in data
+    if moved:
+        try:
+            point.latitude,point.longitude=parse_coordinates(data.get('latitude',point.latitude),data.get('longitude',point.longitude))
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        point.grid_cell=grid_cell(point.latitude,point.longitude)
+    point.content_hash=point_hash(point.address,point.latitude,point.longitude)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': '同じ場所が既に登録されています。'}), 409
+    log_changes(point.user_id,'point','upsert',[point.id])
+    body = point_to_dict(point)
     db.session.commit()
-    return jsonify({
-        'id': point.id, 
-        'name': point.name,
-        'address':point.adress,
-        'latitude':point.latitude,
-        'longitude':point.latitude,
-        'user_id':point.user_id}), 200
+    invalidate('points:%d' % body['user_id'], *route_namespaces_for_point(body['id']))
+    if moved:
+        distance_matrices.add(body['user_id'], [(body['id'], body['latitude'], body['longitude'])])
+    return jsonify(body), 200
     
-@app.route('/points/<int:points_id>', methods=['DELETE'])
+@app.route('/points/<int:point_id>', methods=['DELETE'])
 @login_required
 def delete_point(point_id):
-    point = Point.query.get(point_id)
-    if not point:
-        abort(404)  
-    db.session.delete(point)
-    db.session.commit()
+    point = Point.query.filter_by(id=point_id, user_id=current_user.id).first_or_404()
+    #多くの経路で使われている地点はジョブで削除する
+    references = db.session.query(Route.id).filter(
+        db.or_(Route.start_point_id == point.id, Route.end_point_id == point.id)).limit(DELETE_INLINE_LIMIT + 1).count()
+    references += db.session.query(Waypoint.id).filter_by(waypoint_id=point.id).limit(DELETE_INLINE_LIMIT + 1).count()
+    if respond_async_requested() or references > DELETE_INLINE_LIMIT:
+        return job_accepted(job_queue.enqueue('delete_point', {'point_id': point.id}, current_user.id))
+    delete_point_and_routes(point)
     return jsonify({'message': ' 登録情報は削除されました'}), 200
+
+#地点を削除し、その地点を始点・終点とする経路は削除、経由地としての参照は外す
+DELETE_INLINE_LIMIT = int(os.environ.get('DELETE_INLINE_LIMIT', 20))
+def delete_point_and_routes(point):
+    user_id, point_id = point.user_id, point.id
+    namespaces = ['points:%d' % user_id] + route_namespaces_for_point(point_id)
+    routes = db.session.query(Route.id).filter(db.or_(Route.start_point_id == point_id, Route.end_point_id == point_id))
+    passing = db.session.query(Waypoint.route_id).filter(Waypoint.waypoint_id == point_id)
+    deleted_route_ids = [row.id for row in routes]
+    changed_route_ids = {row.route_id for row in passing} - set(deleted_route_ids)
+    Route.query.filter(Route.id.in_(passing.scalar_subquery()), Route.id.notin_(routes.scalar_subquery())).update(
+        {Route.version: Route.version + 1}, synchronize_session=False)
+    log_changes(user_id, 'point', 'delete', [point_id])
+    log_changes(user_id, 'route', 'delete', deleted_route_ids)
+    log_changes(user_id, 'route', 'upsert', sorted(changed_route_ids))
+    log_favorite_deletes(routes.scalar_subquery())
+    Waypoint.query.filter(db.or_(Waypoint.waypoint_id == point_id, Waypoint.route_id.in_(routes.scalar_subquery()))).delete(
+        synchronize_session=False)
+    RouteFavorite.query.filter(RouteFavorite.route_id.in_(routes.scalar_subquery())).delete(synchronize_session=False)
+    deleted_routes = Route.query.filter(Route.id.in_(routes.scalar_subquery())).delete(synchronize_session=False)
+    Point.query.filter_by(id=point_id).delete(synchronize_session=False)
+    db.session.commit()
+    invalidate(*namespaces)
+    distance_matrices.remove(user_id, point_id)
+    return deleted_routes
 #経路登録
 @app.route('/routes',methods=['POST'])
 @login_required
 def create_route():
     data=request.get_json()
     user_id=current_user.id
-    start_point=data['start_point']
-    end_point=data['end_point']
-    waypoints=data.get('waypoint',[])
-    route=Route(user_id=user_id,start_point=start_point,end_point=end_point)
-    db.session.add(route)
-    db.session.flush()
-    for waypoint_data in waypoints:
-        point=Point(
-            name=waypoint_data['name'],
-            address=waypoint_data['address'],
-            latitude=waypoint_data['latitude'], 
-            longitude=waypoint_data['longitude'],
-            user_id=user_id
-        )
-        db.session.add(waypoint)
-    db.session.commit()
-    return jsonify({'route_id':route.id,'waypoints':len(waypoints)}),201
+    if respond_async_requested():
+        return job_accepted(job_queue.enqueue('create_routes',[data],user_id))
+    coordinates=resolve_addresses(addresses_to_geocode([data]))
+    try:
+        start,end,waypoints=parse_route_item(data,coordinates)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    route_rows,new_points=save_routes(user_id,[(start,end,waypoints)])
+    after_points_created(user_id,new_points)
+    return jsonify({'route_id':route_rows[0]['id'],'waypoints':len(waypoints)}),201
+
+#経路の一括登録
+BULK_ROUTE_LIMIT = 10000
+BULK_LOOKUP_CHUNK = 500
+def read_bulk_items():
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.stream:
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        return items
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400)
+    return items
+
+def point_key(data, coordinates):
+    if not isinstance(data, dict):
+        raise ValueError('point must be an object')
+    name, address = data.get('name'), data.get('address')
+    if not isinstance(name, str) or not isinstance(address, str):
+        raise ValueError('name and address are required')
+    if 'latitude' not in data and 'longitude' not in data and address in coordinates:
+        if coordinates[address] is None:
+            raise ValueError('address could not be geocoded')
+        return (name, address) + tuple(coordinates[address])
+    if 'latitude' not in data or 'longitude' not in data:
+        raise ValueError('latitude and longitude are required')
+    return (name, address) + parse_coordinates(data['latitude'], data['longitude'])
+
+def parse_route_item(item, coordinates):
+    if not isinstance(item, dict):
+        raise ValueError('route must be an object')
+    start = point_key(item.get('start_point'), coordinates)
+    end = point_key(item.get('end_point'), coordinates)
+    waypoints = item.get('waypoint', [])
+    if not isinstance(waypoints, list):
+        raise ValueError('waypoint must be a list')
+    return start, end, [point_key(waypoint, coordinates) for waypoint in waypoints]
+
+#緯度経度の無い地点の住所(まとめてジオコーディングする)
+def addresses_to_geocode(items):
+    addresses = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        waypoints = item.get('waypoint')
+        for point in [item.get('start_point'), item.get('end_point')] + (waypoints if isinstance(waypoints, list) else []):
+            if (isinstance(point, dict) and isinstance(point.get('address'), str)
+                    and 'latitude' not in point and 'longitude' not in point):
+                addresses.append(point['address'])
+    return addresses
+
+def find_existing_points(user_id, content_hashes):
+    point_ids = {}
+    content_hashes = sorted(content_hashes)
+    for i in range(0, len(content_hashes), BULK_LOOKUP_CHUNK):
+        rows = db.session.query(Point.id, Point.content_hash).filter(
+            Point.user_id == user_id,
+            Point.content_hash.in_(content_hashes[i:i + BULK_LOOKUP_CHUNK])).all()
+        point_ids.update((row.content_hash, row.id) for row in rows)
+    return point_ids
+
+#routesは(始点, 終点, [経由地])の一覧。同じユーザーの同一地点は既存のPointを使い、まとめてINSERTする
+def insert_routes(user_id, routes):
+    hashes = {}
+    for start, end, waypoints in routes:
+        for key in [start, end] + waypoints:
+            hashes.setdefault(key, point_hash(key[1], key[2], key[3]))
+    point_ids = find_existing_points(user_id, set(hashes.values()))
+    new_points = {}
+    for key, content_hash in hashes.items():
+        if content_hash not in point_ids and content_hash not in new_points:
+            new_points[content_hash] = {'name': key[0], 'address': key[1], 'latitude': key[2], 'longitude': key[3],
+                                        'user_id': user_id, 'grid_cell': grid_cell(key[2], key[3]),
+                                        'content_hash': content_hash}
+    new_points = list(new_points.values())
+    db.session.bulk_insert_mappings(Point, new_points, return_defaults=True)
+    point_ids.update((row['content_hash'], row['id']) for row in new_points)
+
+    route_rows = [{'user_id': user_id,
+                   'start_point_id': point_ids[hashes[start]],
+                   'end_point_id': point_ids[hashes[end]],
+                   'favorite_count': 0} for start, end, waypoints in routes]
+    db.session.bulk_insert_mappings(Route, route_rows, return_defaults=True)
+    waypoint_rows = [{'route_id': route_row['id'], 'waypoint_id': point_ids[hashes[key]], 'position': position}
+                     for route_row, (start, end, waypoints) in zip(route_rows, routes)
+                     for position, key in enumerate(waypoints)]
+    db.session.bulk_insert_mappings(Waypoint, waypoint_rows)
+    log_changes(user_id, 'point', 'upsert', [row['id'] for row in new_points])
+    log_changes(user_id, 'route', 'upsert', [row['id'] for row in route_rows])
+    return route_rows, new_points
+
+#同じ地点を同時に登録した場合は一意制約で失敗するので、既存の地点を使って1回だけやり直す
+def save_routes(user_id, routes):
+    try:
+        result = insert_routes(user_id, routes)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        result = insert_routes(user_id, routes)
+        db.session.commit()
+    return result
+
+def after_points_created(user_id, new_points):
+    invalidate('points:%d' % user_id)
+    if new_points:
+        distance_matrices.add(user_id, [(row['id'], row['latitude'], row['longitude']) for row in new_points])
 
-@app.route('/routes',methods=['GET'])
+@app.route('/routes/bulk',methods=['POST'])
 @login_required
+def create_routes_bulk():
+    items = read_bulk_items()
+    if len(items) > BULK_ROUTE_LIMIT:
+        abort(413)
+    if respond_async_requested():
+        return job_accepted(job_queue.enqueue('create_routes', items, current_user.id))
+    result = create_routes_from_items(current_user.id, items)
+    return jsonify(result), 201 if result['created'] or not result['errors'] else 400
+
+def create_routes_from_items(user_id, items):
+    errors = []
+    indexes = []
+    routes = []
+    coordinates = resolve_addresses(addresses_to_geocode(items))
+    for index, item in enumerate(items):
+        try:
+            routes.append(parse_route_item(item, coordinates))
+            indexes.append(index)
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+    route_rows, new_points = save_routes(user_id, routes)
+    after_points_created(user_id, new_points)
+    return {
+        'created': [{'index': index, 'route_id': route_row['id']} for index, route_row in zip(indexes, route_rows)],
+        'points_created': len(new_points),
+        'errors': errors}
+
+def location_to_dict(point):
+    return {'id': point.id,
+            'name': point.name,
+            'address': point.address,
+            'latitude': point.latitude,
+            'longitude': point.longitude}
+
+#経路と始点・終点・経由地をまとめて取得(2クエリ)
+def load_route(route_id):
+    return Route.query.options(
+        joinedload(Route.start_location),
+        joinedload(Route.end_location),
+        selectinload(Route.waypoints).joinedload(Waypoint.way_location)
+    ).filter_by(id=route_id).first_or_404()
+
+@app.route('/routes/<int:route_id>',methods=['GET'])
+@login_required
+@cached_response(lambda route_id: 'route:%d' % route_id)
 def get_route(route_id):
-    route=Route.query.get_or_404(route_id)
-    db.session.refresh(route)
-    waypoints = Waypoint.query.filter_by(route_id=route.id).all()
-    waypoints_data = [{'id': wp.id, 'location': wp.location} for wp in waypoints]
-    return jsonify({
+    route=load_route(route_id)
+    response=jsonify(route_to_dict(route, route.start_location, route.end_location,
+                                   [(wp.id, wp.way_location) for wp in route.waypoints]))
+    response.headers['ETag']=route_etag(route.id, route.version, response.get_data())
+    return response
+
+#経路のETag(W/"<id>-<version>-<本文のハッシュ>")。PATCHのIf-Matchではidとversionだけを比べる
+#本文のハッシュは、地点名の変更のようにversionが変わらない変更でも304にしないために付ける
+ROUTE_ETAG = re.compile(r'^(\d+)-(\d+)(?:-[0-9a-f]+)?$')
+def route_etag(route_id, version, body=None):
+    return 'W/"%d-%d%s"' % (route_id, version, '' if body is None else '-' + make_etag(body))
+
+def route_version_matches(if_match, route):
+    if if_match.star_tag:
+        return True
+    for tag in if_match.as_set(include_weak=True):
+        match = ROUTE_ETAG.match(tag)
+        if match and int(match.group(1)) == route.id and int(match.group(2)) == route.version:
+            return True
+    return False
+
+#waypointsは(経由地のid, 地点)のリスト
+def route_to_dict(route, start, end, waypoints):
+    return {
         'id': route.id,
         'user_id':route.user_id,
-        'start_point':route.start_point,
-        'end_point':route.end_point,
-        'waypoint':waypoints_data})
+        'start_point':start.name,
+        'end_point':end.name,
+        'start_location':location_to_dict(start),
+        'end_location':location_to_dict(end),
+        'waypoint':[{'id': waypoint_id,
+                     'waypoint': point.name,
+                     'location': location_to_dict(point)} for waypoint_id, point in waypoints],
+        'version':route.version}
+
+#複数の経路をまとめて取得(本文は経路idのリスト)。自分の経路だけをIN句で読み、件数によらず
+#経路・経由地・地点の3クエリ(件数が多ければチャンクごと)で済ませる(ORMのオブジェクトを作らず列だけ読む)。見つからない・他人の経路のidはmissingで返す
+BATCH_GET_LIMIT = 1000
+@app.route('/routes/batch-get',methods=['POST'])
+@login_required
+def batch_get_routes():
+    route_ids = request.get_json(silent=True)
+    if not isinstance(route_ids, list) or not all(type(route_id) is int for route_id in route_ids):
+        abort(400)
+    route_ids = list(dict.fromkeys(route_ids))
+    if len(route_ids) > BATCH_GET_LIMIT:
+        abort(413)
+    #IN句はSQLiteの変数の上限を超えないようBULK_LOOKUP_CHUNK件ずつに分ける
+    routes = {}
+    waypoints = {}
+    points = {}
+    for i in range(0, len(route_ids), BULK_LOOKUP_CHUNK):
+        routes.update((row.id, row) for row in db.session.query(
+            Route.id, Route.user_id, Route.version, Route.start_point_id, Route.end_point_id).filter(
+            Route.id.in_(route_ids[i:i + BULK_LOOKUP_CHUNK]), Route.user_id == current_user.id))
+    found_ids = sorted(routes)
+    for i in range(0, len(found_ids), BULK_LOOKUP_CHUNK):
+        for row in db.session.query(Waypoint.id, Waypoint.route_id, Waypoint.waypoint_id).filter(
+                Waypoint.route_id.in_(found_ids[i:i + BULK_LOOKUP_CHUNK])).order_by(Waypoint.route_id, Waypoint.position):
+            waypoints.setdefault(row.route_id, []).append(row)
+    point_ids = {row.waypoint_id for rows in waypoints.values() for row in rows}
+    for route in routes.values():
+        point_ids.update((route.start_point_id, route.end_point_id))
+    point_ids = sorted(point_ids)
+    for i in range(0, len(point_ids), BULK_LOOKUP_CHUNK):
+        points.update((row.id, row) for row in db.session.query(
+            Point.id, Point.name, Point.address, Point.latitude, Point.longitude).filter(
+            Point.id.in_(point_ids[i:i + BULK_LOOKUP_CHUNK])))
+    return jsonify({
+        'routes': [route_to_dict(routes[route_id], points[routes[route_id].start_point_id], points[routes[route_id].end_point_id],
+                                 [(row.id, points[row.waypoint_id]) for row in waypoints.get(route_id, [])])
+                   for route_id in route_ids if route_id in routes],
+        'missing': [route_id for route_id in route_ids if route_id not in routes]}), 200
+
+#経由地の訪問順を最適化(始点・終点は固定)
+@app.route('/routes/<int:route_id>/plan',methods=['GET'])
+@login_required
+def plan_route(route_id):
+    route=load_route(route_id)
+    if route.user_id != current_user.id:
+        abort(404)
+    return jsonify(route_plan(route)),200
+
+#planは経路計画の関数(ジョブではプロセスプールで実行する)
+def route_plan(route, plan=planner.plan):
+    locations=[route.start_location]+[wp.way_location for wp in route.waypoints]+[route.end_location]
+    cached=distance_matrices.get(route.user_id,point_rows_loader(route.user_id),[point.id for point in locations])
+    if cached is not None:
+        matrix=cached[1].astype('float64')
+    else:
+        matrix=planner.distance_matrix([point.latitude for point in locations],[point.longitude for point in locations])
+    path=plan(matrix)
+    legs=planner.leg_distances(matrix,path)
+    return {
+        'route_id':route.id,
+        'order':[route.waypoints[index-1].id for index in path[1:-1]],
+        'legs':[{'from':locations[a].id,'to':locations[b].id,'distance':float(distance)}
+                for a,b,distance in zip(path[:-1],path[1:],legs)],
+        'total_distance':float(legs.sum()),
+        'original_distance':planner.path_length(matrix,list(range(len(locations))))
+    }
+
+#道路網での経路(flask build-road-graphでOSMのXMLからROAD_GRAPH_DIRに作っておく)
+ROAD_GRAPH_DIR = os.environ.get('ROAD_GRAPH_DIR', os.path.join(app.instance_path, 'road_graph'))
+ROAD_LEG_TTL = int(os.environ.get('ROAD_LEG_TTL', 86400))
+road_legs = MemoryCache(int(os.environ.get('ROAD_LEG_CACHE_SIZE', 10000)))
+road_graphs = {}
+#グラフを作り直したら(meta.jsonの更新時刻が変わったら)開き直す
+def current_road_graph():
+    try:
+        version = os.stat(os.path.join(ROAD_GRAPH_DIR, 'meta.json')).st_mtime_ns
+    except OSError:
+        return None, None
+    if version not in road_graphs:
+        road_graphs.clear()
+        road_graphs[version] = road_graph.RoadGraph(ROAD_GRAPH_DIR)
+    return version, road_graphs[version]
+
+#区間の結果は吸着した節点の組ごとにキャッシュする(同じ地点の組なら経路・ユーザーをまたいで再利用)
+def road_leg(graph, version, source, target):
+    key = (version, source, target)
+    leg = road_legs.get(key)
+    if leg is None:
+        leg = graph.shortest_path(source, target)
+        road_legs.set(key, leg, ROAD_LEG_TTL)
+    return leg
+
+@app.route('/routes/<int:route_id>/path',methods=['GET'])
+@login_required
+def route_path(route_id):
+    version, graph = current_road_graph()
+    if graph is None:
+        return jsonify({'message': '道路データがありません。'}), 503
+    route = load_route(route_id)
+    if route.user_id != current_user.id:
+        abort(404)
+    geometry = request.args.get('geometry', '1') != '0'
+    locations = [route.start_location] + [wp.way_location for wp in route.waypoints] + [route.end_location]
+    nodes = {point.id: graph.nearest(point.latitude, point.longitude) for point in locations}
+    legs = []
+    for a, b in zip(locations[:-1], locations[1:]):
+        leg = road_leg(graph, version, nodes[a.id], nodes[b.id])
+        data = {'from': a.id, 'to': b.id, 'distance': None, 'duration': None}
+        if leg is not None:
+            data['distance'], data['duration'] = leg[0], leg[1]
+            if geometry:
+                data['coordinates'] = graph.coordinates(leg[2])
+        legs.append(data)
+    reachable = all(leg['distance'] is not None for leg in legs)
+    return jsonify({
+        'route_id': route.id,
+        'distance': sum(leg['distance'] for leg in legs) if reachable else None,
+        'duration': sum(leg['duration'] for leg in legs) if reachable else None,
+        'legs': legs}), 200
+
+@app.cli.command('build-road-graph')
+@click.argument('osm_path')
+def build_road_graph(osm_path):
+    graph = road_graph.build(*road_graph.read_osm(osm_path))
+    road_graph.save(graph, ROAD_GRAPH_DIR)
+    click.echo('nodes: %d, edges: %d' % (graph['meta']['nodes'], graph['meta']['edges']))
+
+#経路のエクスポート(format=geojson|gpx|msgpack)
+def export_format():
+    format = request.args.get('format', 'geojson')
+    if format not in export.MIMETYPES:
+        abort(400)
+    if format == 'msgpack' and export.msgpack is None:
+        abort(406)
+    return format
+
+#favoritedはログイン中のユーザーがお気に入りしているかどうか
+def route_record(route, user_id):
+    locations = [route.start_location] + [wp.way_location for wp in route.waypoints] + [route.end_location]
+    favorited = RouteFavorite.query.filter_by(user_id=user_id, route_id=route.id).first() is not None
+    return {'id': route.id,
+            'user_id': route.user_id,
+            'favorited': favorited,
+            'points': [(point.id, point.name, point.latitude, point.longitude) for point in locations]}
+
+#ユーザーの全経路を1クエリでサーバーサイドカーソルから読み、経路ごとにまとめて返す
+def stream_route_records(user_id):
+    start, end, location = aliased(Point), aliased(Point), aliased(Point)
+    rows = db.session.query(
+        Route.id, Route.user_id, RouteFavorite.route_id,
+        start.id, start.name, start.latitude, start.longitude,
+        end.id, end.name, end.latitude, end.longitude,
+        location.id, location.name, location.latitude, location.longitude
+    ).join(start, Route.start_point_id == start.id).join(end, Route.end_point_id == end.id).outerjoin(
+        RouteFavorite, db.and_(RouteFavorite.route_id == Route.id, RouteFavorite.user_id == user_id)).outerjoin(
+        Waypoint, Waypoint.route_id == Route.id).outerjoin(location, Waypoint.waypoint_id == location.id).filter(
+        Route.user_id == user_id).order_by(Route.id, Waypoint.position).execution_options(
+        stream_results=True).yield_per(STREAM_BATCH_SIZE)
+    for route_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        first = group[0]
+        waypoints = [tuple(row[11:15]) for row in group if row[11] is not None]
+        yield {'id': route_id,
+               'user_id': first[1],
+               'favorited': first[2] is not None,
+               'points': [tuple(first[3:7])] + waypoints + [tuple(first[7:11])]}
+
+@app.route('/routes/<int:route_id>/export',methods=['GET'])
+@login_required
+def export_route(route_id):
+    format = export_format()
+    route = load_route(route_id)
+    if route.user_id != current_user.id:
+        abort(404)
+    return Response(export.export_route(route_record(route, current_user.id), format, app.json.dumps),
+                    mimetype=export.MIMETYPES[format]), 200
+
+@app.route('/routes/export',methods=['GET'])
+@login_required
+def export_routes():
+    format = export_format()
+    records = stream_route_records(current_user.id)
+    return Response(stream_with_context(export.export_routes(records, format, app.json.dumps)),
+                    mimetype=export.MIMETYPES[format])
+
+def user_point_or_400(user_id, point_id):
+    point = Point.query.filter_by(id=point_id, user_id=user_id).first()
+    if point is None:
+        abort(400)
+    return point
 
 @app.route('/routes/<int:route_id>', methods=['PUT'])
 @login_required
 def update_route(route_id):
     route = Route.query.get_or_404(route_id)
     data = request.get_json()
-    route.start_point = data.get('start_point', route.start_point)
-    route.end_point = data.get('end_point', route.end_point)
+    route.start_location = user_point_or_400(route.user_id, data.get('start_point_id', route.start_point_id))
+    route.end_location = user_point_or_400(route.user_id, data.get('end_point_id', route.end_point_id))
+    route.version = Route.version + 1
+    log_changes(route.user_id, 'route', 'upsert', [route.id])
     db.session.commit()
+    invalidate('route:%d' % route.id, *route_list_namespaces([route.id]))
     return jsonify({'id':route.id,
                     'user_id':route.user_id,
-                    'start_point':route.start_point,
-                    'end_point':route.end_point
+                    'start_point':route.start_location.name,
+                    'end_point':route.end_location.name,
+                    'start_point_id':route.start_point_id,
+                    'end_point_id':route.end_point_id,
+                    'version':route.version
                     }), 200
-    
+
+#経路の差分更新。JSON Patch風の操作の一覧を1トランザクションで適用する
+#  {"op": "add", "path": "/waypoints/2", "value": 地点id}       (2番目に挿入。"/waypoints/-"で末尾)
+#  {"op": "remove", "path": "/waypoints/2"}
+#  {"op": "replace", "path": "/waypoints/2", "value": 地点id}   ("/start_point_id"、"/end_point_id"も可)
+#  {"op": "move", "from": "/waypoints/2", "path": "/waypoints/0"}
+#If-Matchで経路のversionを指定し、他の更新と競合していれば412を返す
+WAYPOINT_PATH_PREFIX = '/waypoints/'
+def waypoint_index(path, length, append=False):
+    if not isinstance(path, str) or not path.startswith(WAYPOINT_PATH_PREFIX):
+        raise ValueError('invalid path: %r' % (path,))
+    index = path[len(WAYPOINT_PATH_PREFIX):]
+    if append and index == '-':
+        return length
+    if not index.isdigit() or int(index) >= length + (1 if append else 0):
+        raise ValueError('index out of range: %r' % (path,))
+    return int(index)
+
+#操作の形を確かめる(値は地点のid)。経路を読む前にまとめて行う
+PATCH_OPS = {'add', 'remove', 'replace', 'move'}
+PATCH_VALUE_OPS = {'add', 'replace'}
+def check_patch_operation(operation):
+    if not isinstance(operation, dict):
+        raise ValueError('operation must be an object')
+    op = operation.get('op')
+    if not isinstance(op, str) or op not in PATCH_OPS:
+        raise ValueError('unsupported op: %r' % (op,))
+    if not isinstance(operation.get('path'), str):
+        raise ValueError('path must be a string')
+    if op == 'move' and not isinstance(operation.get('from'), str):
+        raise ValueError('from must be a string')
+    if op in PATCH_VALUE_OPS and type(operation.get('value')) is not int:
+        raise ValueError('value must be a point id')
+
+def apply_route_patch(route, operations, points):
+    waypoints = route.waypoints
+    for operation in operations:
+        op, path = operation['op'], operation['path']
+        if op == 'replace' and path in ('/start_point_id', '/end_point_id'):
+            point = points(operation['value'])
+            if path == '/start_point_id':
+                route.start_point_id = point.id
+            else:
+                route.end_point_id = point.id
+        elif op == 'add':
+            waypoints.insert(waypoint_index(path, len(waypoints), append=True),
+                             Waypoint(waypoint_id=points(operation['value']).id))
+        elif op == 'remove':
+            waypoints.pop(waypoint_index(path, len(waypoints)))
+        elif op == 'replace':
+            waypoints[waypoint_index(path, len(waypoints))].waypoint_id = points(operation['value']).id
+        elif op == 'move':
+            waypoint = waypoints.pop(waypoint_index(operation['from'], len(waypoints)))
+            waypoints.insert(waypoint_index(path, len(waypoints), append=True), waypoint)
+        else:
+            raise ValueError('unsupported op: %r' % (op,))
+    #並び順が変わった経由地だけUPDATEされる
+    for position, waypoint in enumerate(waypoints):
+        waypoint.position = position
+
+@app.route('/routes/<int:route_id>', methods=['PATCH'])
+@login_required
+def patch_route(route_id):
+    operations = request.get_json(silent=True)
+    if not isinstance(operations, list):
+        abort(400)
+    try:
+        for operation in operations:
+            check_patch_operation(operation)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if not request.if_match:
+        return jsonify({'message': 'If-Matchで経路のETagを指定してください。'}), 428
+    route = load_route(route_id)
+    if route.user_id != current_user.id:
+        abort(404)
+    if not route_version_matches(request.if_match, route):
+        return jsonify({'message': '経路が他で更新されています。', 'version': route.version}), 412
+    #操作で使う地点はまとめて所有者を確認する
+    point_ids = {operation['value'] for operation in operations if operation['op'] in PATCH_VALUE_OPS}
+    points = {point.id: point for point in Point.query.filter(Point.id.in_(sorted(point_ids)), Point.user_id == route.user_id)}
+    def point_or_error(point_id):
+        if point_id not in points:
+            raise ValueError('unknown point: %r' % (point_id,))
+        return points[point_id]
+    try:
+        apply_route_patch(route, operations, point_or_error)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 400
+    #読み込んだ時のversionのままなら1増やす(0件なら他の更新が先にコミットした)
+    version = route.version
+    db.session.flush()
+    if not Route.query.filter_by(id=route.id, version=version).update({Route.version: version + 1}, synchronize_session=False):
+        db.session.rollback()
+        return jsonify({'message': '経路が他で更新されています。'}), 412
+    response = jsonify({'id': route.id,
+                        'start_point_id': route.start_point_id,
+                        'end_point_id': route.end_point_id,
+                        'waypoint': [{'id': waypoint.id, 'waypoint_id': waypoint.waypoint_id} for waypoint in route.waypoints],
+                        'version': version + 1})
+    response.headers['ETag'] = route_etag(route.id, version + 1)
+    namespaces = ['route:%d' % route.id] + route_list_namespaces([route.id])
+    log_changes(route.user_id, 'route', 'upsert', [route.id])
+    db.session.commit()
+    invalidate(*namespaces)
+    return response, 200
+
 @app.route('/waypoints/<int:waypoint_id>', methods=['PUT'])
 @login_required
 def update_waypoint(waypoint_id):
     waypoint = Waypoint.query.get_or_404(waypoint_id)
     data = request.get_json()
-    waypoint.location = data.get('location', waypoint.location)
-    
+    waypoint.way_location = user_point_or_400(waypoint.route.user_id, data.get('waypoint_id', waypoint.waypoint_id))
+    waypoint.route.version = Route.version + 1
+    log_changes(waypoint.route.user_id, 'route', 'upsert', [waypoint.route_id])
     db.session.commit()
-    return jsonify({'waypoint':waypoint}), 200
+    invalidate('route:%d' % waypoint.route_id)
+    return jsonify({'id': waypoint.id,
+                    'route_id': waypoint.route_id,
+                    'waypoint': waypoint.way_location.name,
+                    'waypoint_id': waypoint.waypoint_id}), 200
 
 @app.route('/routes/<int:route_id>', methods=['DELETE'])
 @login_required
 def delete_route(route_id):
     route = Route.query.get_or_404(route_id)
+    namespaces = ['route:%d' % route.id] + route_list_namespaces([route.id])
+    log_changes(route.user_id, 'route', 'delete', [route.id])
+    log_favorite_deletes([route.id])
+    RouteFavorite.query.filter_by(route_id=route.id).delete()
     db.session.delete(route)
     db.session.commit()
+    invalidate(*namespaces)
     return jsonify({'message': '削除に成功しました'}), 200
 
 @app.route('/waypoints/<int:waypoint_id>', methods=['DELETE'])
 @login_required
 def delete_waypoint(waypoint_id):
     waypoint = Waypoint.query.get_or_404(waypoint_id)
+    route_id = waypoint.route_id
+    waypoint.route.version = Route.version + 1
+    log_changes(waypoint.route.user_id, 'route', 'upsert', [route_id])
     db.session.delete(waypoint)
     db.session.commit()
+    invalidate('route:%d' % route_id)
     return jsonify({'message': '削除に成功しました'}), 200
-#お気に入り登録、解除
+#お気に入り登録、解除(ログイン中のユーザーとして)
 @app.route('/routes/<int:route_id>/favorite', methods=['POST'])
 @login_required
 def favorite_route(route_id):
     route = Route.query.get_or_404(route_id)
-    user_id = request.json.get('user_id')
-    if route.favorited:
+    user_id = current_user.id
+    db.session.add(RouteFavorite(user_id=user_id, route_id=route.id, created_at=datetime.datetime.utcnow()))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
         return jsonify({'message': '既にお気に入り登録しています。'}), 400
-    route.user_id = user_id
+    Route.query.filter_by(id=route.id).update({Route.favorite_count: Route.favorite_count + 1}, synchronize_session=False)
+    log_changes(user_id, 'favorite', 'upsert', [route.id])
     db.session.commit()
+    invalidate('favorites:%d' % user_id, 'popular')
     return jsonify({'message': 'Route favorited successfully'}), 200
 
 @app.route('/routes/<int:route_id>/unfavorite', methods=['POST'])
 @login_required
 def unfavorite_route(route_id):
     route = Route.query.get_or_404(route_id)
-    if not route.favorited:
+    user_id = current_user.id
+    if not RouteFavorite.query.filter_by(user_id=user_id, route_id=route.id).delete(synchronize_session=False):
+        db.session.rollback()
         return jsonify({'message': 'お気に入りに登録されていません。'}), 400
-    route.user_id = None
+    Route.query.filter_by(id=route.id).update({Route.favorite_count: Route.favorite_count - 1}, synchronize_session=False)
+    log_changes(user_id, 'favorite', 'delete', [route.id])
     db.session.commit()
+    invalidate('favorites:%d' % user_id, 'popular')
     return jsonify({'message': 'お気に入りを解除しました。'}), 200
 
+#ユーザーのお気に入り一覧(route_favoriteの主キー(user_id, route_id)順に読む)
 @app.route('/user/<int:user_id>/favorited_routes', methods=['GET'])
 @login_required
+@cached_response(lambda user_id: 'favorites:%d' % user_id)
 def get_favorited_routes(user_id):
-    favorited_routes = Route.query.filter_by(user_id=user_id, favorited=True).all()
-    data = [{
+    start, end = aliased(Point), aliased(Point)
+    query = db.session.query(Route.id, Route.user_id, start.name.label('start_point'), end.name.label('end_point'),
+                             Route.favorite_count).select_from(RouteFavorite).join(
+        Route, RouteFavorite.route_id == Route.id).join(start, Route.start_point_id == start.id).join(
+        end, Route.end_point_id == end.id).filter(RouteFavorite.user_id == user_id)
+    return list_response(query, RouteFavorite.route_id, favorited_route_to_dict)
+
+def favorited_route_to_dict(route):
+    return {
+        'id': route.id,
+        'user_id': route.user_id,
+        'start_point': route.start_point,
+        'end_point': route.end_point,
+        'favorited': True,
+        'favorite_count': route.favorite_count
+    }
+
+#お気に入り数の多い経路(favorite_countのインデックスを降順に読む)
+POPULAR_LIMIT = 10
+MAX_POPULAR_LIMIT = 100
+@app.route('/routes/popular', methods=['GET'])
+@login_required
+@cached_response(lambda: 'popular')
+def get_popular_routes():
+    limit = max(1, min(request.args.get('limit', POPULAR_LIMIT, type=int), MAX_POPULAR_LIMIT))
+    start, end = aliased(Point), aliased(Point)
+    routes = db.session.query(Route.id, Route.user_id, start.name.label('start_point'), end.name.label('end_point'),
+                              Route.favorite_count).join(start, Route.start_point_id == start.id).join(
+        end, Route.end_point_id == end.id).filter(Route.favorite_count > 0).order_by(
+        Route.favorite_count.desc(), Route.id.desc()).limit(limit).all()
+    return jsonify([{
         'id': route.id,
         'user_id': route.user_id,
         'start_point': route.start_point,
         'end_point': route.end_point,
-        'favorited': route.favorited
-    } for route in favorited_routes]
+        'favorite_count': route.favorite_count
+    } for route in routes]), 200
+#差分同期。sinceのカーソルより後の変更を、エンティティごとに最新の状態(削除はidのみ)で返す
+#sinceを付けなければ現在のカーソルだけを返すので、全件取得の前に呼んでおく
+SYNC_PAGE_SIZE = 1000
+MAX_SYNC_PAGE_SIZE = 10000
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 30))
+SYNC_ENTITIES = {'point': 'points', 'route': 'routes', 'favorite': 'favorites'}
+def sync_route_to_dict(route):
+    return {'id': route.id,
+            'user_id': route.user_id,
+            'start_point_id': route.start_point_id,
+            'end_point_id': route.end_point_id,
+            'waypoint_ids': [waypoint.waypoint_id for waypoint in route.waypoints],
+            'favorite_count': route.favorite_count,
+            'version': route.version}
+
+@app.route('/sync', methods=['GET'])
+@login_required
+def sync():
+    user_id = current_user.id
+    body = {'cursor': None, 'has_more': False, 'deleted': {}}
+    for key in SYNC_ENTITIES.values():
+        body[key] = []
+        body['deleted'][key] = []
+    since = request.args.get('since', type=int)
+    if since is None:
+        body['cursor'] = db.session.query(db.func.max(ChangeLog.id)).filter(ChangeLog.user_id == user_id).scalar() or 0
+        return jsonify(body), 200
+    floor = db.session.get(SyncFloor, user_id)
+    if floor is not None and since < floor.change_id:
+        return jsonify({'message': '変更履歴が圧縮されているため、全件を取得し直してください。'}), 410
+    limit = max(1, min(request.args.get('limit', SYNC_PAGE_SIZE, type=int), MAX_SYNC_PAGE_SIZE))
+    rows = db.session.query(ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op).filter(
+        ChangeLog.user_id == user_id, ChangeLog.id > since).order_by(ChangeLog.id).limit(limit + 1).all()
+    body['has_more'] = len(rows) > limit
+    rows = rows[:limit]
+    body['cursor'] = rows[-1].id if rows else since
+    latest = {}
+    for row in rows:
+        latest[(row.entity, row.entity_id)] = row.op
+    upserts = {entity: [entity_id for (kind, entity_id), op in latest.items() if kind == entity and op == 'upsert']
+               for entity in SYNC_ENTITIES}
+    if upserts['point']:
+        body['points'] = [record(point) for point in db.session.query(
+            Point.id, Point.name, Point.address, Point.latitude, Point.longitude, Point.user_id).filter(
+            Point.id.in_(upserts['point']), Point.user_id == user_id)]
+    if upserts['route']:
+        body['routes'] = [sync_route_to_dict(route) for route in Route.query.options(selectinload(Route.waypoints)).filter(
+            Route.id.in_(upserts['route']), Route.user_id == user_id)]
+    if upserts['favorite']:
+        start, end = aliased(Point), aliased(Point)
+        body['favorites'] = [favorited_route_to_dict(route) for route in db.session.query(
+            Route.id, Route.user_id, start.name.label('start_point'), end.name.label('end_point'),
+            Route.favorite_count).select_from(RouteFavorite).join(Route, RouteFavorite.route_id == Route.id).join(
+            start, Route.start_point_id == start.id).join(end, Route.end_point_id == end.id).filter(
+            RouteFavorite.user_id == user_id, RouteFavorite.route_id.in_(upserts['favorite']))]
+    #記録後に消えたものも削除として返す
+    for entity, key in SYNC_ENTITIES.items():
+        found = {item['id'] for item in body[key]}
+        body['deleted'][key] = sorted(entity_id for (kind, entity_id), op in latest.items()
+                                      if kind == entity and (op == 'delete' or entity_id not in found))
+    return jsonify(body), 200
+
+#変更履歴の圧縮。同じエンティティの古い履歴を消し、保持期間を過ぎた削除の履歴も消してSyncFloorを進める
+def compact_change_log(user_id=None, tombstone_days=SYNC_TOMBSTONE_DAYS):
+    scope = ChangeLog.user_id == user_id if user_id is not None else db.true()
+    latest = db.select(db.func.max(ChangeLog.id)).where(scope).group_by(
+        ChangeLog.user_id, ChangeLog.entity, ChangeLog.entity_id)
+    collapsed = ChangeLog.query.filter(scope, ChangeLog.id.notin_(latest)).delete(synchronize_session=False)
+    tombstones = db.and_(scope, ChangeLog.op == 'delete',
+                      ChangeLog.created_at < datetime.datetime.utcnow() - datetime.timedelta(days=tombstone_days))
+    for floor_user_id, change_id in db.session.query(ChangeLog.user_id, db.func.max(ChangeLog.id)).filter(
+            tombstones).group_by(ChangeLog.user_id):
+        floor = db.session.get(SyncFloor, floor_user_id)
+        if floor is None:
+            db.session.add(SyncFloor(user_id=floor_user_id, change_id=change_id))
+        else:
+            floor.change_id = max(floor.change_id, change_id)
+    expired = ChangeLog.query.filter(tombstones).delete(synchronize_session=False)
+    db.session.commit()
+    return {'collapsed': collapsed, 'expired': expired}
+
+@app.cli.command('compact-changes')
+def compact_changes():
+    click.echo(compact_change_log())
+
+#バックグラウンドジョブ
+def job_to_dict(job):
+    return {'id': job.id,
+            'type': job.kind,
+            'status': job.status,
+            'priority': job.priority,
+            'attempts': job.attempts,
+            'max_attempts': job.max_attempts,
+            'result': json.loads(job.result) if job.result else None,
+            'error': job.error,
+            'created_at': job.created_at.isoformat(),
+            'started_at': job.started_at.isoformat() if job.started_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None}
+
+@job_queue.handler('create_routes')
+def create_routes_job(payload, job):
+    if not isinstance(payload, list) or len(payload) > BULK_ROUTE_LIMIT:
+        raise JobError('payload must be a list of at most %d routes' % BULK_ROUTE_LIMIT)
+    return create_routes_from_items(job.user_id, payload)
+
+#対象はジョブを登録したユーザーのものに限る(他人のidなら見つからないものとして失敗させる)
+@job_queue.handler('delete_point')
+def delete_point_job(payload, job):
+    point = Point.query.filter_by(id=payload.get('point_id'), user_id=job.user_id).first()
+    if point is None:
+        raise JobError('point not found')
+    return {'point_id': point.id, 'routes_deleted': delete_point_and_routes(point)}
+
+@job_queue.handler('compact_changes')
+def compact_changes_job(payload, job):
+    return compact_change_log(job.user_id)
+
+@job_queue.handler('plan_route')
+def plan_route_job(payload, job):
+    route = Route.query.filter_by(id=payload.get('route_id'), user_id=job.user_id).first()
+    if route is None:
+        raise JobError('route not found')
+    return route_plan(load_route(route.id), lambda matrix: job_queue.run_cpu(planner.plan, matrix))
+
+MAX_JOB_PRIORITY = 100
+@app.route('/jobs', methods=['POST'])
+@login_required
+def create_job():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or data.get('type') not in job_queue.handlers:
+        return jsonify({'message': 'typeは%sのいずれかです。' % ', '.join(sorted(job_queue.handlers))}), 400
+    priority = data.get('priority', 0)
+    if not isinstance(priority, int) or abs(priority) > MAX_JOB_PRIORITY:
+        return jsonify({'message': 'priorityは-%dから%dの整数です。' % (MAX_JOB_PRIORITY, MAX_JOB_PRIORITY)}), 400
+    job = job_queue.enqueue(data['type'], data.get('payload', {}), current_user.id, priority=priority)
+    response = jsonify(job_to_dict(job))
+    response.headers['Location'] = '/jobs/%d' % job.id
+    return response, 202
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify(job_to_dict(job)), 200
+
+#ジョブだけを実行するプロセス(flask run-jobs)
+@app.cli.command('run-jobs')
+def run_jobs():
+    job_queue.run_forever()
 
-    return jsonify(data), 200
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
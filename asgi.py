@@ -0,0 +1,203 @@
+#ASGIで動かす場合のエントリーポイント(例: uvicorn asgi:application --workers 4)
+#よく呼ばれる読み取りAPIはSQLAlchemyの非同期エンジンで処理し、それ以外は同じFlaskアプリに渡す
+#レスポンスの形・キャッシュ(ETag/304を含む)はFlask側と共通にする
+import re
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import aliased, joinedload, selectinload
+from werkzeug.http import parse_etags, quote_etag, unquote_etag
+
+from app import (app, db, Point, Route, RouteFavorite, Waypoint, User, PAGE_SIZE, MAX_PAGE_SIZE, SQLITE_BUSY_TIMEOUT,
+                 USER_CACHE_TTL, admission_gate, client_identity, engine_options, favorited_route_to_dict,
+                 rate_limiter, response_cache, route_etag, route_to_dict, user_cache)
+from cache import make_etag
+from serializer import record
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+#Flaskと同じDB(instanceフォルダへの書き換え後のURL)を非同期ドライバで開く
+with app.app_context():
+    database_url = db.engine.url
+database_url = database_url.set(drivername=ASYNC_DRIVERS.get(database_url.get_backend_name(), database_url.drivername))
+engine = create_async_engine(database_url, **engine_options(str(database_url)))
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+if database_url.get_backend_name() == 'sqlite':
+    @event.listens_for(engine.sync_engine, 'connect')
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % SQLITE_BUSY_TIMEOUT)
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+wsgi_application = WsgiToAsgi(app)
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        self.status = status
+
+#Flaskのセッションクッキーを検証してユーザーidを取り出す(無い・不正ならNone)
+def session_user_id(scope):
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = SimpleCookie()
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    morsel = cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if serializer is None or morsel is None:
+        return None
+    try:
+        data = serializer.loads(morsel.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        return int(data['_user_id'])
+    except Exception:
+        return None
+
+#ログイン中のユーザーid。ユーザーが存在しなければ401
+async def current_user_id(scope, session):
+    user_id = session_user_id(scope)
+    if user_id is None:
+        raise HTTPError(401)
+    if user_cache.get(user_id) is None:
+        user = await session.get(User, user_id)
+        if user is None:
+            raise HTTPError(401)
+        user_cache.set(user_id, (user.id, user.username), USER_CACHE_TTL)
+    return user_id
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def query_args(scope):
+    args = {}
+    for pair in scope['query_string'].decode('latin-1').split('&'):
+        if '=' in pair:
+            name, value = pair.split('=', 1)
+            args[name] = value
+    return args
+
+def int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except ValueError:
+        return default
+
+#処理は(本文のバイト列, X-Next-After-Id, ETag)を返す。ETagがNoneなら本文のハッシュにする
+#Flask側のlist_responseと同じページング
+def page(rows, to_dict, limit):
+    return app.json.dumps_bytes([to_dict(row) for row in rows]), str(rows[-1].id) if len(rows) == limit else None, None
+
+async def get_point(scope, session, user_id):
+    args = query_args(scope)
+    limit = max(1, min(int_arg(args, 'limit', PAGE_SIZE), MAX_PAGE_SIZE))
+    result = await session.execute(
+        select(Point.id, Point.name, Point.address, Point.latitude, Point.longitude, Point.user_id).where(
+            Point.user_id == user_id, Point.id > int_arg(args, 'after_id', 0)).order_by(Point.id).limit(limit))
+    return page(result.all(), record, limit)
+
+async def get_route(scope, session, user_id, route_id):
+    route = (await session.execute(select(Route).options(
+        joinedload(Route.start_location),
+        joinedload(Route.end_location),
+        selectinload(Route.waypoints).joinedload(Waypoint.way_location)
+    ).where(Route.id == route_id))).scalars().first()
+    if route is None:
+        raise HTTPError(404)
+    data = app.json.dumps_bytes(route_to_dict(route, route.start_location, route.end_location,
+                                              [(wp.id, wp.way_location) for wp in route.waypoints]))
+    return data, None, route_etag(route.id, route.version, data)
+
+async def get_favorited_routes(scope, session, viewer_id, user_id):
+    args = query_args(scope)
+    limit = max(1, min(int_arg(args, 'limit', PAGE_SIZE), MAX_PAGE_SIZE))
+    start, end = aliased(Point), aliased(Point)
+    result = await session.execute(
+        select(Route.id, Route.user_id, start.name.label('start_point'), end.name.label('end_point'), Route.favorite_count)
+        .select_from(RouteFavorite).join(Route, RouteFavorite.route_id == Route.id)
+        .join(start, Route.start_point_id == start.id).join(end, Route.end_point_id == end.id)
+        .where(RouteFavorite.user_id == user_id, RouteFavorite.route_id > int_arg(args, 'after_id', 0))
+        .order_by(RouteFavorite.route_id).limit(limit))
+    return page(result.all(), favorited_route_to_dict, limit)
+
+#(メソッド, パス, 処理, キャッシュのnamespace)。namespaceはFlask側のcached_responseと同じ名前にし、
+#ログイン中のユーザーidとパスの数値を受け取る
+ASYNC_ROUTES = [
+    ('GET', re.compile(r'^/points$'), get_point, lambda user_id: 'points:%d' % user_id),
+    ('GET', re.compile(r'^/routes/(\d+)$'), get_route, lambda user_id, route_id: 'route:%d' % route_id),
+    ('GET', re.compile(r'^/user/(\d+)/favorited_routes$'), get_favorited_routes,
+     lambda viewer_id, user_id: 'favorites:%d' % user_id),
+]
+
+async def send_body(send, status, data, headers=(), mimetype='application/json'):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', mimetype.encode()), (b'content-length', str(len(data)).encode())]
+                           + list(headers)})
+    await send({'type': 'http.response.body', 'body': data})
+
+async def send_json(send, status, body, headers=()):
+    await send_body(send, status, app.json.dumps_bytes(body), headers)
+
+#Flask側のcached_responseと同じキー・同じエントリ(本文, mimetype, X-Next-After-Id, ETag)を読み書きするので、
+#どちらで作ったキャッシュも共有され、If-None-Matchが一致すれば304を返す
+async def cached_handler(scope, handler, namespace, path_args):
+    async with Session() as session:
+        user_id = await current_user_id(scope, session)
+        key = response_cache.key(namespace(user_id, *path_args), '%s?%s' % (scope['path'], scope['query_string'].decode()))
+        entry = response_cache.get(key)
+        if entry is None:
+            data, next_after_id, etag = await handler(scope, session, user_id, *path_args)
+            entry = (data, 'application/json', next_after_id, etag or quote_etag(make_etag(data)))
+            response_cache.set(key, entry)
+    return entry
+
+async def send_cached(scope, send, entry):
+    data, mimetype, next_after_id, etag = entry
+    headers = [(b'etag', etag.encode())]
+    if next_after_id:
+        headers.append((b'x-next-after-id', next_after_id.encode()))
+    if parse_etags(header(scope, b'if-none-match')).contains_weak(unquote_etag(etag)[0]):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        return await send({'type': 'http.response.body', 'body': b''})
+    await send_body(send, 200, data, headers, mimetype)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and b'format=' not in scope['query_string']:
+        for method, pattern, handler, namespace in ASYNC_ROUTES:
+            match = pattern.match(scope['path'])
+            if scope['method'] == method and match:
+                #Flask側(admit_request)と同じバケット・同じ枠を使う。イベントループを止めないよう枠は待たない
+                client = scope.get('client') or ('',)
+                retry_after = rate_limiter.check(client_identity(session_user_id(scope), client[0]), 'read')
+                if retry_after:
+                    return await send_json(send, 429, {'message': HTTPStatus(429).phrase},
+                                           [(b'retry-after', str(retry_after).encode())])
+                if not admission_gate.acquire(timeout=0):
+                    return await send_json(send, 503, {'message': HTTPStatus(503).phrase}, [(b'retry-after', b'1')])
+                try:
+                    entry = await cached_handler(scope, handler, namespace, [int(group) for group in match.groups()])
+                except HTTPError as e:
+                    return await send_json(send, e.status, {'message': HTTPStatus(e.status).phrase})
+                finally:
+                    admission_gate.release()
+                return await send_cached(scope, send, entry)
+    return await wsgi_application(scope, receive, send)
@@ -0,0 +1,1221 @@
+#ベンチマーク。合成データを投入して全エンドポイントを叩き、p50/p95/p99・スループット・SQL回数・ピークRSSを
+#ベースライン(JSON)と比べて、閾値を超えて遅くなっていれば終了コード1で失敗する
+#  python benchmark.py                        Flaskのテストクライアントで計測
+#  python benchmark.py --server               gunicornのマルチワーカーを起動してHTTPで計測
+#  python benchmark.py --update-baseline      今回の結果をベースラインとして保存
+import argparse
+import datetime
+import http.client
+import itertools
+import json
+import os
+import random
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD = 'benchmark-password'
+SERVER_COMMAND = '{python} -m gunicorn --workers {workers} --bind {host}:{port} app:app'
+ASGI_COMMAND = '{python} -m uvicorn --workers {workers} --host {host} --port {port} --log-level warning asgi:application'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='全エンドポイントのベンチマーク')
+    parser.add_argument('--users', type=int, default=3, help='投入するユーザー数')
+    parser.add_argument('--routes', type=int, default=200, help='ユーザーあたりの経路数')
+    parser.add_argument('--waypoints', type=int, default=5, help='経路あたりの経由地数')
+    parser.add_argument('--favorites', type=int, default=0, help='DBに直接投入するお気に入りの件数(数百万件での計測用)')
+    parser.add_argument('--iterations', type=int, default=50, help='エンドポイントごとのリクエスト数')
+    parser.add_argument('--jobs', type=int, default=40, help='混合負荷で投入するジョブ数')
+    parser.add_argument('--sync-points', type=int, default=50000, help='差分同期を計測するユーザーの地点数')
+    parser.add_argument('--sync-changes', type=int, default=10, help='差分同期の前に行う変更の数')
+    parser.add_argument('--serialize-points', type=int, default=10000, help='一覧のシリアライズを計測するユーザーの地点数')
+    parser.add_argument('--search-points', type=int, default=1000000, help='地点検索を計測するユーザーの地点数')
+    parser.add_argument('--spatial-points', default='10000,100000,1000000', help='範囲検索を全件走査と比べる地点数(カンマ区切り、空で計測しない)')
+    parser.add_argument('--list-rows', type=int, default=100000, help='一覧のメモリ・最初のバイトまでの時間を計測するユーザーの地点数(0で計測しない)')
+    parser.add_argument('--writer-threads', default='1,4,16', help='同時に書き込むクライアント数(カンマ区切り)')
+    parser.add_argument('--writer-requests', type=int, default=200, help='同時書き込みで送るリクエスト数(0で計測しない)')
+    parser.add_argument('--plan-waypoints', default='10,50,100,500', help='経路計画を計測する経由地数(カンマ区切り、空で計測しない)')
+    parser.add_argument('--matrix-points', type=int, default=5000, help='距離行列を計測するユーザーの地点数(0で計測しない)')
+    parser.add_argument('--metrics-requests', type=int, default=1000, help='計測(メトリクス)のオーバーヘッドを測るリクエスト数(0で計測しない)')
+    parser.add_argument('--geocode-addresses', type=int, default=2000, help='住所だけの地点で一括登録する住所の数(0で計測しない)')
+    parser.add_argument('--geocoder-latency', type=float, default=0.05, help='テスト用ジオコーダーの1バッチあたりの遅延(秒)')
+    parser.add_argument('--hash-methods', default='pbkdf2:sha256:1000,pbkdf2:sha256:260000,pbkdf2:sha256:600000,scrypt',
+                        help='ハッシュ化・照合の時間を比べるパスワードのハッシュ方式(カンマ区切り、空で計測しない)')
+    parser.add_argument('--auth-requests', type=int, default=1000, help='ユーザーキャッシュの有無で比べる認証付きリクエストの数(0で計測しない)')
+    parser.add_argument('--dedup-routes', type=int, default=500, help='同じ場所を使い回す経路の数(0で計測しない)')
+    parser.add_argument('--dedup-places', type=int, default=200, help='--dedup-routesの経路が使う場所の数')
+    parser.add_argument('--export-routes', type=int, default=100000, help='一括エクスポートを計測する経路数(0で計測しない)')
+    parser.add_argument('--bulk-routes', type=int, default=500, help='一括登録と1件ずつの登録を比べる経路数(0で計測しない)')
+    parser.add_argument('--asgi-levels', default='', help='ASGIとWSGIのサーバーを比べる同時接続数(カンマ区切り、例: 1,10,100,1000。空で計測しない)')
+    parser.add_argument('--asgi-command', default=ASGI_COMMAND, help='比較に使うASGIサーバーの起動コマンド(WSGIは--server-command)')
+    parser.add_argument('--admission-seconds', type=float, default=5, help='過負荷の保護を計測する各場面の秒数(0で計測しない)')
+    parser.add_argument('--road-grid', type=int, default=300, help='合成する道路網の一辺の交差点数(0で道路網なし)')
+    parser.add_argument('--seed', type=int, default=21, help='乱数のシード')
+    parser.add_argument('--server', action='store_true', help='実サーバーを起動してHTTPで計測する')
+    parser.add_argument('--server-command', default=SERVER_COMMAND, help='サーバーの起動コマンド')
+    parser.add_argument('--workers', type=int, default=4, help='サーバーのワーカー数')
+    parser.add_argument('--concurrency', type=int, default=8, help='HTTPで計測するときの同時リクエスト数')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='ベースラインのJSON')
+    parser.add_argument('--output', help='今回の結果を書き出すJSON')
+    parser.add_argument('--update-baseline', action='store_true', help='今回の結果でベースラインを上書きする')
+    parser.add_argument('--threshold', type=float, default=0.2, help='許容する悪化の割合')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='これより小さいレイテンシの差は無視する')
+    return parser.parse_args()
+
+#ベンチマーク用のDB・キャッシュ等は一時ディレクトリに作り、appをimportする前に環境変数で指定する
+def prepare_environment(directory, args):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    os.environ['DISTANCE_MATRIX_DIR'] = os.path.join(directory, 'distance_matrix')
+    os.environ['ROAD_GRAPH_DIR'] = os.path.join(directory, 'road_graph')
+    #距離行列の計測中に追加する地点も上限に収める
+    os.environ.setdefault('DISTANCE_MATRIX_MAX_POINTS', str(max(5000, args.matrix_points + args.iterations)))
+    if args.road_grid:
+        build_road_grid(os.environ['ROAD_GRAPH_DIR'], args.road_grid, args.seed)
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('GEOCODER', 'fake')
+    os.environ.setdefault('PROFILE_SAMPLE_RATE', '0')
+    os.environ.setdefault('PROFILE_SLOW_SECONDS', '0')
+    os.environ.setdefault('METRICS_TOKEN', 'benchmark')
+    os.environ.setdefault('GEOCODER_LATENCY', str(args.geocoder_latency))
+    #1ユーザーから大量に送るので、レート制限・同時実行数の制限は外しておく(過負荷の保護は別に計測する)
+    os.environ.setdefault('RATE_LIMIT_READ_RATE', '0')
+    os.environ.setdefault('RATE_LIMIT_WRITE_RATE', '0')
+    os.environ.setdefault('MAX_CONCURRENT_REQUESTS', '0')
+    import app
+    with app.app.app_context():
+        app.db.create_all()
+    return app
+
+#合成地点と同じ範囲に格子状の道路網を作る。交差点を少しずらし、一部の道を抜いて幹線道路を混ぜる
+def build_road_grid(directory, size, seed):
+    import numpy as np
+    import road_graph
+    rng = np.random.default_rng(seed)
+    rows, columns = np.divmod(np.arange(size * size), size)
+    latitude = 35.5 + (rows + rng.uniform(-0.3, 0.3, size * size)) * 0.3 / (size - 1)
+    longitude = 139.5 + (columns + rng.uniform(-0.3, 0.3, size * size)) * 0.4 / (size - 1)
+    node = np.arange(size * size).reshape(size, size)
+    sources = np.concatenate([node[:, :-1].ravel(), node[:-1, :].ravel()])
+    targets = np.concatenate([node[:, 1:].ravel(), node[1:, :].ravel()])
+    keep = rng.random(len(sources)) > 0.1
+    sources, targets = sources[keep], targets[keep]
+    rows = np.minimum(sources, targets) // size
+    speeds = np.where(rows % 10 == 0, 60.0, 30.0)
+    started = time.perf_counter()
+    graph = road_graph.build(latitude, longitude, np.concatenate([sources, targets]),
+                             np.concatenate([targets, sources]), np.concatenate([speeds, speeds]))
+    road_graph.save(graph, directory)
+    print('road graph: %d nodes, %d edges (%.1fs)' % (graph['meta']['nodes'], graph['meta']['edges'],
+                                                      time.perf_counter() - started))
+
+class Response:
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+    def lines(self):
+        return [json.loads(line) for line in self.body.splitlines() if line.strip()]
+
+#Flaskのテストクライアント(1プロセス・直列)。SQLの回数はエンジンのイベントで数える(ジョブのスレッドの分は除く)
+class TestClientDriver:
+    name = 'test_client'
+
+    def __init__(self, app_module, count_queries=True):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        self.app_module = app_module
+        self.client = app_module.app.test_client()
+        self.count_queries = count_queries
+        self.sql_queries = 0
+        self.thread = threading.get_ident()
+        if count_queries:
+            event.listen(Engine, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, *args):
+        if threading.get_ident() == self.thread:
+            self.sql_queries += 1
+
+    def request(self, method, path, body=None, headers=None):
+        before = self.sql_queries
+        started = time.perf_counter()
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        data = response.get_data()
+        elapsed = time.perf_counter() - started
+        return Response(response.status_code, data), elapsed, self.sql_queries - before if self.count_queries else None
+
+    #同じアプリに別のクッキーで接続する(別スレッドから使う。SQLの回数は数えない)
+    def session(self):
+        return TestClientDriver(self.app_module, count_queries=False)
+
+    def run(self, requests, concurrency):
+        return [self.request(*request) for request in requests]
+
+    #レスポンスを読み捨てながら(溜めずに)、最初のチャンクまでの秒数・全体の秒数・バイト数を測る
+    def stream(self, path):
+        started = time.perf_counter()
+        response = self.client.get(path, buffered=False)
+        first_byte = None
+        size = 0
+        for chunk in response.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+        response.close()
+        elapsed = time.perf_counter() - started
+        return response.status_code, elapsed if first_byte is None else first_byte, elapsed, size
+
+    def peak_rss_kb(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+STREAM_READ_SIZE = 65536
+
+#起動したサーバーにHTTPで並行してリクエストする。SQLの回数はワーカーごとに分かれるので計測しない
+class HTTPDriver:
+    name = 'server'
+
+    def __init__(self, host, port, process):
+        self.host = host
+        self.port = port
+        self.process = process
+        self.cookie = None
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        return self.local.connection
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        started = time.perf_counter()
+        try:
+            connection = self.connection()
+            connection.request(method, path, data, headers)
+            response = connection.getresponse()
+            payload = response.read()
+        except (http.client.HTTPException, OSError):
+            self.local.connection = None
+            connection = self.connection()
+            connection.request(method, path, data, headers)
+            response = connection.getresponse()
+            payload = response.read()
+        elapsed = time.perf_counter() - started
+        cookie = response.getheader('Set-Cookie')
+        if cookie and path == '/login':
+            self.cookie = cookie.split(';', 1)[0]
+        return Response(response.status, payload), elapsed, None
+
+    def run(self, requests, concurrency):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(lambda request: self.request(*request), requests))
+
+    def session(self):
+        return HTTPDriver(self.host, self.port, self.process)
+
+    def stream(self, path):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            started = time.perf_counter()
+            connection.request('GET', path, headers={'Cookie': self.cookie} if self.cookie else {})
+            response = connection.getresponse()
+            first_byte = None
+            size = 0
+            while chunk := response.read1(STREAM_READ_SIZE):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                size += len(chunk)
+            elapsed = time.perf_counter() - started
+            return response.status, elapsed if first_byte is None else first_byte, elapsed, size
+        finally:
+            connection.close()
+
+    #マスターと全ワーカーのピークRSS(VmHWM)の合計。/procが無い環境ではNone
+    def peak_rss_kb(self):
+        total = 0
+        for pid in [self.process.pid] + child_pids(self.process.pid):
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            total += int(line.split()[1])
+            except OSError:
+                pass
+        return total or None
+
+def child_pids(pid):
+    pids = []
+    try:
+        for task in os.listdir('/proc/%d/task' % pid):
+            with open('/proc/%d/task/%s/children' % (pid, task)) as f:
+                pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        return pids
+    return pids + [grandchild for child in pids for grandchild in child_pids(child)]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(command, workers, env=None, output=None):
+    host, port = '127.0.0.1', free_port()
+    command = command.format(python=shlex.quote(sys.executable), workers=workers, host=host, port=port)
+    process = subprocess.Popen(shlex.split(command), env=dict(os.environ, **(env or {})), stdout=output, stderr=output,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('サーバーが起動できませんでした: %s' % command)
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return HTTPDriver(host, port, process)
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('サーバーの起動がタイムアウトしました: %s' % command)
+
+def metrics_headers():
+    return {'Authorization': 'Bearer ' + os.environ['METRICS_TOKEN']}
+
+#/metricsのゲージ(ラベルの無い行)を読む
+def metrics_gauges(driver):
+    body = expect(driver.request('GET', '/metrics', None, metrics_headers())[0], 200).body.decode('utf-8')
+    return {name: float(value) for name, value in
+            (line.split(' ', 1) for line in body.splitlines() if line and not line.startswith('#') and '{' not in line)}
+
+def expect(response, *statuses):
+    if response.status not in statuses:
+        raise SystemExit('データ投入に失敗しました: %d %r' % (response.status, response.body[:200]))
+    return response
+
+def synthetic_point(rng, index):
+    return {'name': 'p%d' % index,
+            'address': 'bench address %d' % index,
+            'latitude': round(rng.uniform(35.5, 35.8), 6),
+            'longitude': round(rng.uniform(139.5, 139.9), 6)}
+
+def synthetic_route(rng, counter, waypoints):
+    return {'start_point': synthetic_point(rng, next(counter)),
+            'end_point': synthetic_point(rng, next(counter)),
+            'waypoint': [synthetic_point(rng, next(counter)) for _ in range(waypoints)]}
+
+#ユーザー・地点・経路・経由地をAPI経由で投入する。計測は最初のユーザーで行う
+def seed(driver, args, rng):
+    counter = itertools.count()
+    data = {'users': []}
+    for index in range(args.users):
+        username = 'bench-%d-%d' % (args.seed, index)
+        user = expect(driver.request('POST', '/users', {'username': username, 'password': PASSWORD})[0], 201).json()
+        expect(driver.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+        routes = [synthetic_route(rng, counter, args.waypoints) for _ in range(args.routes)]
+        for i in range(0, len(routes), 1000):
+            created = expect(driver.request('POST', '/routes/bulk', routes[i:i + 1000])[0], 201).json()['created']
+            if index == 0:
+                data.setdefault('route_ids', []).extend(item['route_id'] for item in created)
+        data['users'].append((user['id'], username))
+    user_id, username = data['users'][0]
+    expect(driver.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+    data['user_id'] = user_id
+    data['point_ids'] = [point['id'] for point in
+                         expect(driver.request('GET', '/points?format=ndjson')[0], 200).lines()]
+    #削除系で使う経路(経由地つき)を別に用意する
+    disposable = [synthetic_route(rng, counter, 2) for _ in range(args.iterations)]
+    created = expect(driver.request('POST', '/routes/bulk', disposable)[0], 201).json()['created']
+    data['disposable_route_ids'] = [item['route_id'] for item in created]
+    data['disposable_waypoint_ids'] = [
+        expect(driver.request('GET', '/routes/%d' % route_id)[0], 200).json()['waypoint'][0]['id']
+        for route_id in data['disposable_route_ids']]
+    data['waypoint_ids'] = [waypoint['id'] for route_id in data['route_ids'][:args.iterations]
+                            for waypoint in expect(driver.request('GET', '/routes/%d' % route_id)[0], 200).json()['waypoint']]
+    data['created_point_ids'] = []
+    data['job_ids'] = []
+    return data
+
+#お気に入りは件数が多いのでDBに直接入れる。お気に入り専用のユーザーを作り、人気に偏りを付けて経路を選ぶ
+FAVORITES_PER_USER = 100
+FAVORITE_INSERT_CHUNK = 50000
+def seed_favorites(app_module, count, rng):
+    db, Route, RouteFavorite, User = app_module.db, app_module.Route, app_module.RouteFavorite, app_module.User
+    with app_module.app.app_context():
+        route_ids = [row.id for row in db.session.query(Route.id).order_by(Route.id)]
+        per_user = min(FAVORITES_PER_USER, len(route_ids))
+        if not count or not per_user:
+            return
+        weights = [1.0 / (rank + 1) for rank in range(len(route_ids))]
+        users = [{'username': 'bench-fan-%d' % index} for index in range((count + per_user - 1) // per_user)]
+        db.session.execute(User.__table__.insert(), users)
+        fan_ids = [row.id for row in db.session.query(User.id).filter(User.username.like('bench-fan-%'))]
+        now = datetime.datetime.utcnow()
+        rows = []
+        remaining = count
+        for user_id in fan_ids:
+            chosen = set()
+            while len(chosen) < min(per_user, remaining):
+                chosen.update(rng.choices(route_ids, weights, k=per_user - len(chosen)))
+            rows.extend({'user_id': user_id, 'route_id': route_id, 'created_at': now}
+                        for route_id in list(chosen)[:remaining])
+            remaining -= len(chosen)
+            if len(rows) >= FAVORITE_INSERT_CHUNK:
+                db.session.execute(RouteFavorite.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(RouteFavorite.__table__.insert(), rows)
+        db.session.execute(Route.__table__.update().values(favorite_count=db.select(db.func.count()).where(
+            RouteFavorite.route_id == Route.id).scalar_subquery()))
+        db.session.commit()
+
+#計測するケース: (名前, i番目のリクエストを返す関数)。登録→更新→削除の順に並べる
+def cases(data, args, rng):
+    route_ids = data['route_ids']
+    point_ids = data['point_ids']
+    waypoint_ids = data['waypoint_ids'] or [0]
+    user_id = data['user_id']
+    counter = iter(range(10 ** 9, 2 * 10 ** 9))
+
+    def pick(ids, i):
+        return ids[i % len(ids)]
+
+    def bbox(i):
+        lat, lng = rng.uniform(35.5, 35.75), rng.uniform(139.5, 139.85)
+        return ('GET', '/points/bbox?min_lat=%f&min_lng=%f&max_lat=%f&max_lng=%f' % (lat, lng, lat + 0.05, lng + 0.05))
+
+    return [
+        ('POST /users', lambda i: ('POST', '/users', {'username': 'bench-new-%d-%d' % (args.seed, i), 'password': PASSWORD})),
+        ('POST /login', lambda i: ('POST', '/login', {'username': data['users'][0][1], 'password': PASSWORD})),
+        ('GET /users/<id>', lambda i: ('GET', '/users/%d' % user_id)),
+        ('PUT /users/<id>', lambda i: ('PUT', '/users/%d' % pick(data['users'], i + 1)[0],
+                                       {'username': 'bench-renamed-%d-%d' % (args.seed, i)})),
+        ('POST /points', lambda i: ('POST', '/points', synthetic_point(rng, next(counter)))),
+        ('GET /points', lambda i: ('GET', '/points')),
+        ('GET /points?format=ndjson', lambda i: ('GET', '/points?format=ndjson')),
+        ('GET /points/bbox', bbox),
+        ('GET /points/search', lambda i: ('GET', '/points/search?q=%s' % urllib.parse.quote(('bench', 'address 1', 'p1')[i % 3]))),
+        ('GET /points/nearby', lambda i: ('GET', '/points/nearby?lat=%f&lng=%f&radius=2000'
+                                          % (rng.uniform(35.5, 35.8), rng.uniform(139.5, 139.9)))),
+        ('GET /points/distance-matrix', lambda i: ('GET', '/points/distance-matrix?ids=%s'
+                                                   % ','.join(str(point_id) for point_id in rng.sample(point_ids, min(20, len(point_ids)))))),
+        ('PUT /points/<id>', lambda i: ('PUT', '/points/%d' % pick(point_ids, i), {'name': 'renamed %d' % i})),
+        ('POST /routes', lambda i: ('POST', '/routes', synthetic_route(rng, counter, args.waypoints))),
+        ('POST /routes/bulk', lambda i: ('POST', '/routes/bulk', [synthetic_route(rng, counter, args.waypoints) for _ in range(20)])),
+        ('GET /routes/<id>', lambda i: ('GET', '/routes/%d' % pick(route_ids, i))),
+        ('POST /routes/batch-get', lambda i: ('POST', '/routes/batch-get', rng.sample(route_ids, min(50, len(route_ids))))),
+        ('GET /routes/<id>/path', lambda i: ('GET', '/routes/%d/path?geometry=%d' % (pick(route_ids, i), i % 2))),
+        ('GET /routes/<id>/plan', lambda i: ('GET', '/routes/%d/plan' % pick(route_ids, i))),
+        ('GET /routes/<id>/export', lambda i: ('GET', '/routes/%d/export?format=%s' % (pick(route_ids, i), ('geojson', 'gpx')[i % 2]))),
+        ('GET /routes/export', lambda i: ('GET', '/routes/export?format=geojson')),
+        ('PATCH /routes/<id>', lambda i: ('PATCH', '/routes/%d' % pick(route_ids, i), [
+            {'op': 'move', 'from': '/waypoints/0', 'path': '/waypoints/-'},
+            {'op': 'add', 'path': '/waypoints/1', 'value': pick(point_ids, i)},
+            {'op': 'remove', 'path': '/waypoints/1'}], {'If-Match': '*'})),
+        ('PUT /routes/<id>', lambda i: ('PUT', '/routes/%d' % pick(route_ids, i), {'start_point_id': pick(point_ids, i)})),
+        ('PUT /waypoints/<id>', lambda i: ('PUT', '/waypoints/%d' % pick(waypoint_ids, i), {'waypoint_id': pick(point_ids, i + 1)})),
+        ('POST /routes/<id>/favorite', lambda i: ('POST', '/routes/%d/favorite' % pick(route_ids, i))),
+        ('POST /routes/<id>/unfavorite', lambda i: ('POST', '/routes/%d/unfavorite' % pick(route_ids, i))),
+        ('GET /user/<id>/favorited_routes', lambda i: ('GET', '/user/%d/favorited_routes' % user_id)),
+        ('GET /routes/popular', lambda i: ('GET', '/routes/popular?limit=%d' % (10 + i % 3 * 20))),
+        ('DELETE /waypoints/<id>', lambda i: ('DELETE', '/waypoints/%d' % pick(data['disposable_waypoint_ids'], i))),
+        ('DELETE /routes/<id>', lambda i: ('DELETE', '/routes/%d' % pick(data['disposable_route_ids'], i))),
+        ('DELETE /points/<id>', lambda i: ('DELETE', '/points/%d' % pick(data['created_point_ids'] or [0], i))),
+        ('POST /jobs', lambda i: ('POST', '/jobs', {'type': 'plan_route', 'payload': {'route_id': pick(route_ids, i)},
+                                                    'priority': i % 3})),
+        ('GET /jobs/<id>', lambda i: ('GET', '/jobs/%d' % pick(data['job_ids'] or [0], i))),
+        ('GET /cache/stats', lambda i: ('GET', '/cache/stats')),
+        ('GET /metrics', lambda i: ('GET', '/metrics', None, metrics_headers())),
+    ]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+def summarize(results, wall_seconds):
+    latencies = [elapsed * 1000 for _, elapsed, _ in results]
+    queries = [count for _, _, count in results if count is not None]
+    statuses = {}
+    for response, _, _ in results:
+        statuses[str(response.status)] = statuses.get(str(response.status), 0) + 1
+    return {'requests': len(results),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'throughput_rps': round(len(results) / wall_seconds, 2) if wall_seconds else None,
+            'sql_queries': round(sum(queries) / len(queries), 2) if queries else None,
+            'response_bytes': sum(len(response.body) for response, _, _ in results) // len(results),
+            'statuses': statuses}
+
+def run_benchmark(driver, app_module, args):
+    rng = random.Random(args.seed)
+    data = seed(driver, args, rng)
+    seed_favorites(app_module, args.favorites, rng)
+    report = {}
+    for name, make_request in cases(data, args, rng):
+        requests = [make_request(i) for i in range(args.iterations)]
+        started = time.perf_counter()
+        results = driver.run(requests, args.concurrency)
+        report[name] = summarize(results, time.perf_counter() - started)
+        if name == 'POST /points':
+            data['created_point_ids'] = [response.json()['id'] for response, _, _ in results if response.status == 201]
+        if name == 'POST /jobs':
+            data['job_ids'] = [response.json()['id'] for response, _, _ in results if response.status == 202]
+    report.update(run_batch_load(driver, data, args, rng))
+    report.update(run_job_load(driver, data, args, rng))
+    report.update(run_sync_load(driver, app_module, args, rng))
+    report.update(run_search_load(driver, app_module, args, rng))
+    serialize_report, serializer = run_serialize_load(driver, app_module, args, rng)
+    report.update(serialize_report)
+    measurements = {}
+    run_spatial_load(app_module, args, rng, measurements)
+    report.update(run_bulk_load(driver, args, rng, measurements))
+    run_list_load(driver, app_module, args, rng, measurements)
+    report.update(run_write_load(driver, args, rng, measurements))
+    report.update(run_plan_load(driver, args, rng))
+    report.update(run_matrix_load(driver, app_module, args, rng, measurements))
+    run_metrics_overhead(driver, app_module, data, args, rng, measurements)
+    report.update(run_geocode_load(driver, args, rng, measurements))
+    report.update(run_auth_load(driver, app_module, data, args, rng, measurements))
+    run_hash_cost(app_module, args, measurements)
+    report.update(run_dedup_load(driver, app_module, args, rng, measurements))
+    run_export_load(driver, app_module, args, rng, measurements)
+    report.update(run_admission_load(data, args, rng))
+    report.update(run_asgi_load(args, rng))
+    return report, serializer, measurements
+
+def register(driver, username):
+    user_id = expect(driver.request('POST', '/users', {'username': username, 'password': PASSWORD})[0], 201).json()['id']
+    expect(driver.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+    return user_id
+
+#一括登録: 同じ数の経路を、POST /routes/bulkの1回とPOST /routesの1件ずつで(別のユーザーに)登録し、経路/秒を比べる
+def run_bulk_load(driver, args, rng, measurements):
+    if not args.bulk_routes:
+        return {}
+    counter = iter(range(3 * 10 ** 9, 4 * 10 ** 9))
+    report = {}
+    routes_per_second = {}
+    for label in ('bulk', 'single'):
+        register(driver, 'bench-bulk-%d-%s' % (args.seed, label))
+        routes = [synthetic_route(rng, counter, args.waypoints) for _ in range(args.bulk_routes)]
+        started = time.perf_counter()
+        if label == 'bulk':
+            results = [driver.request('POST', '/routes/bulk', routes)]
+        else:
+            results = driver.run([('POST', '/routes', route) for route in routes], args.concurrency)
+        elapsed = time.perf_counter() - started
+        report['BULK %s' % ('POST /routes/bulk' if label == 'bulk' else 'POST /routes x %d' % args.bulk_routes)] = \
+            summarize(results, elapsed)
+        routes_per_second[label] = args.bulk_routes / elapsed
+    measurements['bulk import'] = {'routes': args.bulk_routes,
+                                   'bulk_routes_per_second': round(routes_per_second['bulk'], 1),
+                                   'single_routes_per_second': round(routes_per_second['single'], 1),
+                                   'speedup': round(routes_per_second['bulk'] / routes_per_second['single'], 1)}
+    return report
+
+#一覧の件数による違い: 地点がLIST_SMALL_ROWS件と--list-rows件のユーザーで、GET /pointsの1ページ目とndjsonの全件を読み、
+#最初のバイトまで・全体の時間(中央値)と、リクエスト中のPythonのメモリ確保のピーク(テストクライアントの時だけ)を比べる
+LIST_SMALL_ROWS = 1000
+LIST_ROUNDS = 5
+def run_list_load(driver, app_module, args, rng, measurements):
+    if not args.list_rows:
+        return
+    counter = itertools.count()
+    for rows in (LIST_SMALL_ROWS, args.list_rows):
+        user_id = register(driver, 'bench-list-%d-%d' % (args.seed, rows))
+        insert_points(app_module, user_id, rows, rng)
+        values = {}
+        for label, path in (('page', '/points?limit=1000'), ('ndjson', '/points?format=ndjson')):
+            results = [driver.stream('%s&_=%d' % (path, next(counter))) for _ in range(LIST_ROUNDS)]
+            if any(status != 200 for status, _, _, _ in results):
+                raise SystemExit('一覧の取得に失敗しました: %s' % path)
+            values['%s_first_byte_ms' % label] = round(percentile([first_byte * 1000 for _, first_byte, _, _ in results], 0.5), 3)
+            values['%s_total_ms' % label] = round(percentile([elapsed * 1000 for _, _, elapsed, _ in results], 0.5), 3)
+            values['%s_bytes' % label] = results[0][3]
+            if driver.name == 'test_client':
+                tracemalloc.start()
+                driver.stream('%s&_=%d' % (path, next(counter)))
+                values['%s_peak_kb' % label] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+        measurements['list %d rows' % rows] = values
+
+#同時書き込み: 同じユーザーでログインした複数のクライアント(スレッド)がPOST /pointsとPOST /routesを交互に送り、
+#ロック待ちで失敗したリクエスト(5xx)の数と、クライアント数ごとのスループットを測る
+def run_write_load(driver, args, rng, measurements):
+    if not args.writer_requests:
+        return {}
+    username = 'bench-writers-%d' % args.seed
+    register(driver, username)
+    counter = iter(range(4 * 10 ** 9, 5 * 10 ** 9))
+    report = {}
+    values = {}
+    for threads in [int(value) for value in args.writer_threads.split(',')]:
+        sessions = [driver.session() for _ in range(threads)]
+        for session in sessions:
+            expect(session.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+        requests = [('POST', '/points', synthetic_point(rng, next(counter))) if i % 2 else
+                    ('POST', '/routes', synthetic_route(rng, counter, 2)) for i in range(args.writer_requests)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(itertools.chain.from_iterable(executor.map(
+                lambda session, chunk: [session.request(*request) for request in chunk],
+                sessions, [requests[i::threads] for i in range(threads)])))
+        summary = report['WRITERS x%d' % threads] = summarize(results, time.perf_counter() - started)
+        values['x%d_rps' % threads] = summary['throughput_rps']
+        values['x%d_errors' % threads] = sum(1 for response, _, _ in results if response.status >= 500)
+    measurements['concurrent writers'] = values
+    return report
+
+#経路計画: 経由地数ごとに経路を1件ずつ登録し、GET /routes/<id>/planのレイテンシを測る(500件で100ms未満が目標)
+def run_plan_load(driver, args, rng):
+    if not args.plan_waypoints:
+        return {}
+    register(driver, 'bench-plan-%d' % args.seed)
+    counts = [int(value) for value in args.plan_waypoints.split(',')]
+    counter = iter(range(5 * 10 ** 9, 6 * 10 ** 9))
+    created = expect(driver.request('POST', '/routes/bulk', [synthetic_route(rng, counter, count) for count in counts])[0],
+                     201).json()['created']
+    report = {}
+    for count, item in zip(counts, created):
+        requests = [('GET', '/routes/%d/plan' % item['route_id'])] * args.iterations
+        started = time.perf_counter()
+        results = driver.run(requests, args.concurrency)
+        report['PLAN GET /routes/<id>/plan (%d waypoints)' % count] = summarize(results, time.perf_counter() - started)
+    return report
+
+#距離行列: 地点の多いユーザーで、最初のGET /points/distance-matrix(全件から作る)と、
+#地点の追加・移動・削除ごとの差分更新(O(n))の時間を比べる
+MATRIX_SUBSET = 20
+def run_matrix_load(driver, app_module, args, rng, measurements):
+    if not args.matrix_points:
+        return {}
+    user_id = register(driver, 'bench-matrix-%d' % args.seed)
+    point_ids = insert_points(app_module, user_id, args.matrix_points, rng)
+    path = '/points/distance-matrix?ids=%s' % ','.join(map(str, rng.sample(point_ids, min(MATRIX_SUBSET, len(point_ids)))))
+    started = time.perf_counter()
+    cold = driver.request('GET', path)
+    expect(cold[0], 200)
+    report = {'MATRIX GET /points/distance-matrix (build)': summarize([cold], time.perf_counter() - started)}
+    counter = iter(range(6 * 10 ** 9, 7 * 10 ** 9))
+    values = {'points': args.matrix_points, 'build_ms': report['MATRIX GET /points/distance-matrix (build)']['p50_ms']}
+    created = []
+    for label, name, make_request in (
+            ('add', 'POST /points', lambda i: ('POST', '/points', synthetic_point(rng, next(counter)))),
+            ('move', 'PUT /points/<id>', lambda i: ('PUT', '/points/%d' % created[i], synthetic_point(rng, next(counter)))),
+            ('delete', 'DELETE /points/<id>', lambda i: ('DELETE', '/points/%d' % created[i]))):
+        requests = [make_request(i) for i in range(len(created) if label != 'add' else args.iterations)]
+        started = time.perf_counter()
+        results = driver.run(requests, 1)
+        summary = report['MATRIX %s' % name] = summarize(results, time.perf_counter() - started)
+        values['%s_p50_ms' % label] = summary['p50_ms']
+        if label == 'add':
+            created = [response.json()['id'] for response, _, _ in results if response.status == 201]
+    started = time.perf_counter()
+    results = driver.run([('GET', path)] * args.iterations, args.concurrency)
+    report['MATRIX GET /points/distance-matrix (cached)'] = summarize(results, time.perf_counter() - started)
+    measurements['distance matrix'] = values
+    return report
+
+#計測のオーバーヘッド: 同じリクエストの列をREQUEST_METRICSを切り替えながら(順番も入れ替えて)交互に流し、
+#1周の時間の中央値を比べる。プロセス内で切り替えるのでテストクライアントの時だけ
+METRICS_ROUNDS = 5
+def run_metrics_overhead(driver, app_module, data, args, rng, measurements):
+    if not args.metrics_requests or driver.name != 'test_client':
+        return
+    requests = [('GET', '/routes/%d' % rng.choice(data['route_ids'])) if i % 2 else ('GET', '/points?limit=50&_=%d' % i)
+                for i in range(args.metrics_requests)]
+    seconds = {True: [], False: []}
+    enabled = app_module.REQUEST_METRICS
+    try:
+        for index in range(METRICS_ROUNDS):
+            for instrumented in ((True, False) if index % 2 else (False, True)):
+                app_module.REQUEST_METRICS = instrumented
+                started = time.perf_counter()
+                for response, _, _ in driver.run(requests, 1):
+                    expect(response, 200, 304)
+                seconds[instrumented].append(time.perf_counter() - started)
+    finally:
+        app_module.REQUEST_METRICS = enabled
+    on, off = percentile(seconds[True], 0.5), percentile(seconds[False], 0.5)
+    measurements['request metrics'] = {'requests': args.metrics_requests,
+                                       'on_ms': round(on * 1000, 3), 'off_ms': round(off * 1000, 3),
+                                       'overhead_percent': round((on - off) / off * 100, 2)}
+
+#ジオコーディング: 住所だけの地点(始点・終点)の経路をPOST /routes/bulkで登録する。1回目はキャッシュが空、
+#2回目は別のユーザーで同じ住所を表記ゆれ(大文字・空白)付きで送り、ジオコーダーの遅延込みの時間とキャッシュのヒット率を比べる
+def run_geocode_load(driver, args, rng, measurements):
+    if not args.geocode_addresses:
+        return {}
+    addresses = ['bench geocode %d-%d chome' % (args.seed, index) for index in range(args.geocode_addresses)]
+    report = {}
+    values = {'addresses': args.geocode_addresses, 'geocoder_latency_s': args.geocoder_latency}
+    for label in ('cold', 'warm'):
+        register(driver, 'bench-geocode-%d-%s' % (args.seed, label))
+        pool = addresses if label == 'cold' else [address.upper().replace(' ', '  ') for address in addresses]
+        pool = rng.sample(pool, len(pool))
+        routes = [{'start_point': {'name': 's%d' % i, 'address': pool[i]}, 'end_point': {'name': 'e%d' % i, 'address': pool[i + 1]}}
+                  for i in range(0, len(pool) - 1, 2)]
+        before = metrics_gauges(driver)
+        started = time.perf_counter()
+        results = [driver.request('POST', '/routes/bulk', routes)]
+        elapsed = time.perf_counter() - started
+        expect(results[0][0], 201)
+        after = metrics_gauges(driver)
+        report['GEOCODE POST /routes/bulk (%s)' % label] = summarize(results, elapsed)
+        hits = after['geocode_cache_hits'] - before['geocode_cache_hits']
+        misses = after['geocode_cache_misses'] - before['geocode_cache_misses']
+        values['%s_ms' % label] = round(elapsed * 1000, 3)
+        values['%s_hit_ratio' % label] = round(hits / (hits + misses), 3) if hits + misses else None
+    measurements['geocoding'] = values
+    return report
+
+#認証: POST /login(パスワードの照合)のレイテンシと、認証付きの読み取りのスループットをユーザーキャッシュの有無で比べる
+#キャッシュはプロセス内で差し替える(容量0のキャッシュは何も残さない)ので、比較はテストクライアントの時だけ
+def run_auth_load(driver, app_module, data, args, rng, measurements):
+    if not args.auth_requests:
+        return {}
+    username = 'bench-auth-%d' % args.seed
+    register(driver, username)
+    started = time.perf_counter()
+    results = driver.run([('POST', '/login', {'username': username, 'password': PASSWORD})] * args.iterations, 1)
+    report = {'AUTH POST /login': summarize(results, time.perf_counter() - started)}
+    if driver.name != 'test_client':
+        return report
+    requests = [('GET', '/routes/%d' % rng.choice(data['route_ids'])) for _ in range(args.auth_requests)]
+    user_cache = app_module.user_cache
+    values = {'requests': args.auth_requests}
+    try:
+        for label, cache in (('user cache', user_cache), ('no user cache', app_module.MemoryCache(0))):
+            app_module.user_cache = cache
+            started = time.perf_counter()
+            results = driver.run(requests, 1)
+            summary = report['AUTH GET /routes/<id> (%s)' % label] = summarize(results, time.perf_counter() - started)
+            values['%s_rps' % label.replace(' ', '_')] = summary['throughput_rps']
+    finally:
+        app_module.user_cache = user_cache
+    measurements['user cache'] = values
+    return report
+
+#パスワードのハッシュ方式ごとに、ハッシュ化と照合(POST /users・POST /loginで1回ずつ)の時間をこのプロセスで測る
+#設定中の方式(PASSWORD_HASH_METHOD)には印を付ける
+def run_hash_cost(app_module, args, measurements):
+    if not args.hash_methods:
+        return
+    for method in args.hash_methods.split(','):
+        hashes, checks = [], []
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            hashed = app_module.generate_password_hash(PASSWORD, method=method)
+            hashes.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            if not app_module.check_password_hash(hashed, PASSWORD):
+                raise SystemExit('パスワードの照合に失敗しました: %s' % method)
+            checks.append(time.perf_counter() - started)
+        measurements['password hash %s' % method] = {'hash_p50_ms': round(percentile(hashes, 0.5) * 1000, 3),
+                                                     'check_p50_ms': round(percentile(checks, 0.5) * 1000, 3),
+                                                     'configured': method == app_module.PASSWORD_HASH_METHOD}
+
+#地点の重複排除: --dedup-places件の場所から始点・終点・経由地を選んだ経路を登録し、経路が参照する地点の数と
+#実際にできたPointの行数、(他の計測の分も含む)テーブル全体の大きさ(dbstatが使えるSQLiteの時)、その経路のGET /routes/<id>のレイテンシを測る
+DEDUP_WAYPOINTS = 3
+def run_dedup_load(driver, app_module, args, rng, measurements):
+    if not args.dedup_routes:
+        return {}
+    user_id = register(driver, 'bench-dedup-%d' % args.seed)
+    places = [synthetic_point(rng, 7 * 10 ** 9 + index) for index in range(args.dedup_places)]
+    routes = [{'start_point': rng.choice(places), 'end_point': rng.choice(places),
+               'waypoint': [rng.choice(places) for _ in range(DEDUP_WAYPOINTS)]} for _ in range(args.dedup_routes)]
+    created = expect(driver.request('POST', '/routes/bulk', routes)[0], 201).json()['created']
+    with app_module.app.app_context():
+        points = app_module.Point.query.filter_by(user_id=user_id).count()
+        try:
+            sizes = dict(app_module.db.session.execute(app_module.db.text(
+                "SELECT name, SUM(pgsize) FROM dbstat WHERE name IN ('point', 'waypoint', 'route') GROUP BY name")).all())
+        except app_module.db.exc.OperationalError:
+            sizes = {}
+    references = args.dedup_routes * (2 + DEDUP_WAYPOINTS)
+    measurements['point dedup'] = dict({'point_references': references, 'point_rows': points,
+                                        'dedup_ratio': round(references / points, 2) if points else None},
+                                       **{'%s_table_kb' % name: size // 1024 for name, size in sorted(sizes.items())})
+    requests = [('GET', '/routes/%d' % rng.choice(created)['route_id']) for _ in range(args.iterations)]
+    started = time.perf_counter()
+    results = driver.run(requests, args.concurrency)
+    return {'DEDUP GET /routes/<id>': summarize(results, time.perf_counter() - started)}
+
+#一括エクスポート: 経路がEXPORT_SMALL_ROUTES件と--export-routes件のユーザーで、GET /routes/exportを形式ごとに読み、
+#経路/秒・バイト数と、リクエスト中のPythonのメモリ確保のピーク(テストクライアントの時だけ)を比べる
+EXPORT_SMALL_ROUTES = 1000
+EXPORT_WAYPOINTS = 3
+def run_export_load(driver, app_module, args, rng, measurements):
+    if not args.export_routes:
+        return
+    formats = [format for format in app_module.export.MIMETYPES if format != 'msgpack' or app_module.export.msgpack is not None]
+    counter = itertools.count()
+    for count in (EXPORT_SMALL_ROUTES, args.export_routes):
+        user_id = register(driver, 'bench-export-%d-%d' % (args.seed, count))
+        insert_routes(app_module, user_id, count, rng)
+        values = {}
+        for format in formats:
+            path = '/routes/export?format=%s&_=%d' % (format, next(counter))
+            status, first_byte, elapsed, size = driver.stream(path)
+            if status != 200:
+                raise SystemExit('エクスポートに失敗しました: %s' % path)
+            values['%s_routes_per_second' % format] = round(count / elapsed, 1)
+            values['%s_first_byte_ms' % format] = round(first_byte * 1000, 3)
+            values['%s_bytes' % format] = size
+            if driver.name == 'test_client':
+                tracemalloc.start()
+                driver.stream('/routes/export?format=%s&_=%d' % (format, next(counter)))
+                values['%s_peak_kb' % format] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+        measurements['export %d routes' % count] = values
+
+#経路も件数が多いのでDBに直接入れる。地点は経路10件あたり1件作って使い回す
+def insert_routes(app_module, user_id, count, rng):
+    point_ids = insert_points(app_module, user_id, max(2, count // 10), rng)
+    Route, Waypoint = app_module.Route, app_module.Waypoint
+    with app_module.app.app_context():
+        first_id = (app_module.db.session.query(app_module.db.func.max(Route.id)).scalar() or 0) + 1
+        app_module.db.session.execute(Route.__table__.insert(), [
+            {'id': first_id + index, 'user_id': user_id, 'start_point_id': rng.choice(point_ids),
+             'end_point_id': rng.choice(point_ids), 'favorite_count': 0, 'version': 1} for index in range(count)])
+        app_module.db.session.execute(Waypoint.__table__.insert(), [
+            {'route_id': first_id + index, 'waypoint_id': rng.choice(point_ids), 'position': position}
+            for index in range(count) for position in range(EXPORT_WAYPOINTS)])
+        app_module.db.session.commit()
+
+#地点はAPIを通さずDBに直接入れる(件数が多いので、SEARCH_INSERT_CHUNK件ずつ)。ユーザーの地点のidを返す
+def insert_points(app_module, user_id, count, rng, start=0):
+    Point = app_module.Point
+    with app_module.app.app_context():
+        for chunk in range(start, start + count, SEARCH_INSERT_CHUNK):
+            rows = []
+            for index in range(chunk, min(chunk + SEARCH_INSERT_CHUNK, start + count)):
+                point = synthetic_point(rng, index)
+                rows.append(dict(point, user_id=user_id, grid_cell=app_module.grid_cell(point['latitude'], point['longitude']),
+                                 content_hash=app_module.point_hash(point['address'], point['latitude'], point['longitude'])))
+            app_module.db.session.execute(Point.__table__.insert(), rows)
+            app_module.db.session.commit()
+        return [row.id for row in app_module.db.session.query(Point.id).filter_by(user_id=user_id)]
+
+#差分同期: 地点の多いユーザーで数件だけ変更し、GET /syncと全件取得(GET /points?format=ndjson)を比べる
+FULL_DOWNLOAD_ITERATIONS = 5
+def run_sync_load(driver, app_module, args, rng):
+    if not args.sync_points:
+        return {}
+    username = 'bench-sync-%d' % args.seed
+    user_id = expect(driver.request('POST', '/users', {'username': username, 'password': PASSWORD})[0], 201).json()['id']
+    expect(driver.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+    cursor = expect(driver.request('GET', '/sync')[0], 200).json()['cursor']
+    point_ids = insert_points(app_module, user_id, args.sync_points, rng)
+    for i in range(args.sync_changes):
+        driver.request('PUT', '/points/%d' % rng.choice(point_ids), {'name': 'changed %d' % i})
+    report = {}
+    for name, request, iterations in (('SYNC GET /sync', ('GET', '/sync?since=%d' % cursor), args.iterations),
+                                      ('SYNC GET /points?format=ndjson', ('GET', '/points?format=ndjson'),
+                                       min(args.iterations, FULL_DOWNLOAD_ITERATIONS))):
+        started = time.perf_counter()
+        results = driver.run([request] * iterations, args.concurrency)
+        report[name] = summarize(results, time.perf_counter() - started)
+    return report
+
+#経路一覧の1ページ(BATCH_PAGE_SIZE件)を、POST /routes/batch-getの1回とGET /routes/<id>のページ分の呼び出しで読み比べる
+#個別呼び出しはページ全体(全部返るまで)を1件として数える。個別の方はレスポンスキャッシュに当たることがあるので控えめな比較になる
+BATCH_PAGE_SIZE = 200
+BATCH_PAGES = 10
+def run_batch_load(driver, data, args, rng):
+    route_ids = data['route_ids']
+    pages = [rng.sample(route_ids, min(BATCH_PAGE_SIZE, len(route_ids))) for _ in range(min(args.iterations, BATCH_PAGES))]
+    started = time.perf_counter()
+    batch = [driver.request('POST', '/routes/batch-get', page) for page in pages]
+    report = {'BATCH POST /routes/batch-get': summarize(batch, time.perf_counter() - started)}
+    individual = []
+    started = time.perf_counter()
+    for page in pages:
+        page_started = time.perf_counter()
+        results = driver.run([('GET', '/routes/%d' % route_id) for route_id in page], args.concurrency)
+        statuses = {response.status for response, _, _ in results}
+        queries = [count for _, _, count in results]
+        individual.append((Response(statuses.pop() if len(statuses) == 1 else 0, b''.join(response.body for response, _, _ in results)),
+                           time.perf_counter() - page_started, None if None in queries else sum(queries)))
+    report['BATCH GET /routes/<id> x page'] = summarize(individual, time.perf_counter() - started)
+    return report
+
+#一覧のシリアライズ: 地点の多いユーザーでGET /pointsの全ページとndjsonを読む。レスポンスキャッシュに
+#当たらないよう毎回違うクエリ文字列を付ける。あわせてapp.json.dumpsの処理量(行/秒)をプロセス内で測る
+SERIALIZE_ROUNDS = 5
+def run_serialize_load(driver, app_module, args, rng):
+    if not args.serialize_points:
+        return {}, None
+    username = 'bench-serialize-%d' % args.seed
+    user_id = expect(driver.request('POST', '/users', {'username': username, 'password': PASSWORD})[0], 201).json()['id']
+    expect(driver.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+    point_ids = insert_points(app_module, user_id, args.serialize_points, rng)
+    page_size = 1000
+    pages = [0] + point_ids[page_size - 1:-1:page_size]
+    counter = itertools.count()
+    report = {}
+    for name, requests in (
+            ('SERIALIZE GET /points?limit=1000', [('GET', '/points?limit=%d&after_id=%d&_=%d' % (page_size, after_id, next(counter)))
+                                                  for _ in range(SERIALIZE_ROUNDS) for after_id in pages]),
+            ('SERIALIZE GET /points?format=ndjson', [('GET', '/points?format=ndjson&_=%d' % next(counter))
+                                                     for _ in range(SERIALIZE_ROUNDS)])):
+        started = time.perf_counter()
+        results = driver.run(requests, args.concurrency)
+        report[name] = summarize(results, time.perf_counter() - started)
+    with app_module.app.app_context():
+        records = [app_module.point_to_dict(point) for point in app_module.Point.query.filter_by(user_id=user_id)]
+        started = time.perf_counter()
+        for _ in range(SERIALIZE_ROUNDS):
+            body = app_module.app.json.dumps(records)
+        elapsed = (time.perf_counter() - started) / SERIALIZE_ROUNDS
+    serializer = {'rows_per_second': round(len(records) / elapsed), 'mb_per_second': round(len(body.encode('utf-8')) / elapsed / 1e6, 1)}
+    return report, serializer
+
+#地点検索: 日本語の名前・住所を持つ地点を大量に入れたユーザーで、前方一致・部分一致・複数語・該当なしを測る
+SEARCH_PREFECTURES = ['東京都', '神奈川県', '埼玉県', '千葉県']
+SEARCH_CITIES = ['千代田区', '中央区', '港区', '新宿区', '文京区', '台東区', '墨田区', '江東区', '品川区', '目黒区',
+                 '大田区', '世田谷区', '渋谷区', '中野区', '杉並区', '豊島区', '練馬区', '横浜市西区', '川崎市中原区']
+SEARCH_TOWNS = ['本町', '栄町', '緑町', '大手町', '丸の内', '神田', '銀座', '日本橋', '青山', '赤坂', '六本木', '麻布',
+                '高輪', '白金', '恵比寿', '代官山', '自由が丘', '三軒茶屋', '下北沢', '吉祥寺', '荻窪']
+SEARCH_KINDS = ['カフェ', '公園', '駅', '図書館', '病院', '郵便局', 'スーパー', '書店', '美術館', '神社', 'ホテル']
+SEARCH_QUERIES = [
+    ('SEARCH prefix', ['銀座', '六本', '東京', '神奈']),
+    ('SEARCH substring', ['三軒茶屋', '中原区', '丸の内3丁目', '世田谷区三軒茶屋', '恵比寿カフェ']),
+    ('SEARCH multi-term', ['港区 六本木', '渋谷区 カフェ', '江東区 公園 1丁目']),
+    ('SEARCH miss', ['存在しない地名', 'zzzz']),
+]
+SEARCH_INSERT_CHUNK = 50000
+def run_search_load(driver, app_module, args, rng):
+    if not args.search_points:
+        return {}
+    username = 'bench-search-%d' % args.seed
+    user_id = expect(driver.request('POST', '/users', {'username': username, 'password': PASSWORD})[0], 201).json()['id']
+    Point = app_module.Point
+    started = time.perf_counter()
+    with app_module.app.app_context():
+        for start in range(0, args.search_points, SEARCH_INSERT_CHUNK):
+            rows = []
+            for index in range(start, min(start + SEARCH_INSERT_CHUNK, args.search_points)):
+                town = rng.choice(SEARCH_TOWNS)
+                address = '%s%s%s%d丁目%d-%d' % (rng.choice(SEARCH_PREFECTURES), rng.choice(SEARCH_CITIES), town,
+                                               rng.randint(1, 9), rng.randint(1, 30), rng.randint(1, 20))
+                latitude, longitude = round(rng.uniform(35.5, 35.8), 6), round(rng.uniform(139.5, 139.9), 6)
+                rows.append({'name': '%s%s%d' % (rng.choice(SEARCH_TOWNS + [town]), rng.choice(SEARCH_KINDS), index % 97),
+                             'address': address, 'latitude': latitude, 'longitude': longitude, 'user_id': user_id,
+                             'grid_cell': app_module.grid_cell(latitude, longitude),
+                             'content_hash': app_module.point_hash(address, latitude, longitude)})
+            app_module.db.session.execute(Point.__table__.insert(), rows)
+            app_module.db.session.commit()
+    print('search points: %d (%.1fs)' % (args.search_points, time.perf_counter() - started))
+    expect(driver.request('POST', '/login', {'username': username, 'password': PASSWORD})[0], 200)
+    report = {}
+    for name, queries in SEARCH_QUERIES:
+        requests = [('GET', '/points/search?q=%s' % urllib.parse.quote(queries[i % len(queries)]))
+                    for i in range(args.iterations)]
+        started = time.perf_counter()
+        results = driver.run(requests, args.concurrency)
+        report[name] = summarize(results, time.perf_counter() - started)
+    return report
+
+#範囲検索: 1人のユーザーの地点を--spatial-pointsの件数まで順に増やしながら、約1km四方の範囲を
+#格子のインデックス(query_points_in_bbox)と、user_idだけで全件読んでPythonで絞る場合で引き比べる(プロセス内でDBを直接読む)
+SPATIAL_BOX = 0.01
+SPATIAL_SCAN_ROUNDS = 3
+def run_spatial_load(app_module, args, rng, measurements):
+    if not args.spatial_points:
+        return
+    Point = app_module.Point
+    with app_module.app.app_context():
+        user = app_module.User(username='bench-spatial-%d' % args.seed)
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+        user_id = user.id
+    inserted = 0
+    for count in [int(value) for value in args.spatial_points.split(',')]:
+        insert_points(app_module, user_id, count - inserted, rng, start=inserted)
+        inserted = count
+        boxes = []
+        for _ in range(args.iterations):
+            lat, lng = rng.uniform(35.5, 35.8 - SPATIAL_BOX), rng.uniform(139.5, 139.9 - SPATIAL_BOX)
+            boxes.append((lat, lng, lat + SPATIAL_BOX, lng + SPATIAL_BOX))
+        grid, scan = [], []
+        with app_module.app.app_context():
+            for min_lat, min_lng, max_lat, max_lng in boxes:
+                started = time.perf_counter()
+                found = app_module.query_points_in_bbox(user_id, min_lat, min_lng, max_lat, max_lng)
+                grid.append(time.perf_counter() - started)
+            for min_lat, min_lng, max_lat, max_lng in boxes[:SPATIAL_SCAN_ROUNDS]:
+                started = time.perf_counter()
+                scanned = [row for row in app_module.db.session.query(Point.id, Point.latitude, Point.longitude).filter(
+                    Point.user_id == user_id) if min_lat <= row.latitude <= max_lat and min_lng <= row.longitude <= max_lng]
+                scan.append(time.perf_counter() - started)
+            if len(scanned) != len(app_module.query_points_in_bbox(user_id, min_lat, min_lng, max_lat, max_lng)):
+                raise SystemExit('範囲検索の結果が全件走査と一致しません')
+        grid_ms, scan_ms = percentile(grid, 0.5) * 1000, percentile(scan, 0.5) * 1000
+        measurements['bbox %d points' % count] = {'grid_p50_ms': round(grid_ms, 3),
+                                                  'grid_p95_ms': round(percentile(grid, 0.95) * 1000, 3),
+                                                  'scan_p50_ms': round(scan_ms, 3),
+                                                  'speedup': round(scan_ms / grid_ms, 1),
+                                                  'points_in_box': len(found)}
+
+#過負荷の保護: 行儀の良いクライアント(ユーザーごとに決まった間隔で読み書き)のレイテンシを、単独の時と、1ユーザーが
+#複数の接続で間隔を空けずに送り続ける時で比べる。レート制限・同時実行数の制限を外したサーバーと付けたサーバーを
+#スレッド1プロセスで別に起動して計測する(制限の無いスレッドサーバーはリクエストを受けた分だけ処理を抱え込む)
+ADMISSION_SERVER_COMMAND = '{python} -m flask --app app run --with-threads --host {host} --port {port}'
+ADMISSION_CLIENTS = 4
+ADMISSION_CLIENT_RATE = 10
+ADMISSION_FLOODERS = 8
+ADMISSION_LIMITS = {'RATE_LIMIT_READ_RATE': '20', 'RATE_LIMIT_READ_BURST': '40',
+                    'RATE_LIMIT_WRITE_RATE': '5', 'RATE_LIMIT_WRITE_BURST': '10', 'MAX_CONCURRENT_REQUESTS': '4'}
+ADMISSION_NO_LIMITS = {'RATE_LIMIT_READ_RATE': '0', 'RATE_LIMIT_WRITE_RATE': '0', 'MAX_CONCURRENT_REQUESTS': '0'}
+#ASGIとWSGI: 同じDBに対してASGIサーバー(asgi:application)とWSGIサーバーをそれぞれ起動し、同時接続数ごとに
+#キャッシュに当たらない経路の読み取り(非同期のDBアクセス)とキャッシュに当たる地点一覧を交互に送って比べる
+#リクエスト数は接続数の2倍(--iterations以上)。同時接続数の分だけクライアント側のスレッドを作る
+ASGI_ROUTES = 50
+def run_asgi_load(args, rng):
+    if not args.asgi_levels:
+        return {}
+    levels = [int(level) for level in args.asgi_levels.split(',')]
+    counter = iter(range(8 * 10 ** 9, 9 * 10 ** 9))
+    report = {}
+    for label, command in (('asgi', args.asgi_command), ('wsgi', args.server_command)):
+        server = start_server(command, args.workers, None, subprocess.DEVNULL)
+        try:
+            register(server, 'bench-asgi-%d-%s' % (args.seed, label))
+            created = expect(server.request('POST', '/routes/bulk', [synthetic_route(rng, counter, args.waypoints)
+                                                                     for _ in range(ASGI_ROUTES)])[0], 201).json()['created']
+            route_ids = [item['route_id'] for item in created]
+            for level in levels:
+                requests = [('GET', '/routes/%d?n=%d' % (rng.choice(route_ids), next(counter))) if i % 2 else ('GET', '/points')
+                            for i in range(max(args.iterations, 2 * level))]
+                started = time.perf_counter()
+                results = server.run(requests, level)
+                report['%s GET /routes/<id> + /points (c=%d)' % (label.upper(), level)] = \
+                    summarize(results, time.perf_counter() - started)
+        finally:
+            server.process.terminate()
+            server.process.wait()
+    return report
+
+def run_admission_load(data, args, rng):
+    if not args.admission_seconds:
+        return {}
+
+    #行儀の良いクライアントは5回に1回地点を登録し、残りは経路を読む
+    def polite_request(i, rng):
+        if i % 5 == 4:
+            return 'POST', '/points', synthetic_point(rng, i)
+        return 'GET', '/routes/%d' % rng.choice(data['route_ids']), None
+
+    #送り続けるクライアントはレスポンスキャッシュに当たらない読み取りと地点の登録を交互に送る
+    def flood_request(i, rng):
+        if i % 2:
+            return 'POST', '/points', synthetic_point(rng, i)
+        return 'GET', '/routes/%d?n=%d' % (rng.choice(data['route_ids']), i), None
+
+    def worker(driver, make_request, interval, deadline, results, seed):
+        worker_rng = random.Random(seed)
+        next_at = time.perf_counter()
+        for i in itertools.count():
+            if time.perf_counter() >= deadline:
+                return
+            response, elapsed, _ = driver.request(*make_request(i, worker_rng))
+            results.append((response, elapsed, None))
+            if interval:
+                next_at += interval
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+
+    def run(clients, flooder):
+        polite_results, flood_results = [], []
+        started = time.perf_counter()
+        deadline = started + args.admission_seconds
+        threads = [threading.Thread(target=worker, args=(client, polite_request, 1 / ADMISSION_CLIENT_RATE, deadline,
+                                                         polite_results, rng.random())) for client in clients]
+        if flooder:
+            threads += [threading.Thread(target=worker, args=(flooder, flood_request, 0, deadline, flood_results, rng.random()))
+                        for _ in range(ADMISSION_FLOODERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.perf_counter() - started
+        return summarize(polite_results, wall_seconds), summarize(flood_results, wall_seconds) if flood_results else None
+
+    report = {}
+    for label, env in (('no limits', ADMISSION_NO_LIMITS), ('limits', ADMISSION_LIMITS)):
+        #開発サーバーはリクエストごとにログを出すので捨てる
+        server = start_server(ADMISSION_SERVER_COMMAND, 1, env, subprocess.DEVNULL)
+        try:
+            clients = []
+            for index in range(ADMISSION_CLIENTS + 1):
+                driver = HTTPDriver(server.host, server.port, server.process)
+                username = 'bench-admission-%d-%s-%d' % (args.seed, label.replace(' ', '-'), index)
+                register(driver, username)
+                clients.append(driver)
+            clients, flooder = clients[:-1], clients[-1]
+            report['ADMISSION polite alone (%s)' % label] = run(clients, None)[0]
+            polite, flood = run(clients, flooder)
+            report['ADMISSION polite + flood (%s)' % label] = polite
+            report['ADMISSION flood (%s)' % label] = flood
+        finally:
+            server.process.terminate()
+            server.process.wait()
+    return report
+
+#混合負荷: 経路の一括登録(Prefer: respond-async)と経路計画のジョブを投入し、
+#全て終わるまで読み取りを続けて、投入・読み取りのレイテンシとジョブの処理速度を測る
+JOB_TIMEOUT = 300
+def run_job_load(driver, data, args, rng):
+    if not args.jobs:
+        return {}
+    counter = iter(range(2 * 10 ** 9, 3 * 10 ** 9))
+    requests = []
+    for i in range(args.jobs):
+        if i % 2:
+            requests.append(('POST', '/jobs', {'type': 'plan_route', 'payload': {'route_id': rng.choice(data['route_ids'])}}))
+        else:
+            requests.append(('POST', '/routes/bulk', [synthetic_route(rng, counter, args.waypoints) for _ in range(20)],
+                             {'Prefer': 'respond-async'}))
+    started = time.perf_counter()
+    enqueued = driver.run(requests, args.concurrency)
+    enqueue_seconds = time.perf_counter() - started
+    pending = {response.json()['id'] for response, _, _ in enqueued if response.status == 202}
+    jobs = []
+    reads = []
+    while pending and time.perf_counter() - started < JOB_TIMEOUT:
+        reads.extend(driver.run([('GET', '/routes/%d' % rng.choice(data['route_ids'])) for _ in range(args.concurrency)],
+                                args.concurrency))
+        for job_id in list(pending):
+            job = driver.request('GET', '/jobs/%d' % job_id)[0].json()
+            if job['status'] in ('done', 'failed'):
+                pending.discard(job_id)
+                jobs.append(job)
+    drain_seconds = time.perf_counter() - started
+    #ジョブのレイテンシは投入から完了まで
+    completion = [(Response(job['status'], b''), (datetime.datetime.fromisoformat(job['finished_at'])
+                   - datetime.datetime.fromisoformat(job['created_at'])).total_seconds(), None) for job in jobs]
+    report = {'JOBS enqueue': summarize(enqueued, enqueue_seconds),
+              'JOBS GET /routes/<id> during jobs': summarize(reads, drain_seconds)}
+    if completion:
+        report['JOBS completion'] = summarize(completion + [(Response('timeout', b''), JOB_TIMEOUT, None)] * len(pending),
+                                              drain_seconds)
+    return report
+
+#ベースラインと比べて閾値を超えた悪化を一覧にする
+def regressions(result, baseline, threshold, min_delta_ms):
+    found = []
+    limit = 1 + threshold
+    for name, current in result['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if previous is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if current[metric] > previous[metric] * limit and current[metric] - previous[metric] > min_delta_ms:
+                found.append('%s %s: %.3f -> %.3f' % (name, metric, previous[metric], current[metric]))
+        if current['throughput_rps'] and previous['throughput_rps'] and current['throughput_rps'] * limit < previous['throughput_rps']:
+            found.append('%s throughput_rps: %.2f -> %.2f' % (name, previous['throughput_rps'], current['throughput_rps']))
+        if current['sql_queries'] is not None and previous['sql_queries'] is not None \
+                and current['sql_queries'] > previous['sql_queries'] * limit and current['sql_queries'] - previous['sql_queries'] >= 1:
+            found.append('%s sql_queries: %.2f -> %.2f' % (name, previous['sql_queries'], current['sql_queries']))
+        if current['response_bytes'] > previous.get('response_bytes', current['response_bytes']) * limit:
+            found.append('%s response_bytes: %d -> %d' % (name, previous['response_bytes'], current['response_bytes']))
+    if result['peak_rss_kb'] and baseline.get('peak_rss_kb') and result['peak_rss_kb'] > baseline['peak_rss_kb'] * limit:
+        found.append('peak_rss_kb: %d -> %d' % (baseline['peak_rss_kb'], result['peak_rss_kb']))
+    return found
+
+def print_report(result):
+    print('%-34s %8s %9s %9s %9s %10s %6s %9s  %s' % ('endpoint', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'sql',
+                                                      'bytes', 'status'))
+    for name, row in result['endpoints'].items():
+        print('%-34s %8d %9.3f %9.3f %9.3f %10s %6s %9d  %s' % (
+            name, row['requests'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['throughput_rps'],
+            '-' if row['sql_queries'] is None else row['sql_queries'], row['response_bytes'],
+            ' '.join('%s:%d' % item for item in sorted(row['statuses'].items()))))
+    if result.get('serializer'):
+        print('serializer (app.json.dumps): %(rows_per_second)d rows/s, %(mb_per_second)s MB/s' % result['serializer'])
+    for name, values in result.get('measurements', {}).items():
+        print('%s: %s' % (name, ', '.join('%s=%s' % item for item in values.items())))
+    print('peak RSS: %s KB' % result['peak_rss_kb'])
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as directory:
+        app_module = prepare_environment(directory, args)
+        driver = start_server(args.server_command, args.workers) if args.server else TestClientDriver(app_module)
+        try:
+            endpoints, serializer, measurements = run_benchmark(driver, app_module, args)
+            peak_rss_kb = driver.peak_rss_kb()
+        finally:
+            if args.server:
+                driver.process.terminate()
+                driver.process.wait()
+    result = {'driver': driver.name,
+              'scale': {'users': args.users, 'routes': args.routes, 'waypoints': args.waypoints, 'favorites': args.favorites,
+                        'jobs': args.jobs, 'sync_points': args.sync_points, 'sync_changes': args.sync_changes,
+                        'search_points': args.search_points,
+                        'spatial_points': args.spatial_points,
+                        'serialize_points': args.serialize_points,
+                        'road_grid': args.road_grid,
+                        'admission_seconds': args.admission_seconds,
+                        'asgi_levels': args.asgi_levels,
+                        'bulk_routes': args.bulk_routes,
+                        'list_rows': args.list_rows,
+                        'writer_threads': args.writer_threads,
+                        'writer_requests': args.writer_requests,
+                        'plan_waypoints': args.plan_waypoints,
+                        'matrix_points': args.matrix_points,
+                        'metrics_requests': args.metrics_requests,
+                        'geocode_addresses': args.geocode_addresses,
+                        'geocoder_latency': args.geocoder_latency,
+                        'auth_requests': args.auth_requests,
+                        'hash_methods': args.hash_methods,
+                        'dedup_routes': args.dedup_routes,
+                        'dedup_places': args.dedup_places,
+                        'export_routes': args.export_routes,
+                        'iterations': args.iterations, 'concurrency': args.concurrency if args.server else 1,
+                        'workers': args.workers if args.server else 1},
+              'endpoints': endpoints,
+              'serializer': serializer,
+              'measurements': measurements,
+              'peak_rss_kb': peak_rss_kb}
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    #ベースラインは計測方法(テストクライアント/サーバー)ごとに分けて持つ
+    baseline = baselines.get(driver.name)
+    if args.update_baseline or baseline is None:
+        baselines[driver.name] = result
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False)
+        print('ベースラインを保存しました: %s' % args.baseline)
+        return 0
+    if baseline['scale'] != result['scale']:
+        print('ベースラインと規模が違うため比較しません: %s' % baseline['scale'])
+        return 0
+    found = regressions(result, baseline, args.threshold, args.min_delta_ms)
+    for line in found:
+        print('REGRESSION %s' % line)
+    return 1 if found else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+#キャッシュの保存先。Redis等に差し替える場合はこのメソッドを実装する
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+    def delete(self, key):
+        raise NotImplementedError
+    def get_counter(self, key):
+        raise NotImplementedError
+    def incr(self, key):
+        raise NotImplementedError
+
+#プロセス内のLRUキャッシュ(件数上限+TTL)
+class MemoryCache(CacheBackend):
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.counters = OrderedDict()
+        self.counter_floor = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    #世代番号はエントリと別のLRUで持つ(件数上限は同じ)。追い出した番号より大きい値(counter_floor)から
+    #数え直すので、追い出された世代番号に戻って古いキャッシュが復活することはない
+    def get_counter(self, key):
+        with self.lock:
+            if key not in self.counters:
+                return self.counter_floor
+            self.counters.move_to_end(key)
+            return self.counters[key]
+
+    def incr(self, key):
+        with self.lock:
+            value = self.counters[key] = self.counters.get(key, self.counter_floor) + 1
+            self.counters.move_to_end(key)
+            while len(self.counters) > self.max_size:
+                _, evicted = self.counters.popitem(last=False)
+                self.counter_floor = max(self.counter_floor, evicted + 1)
+            return value
+
+#レスポンスキャッシュ。namespaceの世代番号を上げると、そのnamespaceのキャッシュは全て無効になる
+class ResponseCache:
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, namespace, path):
+        return '%s:%d:%s' % (namespace, self.backend.get_counter('generation:' + namespace), path)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, namespace):
+        self.backend.incr('generation:' + namespace)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0}
+
+def make_etag(body):
+    return hashlib.md5(body).hexdigest()
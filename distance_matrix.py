@@ -0,0 +1,185 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+import planner
+
+INITIAL_CAPACITY = 64
+SKIPPED = object()
+
+#ユーザーごとの保存地点間の距離行列(float32)をディスクにmemmapで保持する
+#行列は最初のgetで作り(O(n^2))、地点の追加・変更・削除は1行1列の書き換え(O(n))で済ませる
+#行列が無いユーザーの追加・削除は何もしない(書き込みのリクエストで作り直さない)
+#地点がmax_pointsを超えるユーザーは行列を持たず、getのたびに指定の地点だけで計算する
+#書き込みはページキャッシュ経由で他のワーカーにも見えるので、都度のflushはしない
+class DistanceMatrixStore:
+    def __init__(self, directory, max_points):
+        self.directory = directory
+        self.max_points = max_points
+
+    def _path(self, user_id, name):
+        return os.path.join(self.directory, str(user_id), name)
+
+    @contextmanager
+    def _locked(self, user_id):
+        os.makedirs(os.path.join(self.directory, str(user_id)), exist_ok=True)
+        with open(self._path(user_id, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    #行列が無ければNone、地点が多すぎて持たないユーザーはSKIPPED
+    def _load(self, user_id):
+        try:
+            with open(self._path(user_id, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta.get('skipped'):
+                return SKIPPED
+            count = meta['count']
+            ids = np.load(self._path(user_id, 'ids.npy'), mmap_mode='r+')
+            coords = np.load(self._path(user_id, 'coords.npy'), mmap_mode='r+')
+            matrix = np.load(self._path(user_id, 'matrix.npy'), mmap_mode='r+')
+        except (OSError, ValueError, KeyError):
+            return None
+        return count, ids, coords, matrix
+
+    def _save_meta(self, user_id, meta):
+        path = self._path(user_id, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def _save_count(self, user_id, count):
+        self._save_meta(user_id, {'count': count})
+
+    #上限を超えたら行列のファイルを消し、次に地点が減るまで作らない
+    def _skip(self, user_id):
+        self._save_meta(user_id, {'skipped': True})
+        for name in ('ids', 'coords', 'matrix'):
+            try:
+                os.remove(self._path(user_id, name + '.npy'))
+            except FileNotFoundError:
+                pass
+
+    #容量を倍々で確保し直す(償却O(1))。max_pointsより大きくはしない
+    def _allocate(self, user_id, capacity, count=0, ids=None, coords=None, matrix=None):
+        capacity = max(min(capacity, self.max_points), count)
+        arrays = {}
+        for name, shape, dtype in (('ids', (capacity,), np.int64),
+                                   ('coords', (capacity, 2), np.float64),
+                                   ('matrix', (capacity, capacity), np.float32)):
+            tmp = self._path(user_id, name + '.tmp.npy')
+            arrays[name] = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+        if count:
+            arrays['ids'][:count] = ids[:count]
+            arrays['coords'][:count] = coords[:count]
+            arrays['matrix'][:count, :count] = matrix[:count, :count]
+        for name, array in arrays.items():
+            array.flush()
+            os.replace(self._path(user_id, name + '.tmp.npy'), self._path(user_id, name + '.npy'))
+        return arrays['ids'], arrays['coords'], arrays['matrix']
+
+    def _rebuild(self, user_id, rows):
+        count = len(rows)
+        ids, coords, matrix = self._allocate(user_id, max(INITIAL_CAPACITY, count * 2))
+        if count:
+            ids[:count] = [row[0] for row in rows]
+            coords[:count] = [(row[1], row[2]) for row in rows]
+            for i in range(count):
+                matrix[i, :count] = planner.distances_from(coords[i, 0], coords[i, 1], coords[:count, 0], coords[:count, 1])
+        matrix.flush()
+        self._save_count(user_id, count)
+        return count, ids, coords, matrix
+
+    def _index(self, ids, count, point_id):
+        found = np.flatnonzero(ids[:count] == point_id)
+        return int(found[0]) if len(found) else None
+
+    def _write_row(self, coords, matrix, count, index, latitude, longitude):
+        coords[index] = (latitude, longitude)
+        row = planner.distances_from(latitude, longitude, coords[:count, 0], coords[:count, 1])
+        matrix[index, :count] = row
+        matrix[:count, index] = row
+
+    #rowsは(id, latitude, longitude)の一覧。既にある地点は座標を更新する
+    def add(self, user_id, rows):
+        with self._locked(user_id):
+            loaded = self._load(user_id)
+            if loaded is None or loaded is SKIPPED:
+                return
+            count, ids, coords, matrix = loaded
+            for point_id, latitude, longitude in rows:
+                index = self._index(ids, count, point_id)
+                if index is None:
+                    if count == self.max_points:
+                        self._skip(user_id)
+                        return
+                    if count == len(ids):
+                        ids, coords, matrix = self._allocate(user_id, len(ids) * 2, count, ids, coords, matrix)
+                    index = count
+                    count += 1
+                    ids[index] = point_id
+                self._write_row(coords, matrix, count, index, latitude, longitude)
+            self._save_count(user_id, count)
+
+    #削除した行・列には末尾の地点を移す
+    #行列を持たないユーザーは、次のgetで地点数を数え直す
+    def remove(self, user_id, point_id):
+        with self._locked(user_id):
+            loaded = self._load(user_id)
+            if loaded is SKIPPED:
+                os.remove(self._path(user_id, 'meta.json'))
+            if loaded is None or loaded is SKIPPED:
+                return
+            count, ids, coords, matrix = loaded
+            index = self._index(ids, count, point_id)
+            if index is None:
+                return
+            last = count - 1
+            if index != last:
+                ids[index] = ids[last]
+                coords[index] = coords[last]
+                matrix[index, :count] = matrix[last, :count]
+                matrix[:count, index] = matrix[:count, last]
+                matrix[index, index] = 0
+            self._save_count(user_id, last)
+
+    def _compute(self, load_points, point_ids):
+        if point_ids is None:
+            return None
+        rows = {row[0]: row for row in load_points(point_ids)}
+        if any(point_id not in rows for point_id in point_ids):
+            return None
+        matrix = planner.distance_matrix([rows[point_id][1] for point_id in point_ids],
+                                         [rows[point_id][2] for point_id in point_ids])
+        return np.asarray(point_ids), matrix.astype(np.float32)
+
+    #load_pointsは(id, latitude, longitude)の一覧を返す関数(idsを渡すとその地点だけ)
+    #point_idsを指定するとその順の部分行列を返す。含まれない地点があればNone
+    #行列を持たないユーザーは、point_idsの地点だけで計算する(全件はNone)
+    def get(self, user_id, load_points, point_ids=None):
+        with self._locked(user_id):
+            loaded = self._load(user_id)
+            if loaded is None:
+                rows = load_points()
+                if len(rows) > self.max_points:
+                    self._skip(user_id)
+                    loaded = SKIPPED
+                else:
+                    loaded = self._rebuild(user_id, rows)
+            if loaded is SKIPPED:
+                return self._compute(load_points, point_ids)
+            count, ids, coords, matrix = loaded
+            ids = np.array(ids[:count])
+            if point_ids is None:
+                return ids, np.array(matrix[:count, :count])
+            positions = {point_id: index for index, point_id in enumerate(ids.tolist())}
+            if any(point_id not in positions for point_id in point_ids):
+                return None
+            index = [positions[point_id] for point_id in point_ids]
+            return np.asarray(point_ids), np.array(matrix[np.ix_(index, index)])
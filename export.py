@@ -0,0 +1,73 @@
+import json
+import struct
+from xml.sax.saxutils import escape
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#経路のエクスポート。recordは{'id', 'user_id', 'favorited', 'points': [(id, name, 緯度, 経度), ...]}で、
+#pointsは始点・経由地・終点の順。GeoJSONはdumps(アプリではapp.json.dumps)で書き出す
+MIMETYPES = {
+    'geojson': 'application/geo+json',
+    'gpx': 'application/gpx+xml',
+    'msgpack': 'application/x-msgpack',
+}
+
+def geojson_feature(record):
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': [[longitude, latitude] for _, _, latitude, longitude in record['points']],
+        },
+        'properties': {
+            'id': record['id'],
+            'user_id': record['user_id'],
+            'favorited': record['favorited'],
+            'point_ids': [point_id for point_id, _, _, _ in record['points']],
+            'names': [name for _, name, _, _ in record['points']],
+        },
+    }
+
+GPX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="hackathonteam21" xmlns="http://www.topografix.com/GPX/1/1">\n'
+GPX_FOOTER = '</gpx>\n'
+
+def gpx_route(record):
+    points = ''.join('<rtept lat="%r" lon="%r"><name>%s</name></rtept>' % (latitude, longitude, escape(name))
+                     for _, name, latitude, longitude in record['points'])
+    return '<rte><name>%s</name>%s</rte>\n' % (escape(str(record['id'])), points)
+
+def msgpack_route(record):
+    return msgpack.packb([record['id'], record['user_id'], record['favorited'],
+                          [list(point) for point in record['points']]])
+
+#1経路ずつ4バイト(ビッグエンディアン)の長さを前に付けて連結する
+def length_prefixed(data):
+    return struct.pack('>I', len(data)) + data
+
+def export_route(record, format, dumps=json.dumps):
+    if format == 'geojson':
+        return dumps(geojson_feature(record))
+    if format == 'gpx':
+        return GPX_HEADER + gpx_route(record) + GPX_FOOTER
+    return msgpack_route(record)
+
+#複数経路を1件ずつ書き出す(全件をメモリに載せない)
+def export_routes(records, format, dumps=json.dumps):
+    if format == 'geojson':
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = '\n'
+        for record in records:
+            yield separator + dumps(geojson_feature(record))
+            separator = ',\n'
+        yield '\n]}\n'
+    elif format == 'gpx':
+        yield GPX_HEADER
+        for record in records:
+            yield gpx_route(record)
+        yield GPX_FOOTER
+    else:
+        for record in records:
+            yield length_prefixed(msgpack_route(record))
@@ -0,0 +1,47 @@
+import hashlib
+import re
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+#住所の表記ゆれ(全角/半角・空白・大文字小文字)をそろえてキャッシュのキーにする
+def normalize_address(address):
+    address = unicodedata.normalize('NFKC', address)
+    return re.sub(r'\s+', ' ', address).strip().lower()
+
+#ジオコーダーの共通インターフェース。geocode_batchは住所の一覧に対して(緯度, 経度)かNoneを返す
+class Geocoder:
+    batch_size = 50
+
+    def geocode(self, address):
+        raise NotImplementedError
+
+    def geocode_batch(self, addresses):
+        return [self.geocode(address) for address in addresses]
+
+#テスト・ベンチマーク用のジオコーダー。住所のハッシュから日本付近の座標を作り、latencyで遅延を入れる
+class FakeGeocoder(Geocoder):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def geocode_batch(self, addresses):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.geocode(address) for address in addresses]
+
+    def geocode(self, address):
+        digest = hashlib.sha1(address.encode('utf-8')).digest()
+        return (30 + digest[0] / 255 * 15, 129 + digest[1] / 255 * 16)
+
+#キャッシュに無い住所をバッチに分け、スレッドプールで並行して問い合わせる
+def geocode_concurrently(geocoder, addresses, concurrency):
+    batches = [addresses[i:i + geocoder.batch_size] for i in range(0, len(addresses), geocoder.batch_size)]
+    results = {}
+    if not batches:
+        return results
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+        for batch, coordinates in zip(batches, executor.map(geocoder.geocode_batch, batches)):
+            results.update(zip(batch, coordinates))
+    return results
@@ -0,0 +1,140 @@
+import datetime
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+#リトライしても成功しない失敗(対象が存在しない等)はこれを投げる
+class JobError(Exception):
+    pass
+
+#DBのテーブルを使うジョブキュー。複数プロセスから同じテーブルを読み、状態の条件付きUPDATEで1件ずつ取り出す
+#ジョブはスレッド(DBアクセス等のI/O)で実行し、CPUを使う計算はrun_cpuでプロセスプールに渡す
+class JobQueue:
+    def __init__(self, app, db, model, threads=2, processes=None, poll_interval=0.5, timeout=600, max_backoff=300):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.threads = threads
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.timeout = datetime.timedelta(seconds=timeout)
+        self.max_backoff = max_backoff
+        self.handlers = {}
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.process_pool = None
+        self.stats = {'succeeded': 0, 'failed': 0, 'retried': 0}
+
+    def handler(self, kind):
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+
+    #呼び出し側のセッションでINSERTしてコミットし、このプロセスのワーカーを起こす
+    def enqueue(self, kind, payload, user_id, priority=0, max_attempts=3):
+        if kind not in self.handlers:
+            raise ValueError('unknown job type: %r' % (kind,))
+        now = datetime.datetime.utcnow()
+        job = self.model(kind=kind, payload=json.dumps(payload), user_id=user_id, status='queued', priority=priority,
+                         attempts=0, max_attempts=max_attempts, run_at=now, created_at=now)
+        self.db.session.add(job)
+        self.db.session.commit()
+        self.start()
+        self.wakeup.set()
+        return job
+
+    def start(self):
+        with self.lock:
+            if self.workers:
+                return
+            for index in range(self.threads):
+                worker = threading.Thread(target=self.work_loop, name='job-worker-%d' % index, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def run_cpu(self, f, *args):
+        with self.lock:
+            if self.process_pool is None:
+                #スレッドやDB接続を持ったプロセスをforkしないようspawnで起動する
+                self.process_pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+        return self.process_pool.submit(f, *args).result()
+
+    #実行できるジョブ(待機中で実行時刻を過ぎたもの、実行中のままタイムアウトしたもの)を優先度順に1件取り出す
+    #取り出すたびにattemptsが増えるので、読んだ時とattemptsが同じ時だけ更新する
+    #(statusだけだと、タイムアウトしたジョブを2つのワーカーが同時に取り出せる)
+    def claim(self):
+        Job = self.model
+        while True:
+            now = datetime.datetime.utcnow()
+            candidate = self.db.session.query(Job.id, Job.status, Job.attempts).filter(self.db.or_(
+                self.db.and_(Job.status == 'queued', Job.run_at <= now),
+                self.db.and_(Job.status == 'running', Job.started_at < now - self.timeout))).order_by(
+                Job.priority.desc(), Job.id).first()
+            if candidate is None:
+                self.db.session.commit()
+                return None
+            claimed = self.db.session.query(Job).filter_by(
+                id=candidate.id, status=candidate.status, attempts=candidate.attempts).update(
+                {Job.status: 'running', Job.started_at: now, Job.attempts: Job.attempts + 1}, synchronize_session=False)
+            self.db.session.commit()
+            if claimed:
+                return self.db.session.get(Job, candidate.id)
+
+    def run_one(self):
+        with self.app.app_context():
+            job = self.claim()
+            if job is None:
+                return False
+            try:
+                result = self.handlers[job.kind](json.loads(job.payload), job)
+            except Exception as e:
+                self.db.session.rollback()
+                self.finish_failed(job, e)
+            else:
+                job.status = 'done'
+                job.result = json.dumps(result)
+                job.error = None
+                job.finished_at = datetime.datetime.utcnow()
+                self.db.session.commit()
+                self.stats['succeeded'] += 1
+            return True
+
+    #回数が残っていれば指数的に待ってから再実行する
+    def finish_failed(self, job, error):
+        job = self.db.session.get(self.model, job.id)
+        job.error = '%s: %s' % (type(error).__name__, error)
+        if isinstance(error, JobError) or job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.datetime.utcnow()
+            self.stats['failed'] += 1
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=min(2 ** job.attempts, self.max_backoff))
+            self.stats['retried'] += 1
+        self.db.session.commit()
+        if job.status == 'failed':
+            logger.warning('job %d (%s) failed: %s', job.id, job.kind, job.error)
+
+    def work_loop(self):
+        while True:
+            try:
+                if self.run_one():
+                    continue
+            except Exception:
+                logger.exception('job worker error')
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+
+    #ジョブ専用のプロセスとして動かす(flask run-jobs)
+    def run_forever(self):
+        self.start()
+        while True:
+            time.sleep(3600)
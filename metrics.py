@@ -0,0 +1,70 @@
+import threading
+
+#レイテンシのヒストグラムの区切り(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.sum += value
+
+#エンドポイントごとのリクエスト数・レイテンシ・SQL回数/時間・レスポンスサイズを集計する
+class RequestMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.requests = {}
+        self.sql_queries = {}
+        self.sql_seconds = {}
+        self.response_bytes = {}
+
+    def observe(self, endpoint, method, status, seconds, sql_queries, sql_seconds, response_bytes):
+        key = (endpoint, method)
+        with self.lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram(self.buckets)
+            self.latency[key].observe(seconds)
+            status_key = (endpoint, method, status)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.sql_queries[key] = self.sql_queries.get(key, 0) + sql_queries
+            self.sql_seconds[key] = self.sql_seconds.get(key, 0.0) + sql_seconds
+            self.response_bytes[key] = self.response_bytes.get(key, 0) + (response_bytes or 0)
+
+    #Prometheusのテキスト形式で出力。gaugesは(名前, 値)の一覧
+    def render(self, gauges=()):
+        lines = []
+        with self.lock:
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), value in sorted(self.requests.items()):
+                lines.append('http_requests_total{endpoint="%s",method="%s",status="%d"} %d' % (endpoint, method, status, value))
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (endpoint, method), histogram in sorted(self.latency.items()):
+                labels = 'endpoint="%s",method="%s"' % (endpoint, method)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('http_request_duration_seconds_bucket{%s,le="%g"} %d' % (labels, bound, cumulative))
+                lines.append('http_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, histogram.total))
+                lines.append('http_request_duration_seconds_sum{%s} %f' % (labels, histogram.sum))
+                lines.append('http_request_duration_seconds_count{%s} %d' % (labels, histogram.total))
+            for name, values, kind, fmt in (('sql_queries_total', self.sql_queries, 'counter', '%d'),
+                                            ('sql_duration_seconds_total', self.sql_seconds, 'counter', '%f'),
+                                            ('http_response_bytes_total', self.response_bytes, 'counter', '%d')):
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (endpoint, method), value in sorted(values.items()):
+                    lines.append(('%s{endpoint="%s",method="%s"} ' + fmt) % (name, endpoint, method, value))
+        for name, value in gauges:
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %g' % (name, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,44 @@
+"""外部キーと検索条件にインデックス追加
+
+Revision ID: 2e7b5c90d1a8
+Revises: 9c1f3a7d2b64
+Create Date: 2024-02-18 16:05:12.402733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e7b5c90d1a8'
+down_revision = '9c1f3a7d2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_point_user_id'), ['user_id'], unique=False)
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_route_end_point_id'), ['end_point_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_route_start_point_id'), ['start_point_id'], unique=False)
+        batch_op.create_index('ix_route_user_id_favorited', ['user_id', 'favorited'], unique=False)
+
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_waypoint_route_id'), ['route_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_waypoint_waypoint_id'), ['waypoint_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_waypoint_waypoint_id'))
+        batch_op.drop_index(batch_op.f('ix_waypoint_route_id'))
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.drop_index('ix_route_user_id_favorited')
+        batch_op.drop_index(batch_op.f('ix_route_start_point_id'))
+        batch_op.drop_index(batch_op.f('ix_route_end_point_id'))
+
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_point_user_id'))
@@ -0,0 +1,55 @@
+"""経由地の順番と経路のversion追加
+
+Revision ID: 3e8c0b6f29d4
+Revises: 7b1d5e93a4c6
+Create Date: 2024-02-22 14:05:51.316874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8c0b6f29d4'
+down_revision = '7b1d5e93a4c6'
+branch_labels = None
+depends_on = None
+
+
+waypoint = sa.table('waypoint', sa.column('id', sa.Integer), sa.column('route_id', sa.Integer),
+                    sa.column('position', sa.Integer))
+
+
+def upgrade():
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('position', sa.Integer(), nullable=True))
+
+    # これまでの並び順(id順)を経路ごとに0から振り直す
+    connection = op.get_bind()
+    positions = {}
+    updates = []
+    for row in connection.execute(sa.select(waypoint.c.id, waypoint.c.route_id).order_by(waypoint.c.route_id, waypoint.c.id)):
+        position = positions.get(row.route_id, 0)
+        positions[row.route_id] = position + 1
+        updates.append({'waypoint_id': row.id, 'position': position})
+    if updates:
+        connection.execute(waypoint.update().where(waypoint.c.id == sa.bindparam('waypoint_id')).values(
+            position=sa.bindparam('position')), updates)
+
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.alter_column('position', existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_index('ix_waypoint_route_id')
+        batch_op.create_index('ix_waypoint_route_id_position', ['route_id', 'position'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.drop_index('ix_waypoint_route_id_position')
+        batch_op.create_index('ix_waypoint_route_id', ['route_id'], unique=False)
+        batch_op.drop_column('position')
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.drop_column('version')
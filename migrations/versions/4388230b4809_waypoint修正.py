@@ -18,17 +18,19 @@ depends_on = None
 
 def upgrade():
     # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_table('_alembic_tmp_point')
+    op.execute('DROP TABLE IF EXISTS _alembic_tmp_point')
     with op.batch_alter_table('point', schema=None) as batch_op:
         batch_op.add_column(sa.Column('address', sa.String(length=140), nullable=False))
         batch_op.alter_column('latitude',
                existing_type=sa.VARCHAR(length=140),
-               type_=sa.Float(precision=140),
-               existing_nullable=False)
+               type_=sa.Float(),
+               existing_nullable=False,
+               postgresql_using='latitude::double precision')
         batch_op.alter_column('longitude',
                existing_type=sa.VARCHAR(length=140),
-               type_=sa.Float(precision=140),
-               existing_nullable=False)
+               type_=sa.Float(),
+               existing_nullable=False,
+               postgresql_using='longitude::double precision')
         batch_op.drop_column('adress')
 
     with op.batch_alter_table('route', schema=None) as batch_op:
@@ -67,11 +69,11 @@ def downgrade():
     with op.batch_alter_table('point', schema=None) as batch_op:
         batch_op.add_column(sa.Column('adress', sa.VARCHAR(length=140), nullable=False))
         batch_op.alter_column('longitude',
-               existing_type=sa.Float(precision=140),
+               existing_type=sa.Float(),
                type_=sa.VARCHAR(length=140),
                existing_nullable=False)
         batch_op.alter_column('latitude',
-               existing_type=sa.Float(precision=140),
+               existing_type=sa.Float(),
                type_=sa.VARCHAR(length=140),
                existing_nullable=False)
         batch_op.drop_column('address')
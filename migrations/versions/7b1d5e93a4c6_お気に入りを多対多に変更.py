@@ -0,0 +1,75 @@
+"""お気に入りを多対多に変更
+
+Revision ID: 7b1d5e93a4c6
+Revises: f6a2c8e15b37
+Create Date: 2024-02-21 10:42:19.583027
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b1d5e93a4c6'
+down_revision = 'f6a2c8e15b37'
+branch_labels = None
+depends_on = None
+
+
+route = sa.table('route', sa.column('id', sa.Integer), sa.column('user_id', sa.Integer),
+                 sa.column('favorited', sa.Boolean), sa.column('favorite_count', sa.Integer))
+route_favorite = sa.table('route_favorite', sa.column('user_id', sa.Integer), sa.column('route_id', sa.Integer),
+                          sa.column('created_at', sa.DateTime))
+
+
+def upgrade():
+    op.create_table('route_favorite',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('route_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['route_id'], ['route.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'route_id')
+    )
+    with op.batch_alter_table('route_favorite', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_route_favorite_route_id'), ['route_id'], unique=False)
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('favorite_count', sa.Integer(), server_default='0', nullable=False))
+
+    # これまでのお気に入り(favorited)は経路の持ち主のお気に入りとして移す
+    connection = op.get_bind()
+    connection.execute(route_favorite.insert().from_select(
+        ['user_id', 'route_id', 'created_at'],
+        sa.select(route.c.user_id, route.c.id, sa.literal(datetime.datetime.utcnow(), sa.DateTime)).where(
+            route.c.favorited == sa.true())))
+    connection.execute(route.update().where(route.c.favorited == sa.true()).values(favorite_count=1))
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.drop_index('ix_route_user_id_favorited')
+        batch_op.drop_column('favorited')
+        batch_op.create_index(batch_op.f('ix_route_user_id'), ['user_id'], unique=False)
+        batch_op.create_index('ix_route_favorite_count', ['favorite_count', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('favorited', sa.BOOLEAN(), nullable=True))
+
+    # 持ち主自身のお気に入りだけをfavoritedに戻す(他のユーザーのお気に入りは表現できないので失われる)
+    connection = op.get_bind()
+    connection.execute(route.update().values(favorited=sa.exists().where(
+        route_favorite.c.route_id == route.c.id, route_favorite.c.user_id == route.c.user_id)))
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.drop_index('ix_route_favorite_count')
+        batch_op.drop_index(batch_op.f('ix_route_user_id'))
+        batch_op.drop_column('favorite_count')
+        batch_op.create_index('ix_route_user_id_favorited', ['user_id', 'favorited'], unique=False)
+
+    with op.batch_alter_table('route_favorite', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_route_favorite_route_id'))
+
+    op.drop_table('route_favorite')
@@ -0,0 +1,37 @@
+"""pointに空間インデックス追加
+
+Revision ID: 9c1f3a7d2b64
+Revises: 4388230b4809
+Create Date: 2024-02-18 13:20:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c1f3a7d2b64'
+down_revision = '4388230b4809'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('grid_cell', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_point_user_id_grid_cell', ['user_id', 'grid_cell'], unique=False)
+
+    # 既存の住所にもグリッド番号を付与する(app.pyのgrid_cellと同じ計算)
+    point = sa.table('point', sa.column('id', sa.Integer), sa.column('latitude', sa.Float),
+                     sa.column('longitude', sa.Float), sa.column('grid_cell', sa.Integer))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(point.c.id, point.c.latitude, point.c.longitude)).fetchall()
+    for row in rows:
+        cell = int((row.latitude + 90) / 0.01) * 36000 + int((row.longitude + 180) / 0.01)
+        connection.execute(point.update().where(point.c.id == row.id).values(grid_cell=cell))
+
+
+def downgrade():
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.drop_index('ix_point_user_id_grid_cell')
+        batch_op.drop_column('grid_cell')
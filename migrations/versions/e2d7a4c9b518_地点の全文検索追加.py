@@ -0,0 +1,58 @@
+"""地点の全文検索追加
+
+Revision ID: e2d7a4c9b518
+Revises: 8a4f6d2c1e95
+Create Date: 2024-02-27 11:42:18.905371
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2d7a4c9b518'
+down_revision = '8a4f6d2c1e95'
+branch_labels = None
+depends_on = None
+
+
+# app.pyのPOINT_SEARCH_DDLと同じ(FTS5はSQLiteのみ)
+POINT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE point_search USING fts5(owner, name, address, content='', tokenize='trigram')",
+    "CREATE TRIGGER point_search_insert AFTER INSERT ON point BEGIN "
+    "INSERT INTO point_search(rowid, owner, name, address) VALUES (new.id, '<' || new.user_id || '>', new.name, new.address); "
+    "END",
+    "CREATE TRIGGER point_search_delete AFTER DELETE ON point BEGIN "
+    "INSERT INTO point_search(point_search, rowid, owner, name, address) "
+    "VALUES ('delete', old.id, '<' || old.user_id || '>', old.name, old.address); "
+    "END",
+    "CREATE TRIGGER point_search_update AFTER UPDATE OF user_id, name, address ON point BEGIN "
+    "INSERT INTO point_search(point_search, rowid, owner, name, address) "
+    "VALUES ('delete', old.id, '<' || old.user_id || '>', old.name, old.address); "
+    "INSERT INTO point_search(rowid, owner, name, address) VALUES (new.id, '<' || new.user_id || '>', new.name, new.address); "
+    "END",
+]
+
+
+def upgrade():
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.create_index('ix_point_user_id_name', ['user_id', 'name'], unique=False)
+        batch_op.create_index('ix_point_user_id_address', ['user_id', 'address'], unique=False)
+
+    if op.get_bind().dialect.name == 'sqlite':
+        for statement in POINT_SEARCH_DDL:
+            op.execute(statement)
+        # 既存の地点を索引に入れる
+        op.execute("INSERT INTO point_search(rowid, owner, name, address) "
+                   "SELECT id, '<' || user_id || '>', name, address FROM point")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for trigger in ('point_search_insert', 'point_search_delete', 'point_search_update'):
+            op.execute('DROP TRIGGER IF EXISTS %s' % trigger)
+        op.execute('DROP TABLE IF EXISTS point_search')
+
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.drop_index('ix_point_user_id_address')
+        batch_op.drop_index('ix_point_user_id_name')
@@ -0,0 +1,98 @@
+"""pointの重複をまとめて文字列列を削除
+
+Revision ID: f6a2c8e15b37
+Revises: d41a9f07c3e2
+Create Date: 2024-02-20 11:27:35.904162
+
+"""
+import hashlib
+import os
+import re
+import shutil
+import unicodedata
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a2c8e15b37'
+down_revision = 'd41a9f07c3e2'
+branch_labels = None
+depends_on = None
+
+
+point = sa.table('point', sa.column('id', sa.Integer), sa.column('user_id', sa.Integer),
+                 sa.column('name', sa.String), sa.column('address', sa.String),
+                 sa.column('latitude', sa.Float), sa.column('longitude', sa.Float),
+                 sa.column('content_hash', sa.String))
+route = sa.table('route', sa.column('id', sa.Integer), sa.column('start_point_id', sa.Integer),
+                 sa.column('end_point_id', sa.Integer), sa.column('start_point', sa.String),
+                 sa.column('end_point', sa.String))
+waypoint = sa.table('waypoint', sa.column('id', sa.Integer), sa.column('waypoint_id', sa.Integer),
+                    sa.column('waypoint', sa.String))
+
+
+# app.pyのpoint_hashと同じ計算(マイグレーションはアプリのコードに依存させない)
+def point_hash(address, latitude, longitude):
+    address = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', address)).strip().lower()
+    content = '%s|%.6f|%.6f' % (address, latitude, longitude)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def upgrade():
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=40), nullable=True))
+
+    # 同じユーザーの同じ場所は一番小さいidのPointにまとめ、経路・経由地の参照を付け替える
+    connection = op.get_bind()
+    keep = {}
+    for row in connection.execute(sa.select(point.c.id, point.c.user_id, point.c.address,
+                                            point.c.latitude, point.c.longitude).order_by(point.c.id)):
+        content_hash = point_hash(row.address, row.latitude, row.longitude)
+        key = (row.user_id, content_hash)
+        if key not in keep:
+            keep[key] = row.id
+            connection.execute(point.update().where(point.c.id == row.id).values(content_hash=content_hash))
+            continue
+        keeper = keep[key]
+        connection.execute(route.update().where(route.c.start_point_id == row.id).values(start_point_id=keeper))
+        connection.execute(route.update().where(route.c.end_point_id == row.id).values(end_point_id=keeper))
+        connection.execute(waypoint.update().where(waypoint.c.waypoint_id == row.id).values(waypoint_id=keeper))
+        connection.execute(point.delete().where(point.c.id == row.id))
+
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.alter_column('content_hash', existing_type=sa.String(length=40), nullable=False)
+        batch_op.create_index('ix_point_user_id_content_hash', ['user_id', 'content_hash'], unique=True)
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.drop_column('end_point')
+        batch_op.drop_column('start_point')
+
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.drop_column('waypoint')
+
+    # 削除したPointが残らないよう、保存済みの距離行列は作り直させる
+    shutil.rmtree(os.environ.get('DISTANCE_MATRIX_DIR', os.path.join(current_app.instance_path, 'distance_matrix')),
+                  ignore_errors=True)
+
+
+def downgrade():
+    with op.batch_alter_table('waypoint', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('waypoint', sa.VARCHAR(length=128), nullable=False, server_default=''))
+
+    with op.batch_alter_table('route', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('start_point', sa.VARCHAR(length=128), nullable=False, server_default=''))
+        batch_op.add_column(sa.Column('end_point', sa.VARCHAR(length=128), nullable=False, server_default=''))
+
+    # 地点名から文字列の列を復元する
+    op.execute(route.update().values(
+        start_point=sa.select(point.c.name).where(point.c.id == route.c.start_point_id).scalar_subquery(),
+        end_point=sa.select(point.c.name).where(point.c.id == route.c.end_point_id).scalar_subquery()))
+    op.execute(waypoint.update().values(
+        waypoint=sa.select(point.c.name).where(point.c.id == waypoint.c.waypoint_id).scalar_subquery()))
+
+    with op.batch_alter_table('point', schema=None) as batch_op:
+        batch_op.drop_index('ix_point_user_id_content_hash')
+        batch_op.drop_column('content_hash')
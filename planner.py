@@ -0,0 +1,98 @@
+import time
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+#経由地がこの数以下なら全探索(Held-Karp)で最適解を求める
+EXACT_LIMIT = 9
+#2-optの打ち切り時間(秒)
+TWO_OPT_TIME_LIMIT = 0.03
+
+#全地点間の距離(メートル)を行列で計算
+def distance_matrix(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lng = np.radians(np.asarray(longitudes, dtype=np.float64))
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+#1地点から複数地点への距離(メートル)
+def distances_from(latitude, longitude, latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lng = np.radians(np.asarray(longitudes, dtype=np.float64))
+    lat0, lng0 = np.radians(latitude), np.radians(longitude)
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat) * np.sin((lng - lng0) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+#順番どおりに辿ったときの各区間の距離
+def leg_distances(matrix, path):
+    path = np.asarray(path)
+    return matrix[path[:-1], path[1:]]
+
+def path_length(matrix, path):
+    return float(leg_distances(matrix, path).sum())
+
+def nearest_neighbour(matrix):
+    last = len(matrix) - 1
+    path = [0]
+    unvisited = np.ones(len(matrix), dtype=bool)
+    unvisited[[0, last]] = False
+    for _ in range(last - 1):
+        distances = np.where(unvisited, matrix[path[-1]], np.inf)
+        nearest = int(np.argmin(distances))
+        path.append(nearest)
+        unvisited[nearest] = False
+    path.append(last)
+    return path
+
+#始点と終点を固定したまま区間を反転して短くする
+def two_opt(matrix, path, time_limit=TWO_OPT_TIME_LIMIT):
+    path = np.asarray(path)
+    deadline = time.perf_counter() + time_limit
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(1, len(path) - 2):
+            a, b = path[i - 1], path[i]
+            c, d = path[i + 1:-1], path[i + 2:]
+            delta = matrix[a, c] + matrix[b, d] - matrix[a, b] - matrix[c, d]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-9:
+                path[i:i + j + 2] = path[i:i + j + 2][::-1].copy()
+                improved = True
+    return path.tolist()
+
+#Held-Karpによる厳密解(始点0、終点は最後の地点)
+def exact(matrix):
+    last = len(matrix) - 1
+    n = last - 1
+    if n == 0:
+        return [0, last]
+    cost = {(1 << k, k): (matrix[0, k + 1], None) for k in range(n)}
+    for mask in range(1, 1 << n):
+        for k in range(n):
+            if not mask & (1 << k) or (mask, k) not in cost:
+                continue
+            base = cost[(mask, k)][0]
+            for nxt in range(n):
+                if mask & (1 << nxt):
+                    continue
+                state = (mask | (1 << nxt), nxt)
+                value = base + matrix[k + 1, nxt + 1]
+                if state not in cost or value < cost[state][0]:
+                    cost[state] = (value, k)
+    full = (1 << n) - 1
+    k = min(range(n), key=lambda k: cost[(full, k)][0] + matrix[k + 1, last])
+    order = []
+    mask = full
+    while k is not None:
+        order.append(k + 1)
+        mask, k = mask ^ (1 << k), cost[(mask, k)][1]
+    return [0] + order[::-1] + [last]
+
+#地点は[始点, 経由地..., 終点]の順。最適化した訪問順(インデックス)を返す
+def plan(matrix):
+    if len(matrix) - 2 <= EXACT_LIMIT:
+        return exact(matrix)
+    return two_opt(matrix, nearest_neighbour(matrix))
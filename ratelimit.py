@@ -0,0 +1,79 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+#トークンバケットの保存先。複数プロセス・サーバーで共有する場合(Redis等)はこのメソッドを実装する
+#takeはトークンを1つ取れれば0を、取れなければ次の1つが貯まるまでの秒数を返す
+class RateLimitBackend:
+    def take(self, key, rate, burst, now):
+        raise NotImplementedError
+
+#プロセス内のトークンバケット(キー数上限つき。追い出されたキーは満タンから数え直す)
+class MemoryRateLimitBackend(RateLimitBackend):
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self.buckets)
+
+#クライアント×エンドポイントの種類(読み取り・書き込み)ごとのレート制限。limitsは種類ごとの(毎秒の回数, バースト)で、回数0は制限なし
+class RateLimiter:
+    def __init__(self, backend, limits):
+        self.backend = backend
+        self.limits = limits
+        self.limited = 0
+
+    #制限を超えていればRetry-Afterに入れる秒数(1以上の整数)を、超えていなければ0を返す
+    def check(self, identity, kind):
+        rate, burst = self.limits.get(kind, (0, 0))
+        if not rate:
+            return 0
+        wait = self.backend.take('%s:%s' % (kind, identity), rate, max(burst, 1), time.time())
+        if not wait:
+            return 0
+        self.limited += 1
+        return max(1, math.ceil(wait))
+
+#プロセス内で同時に処理するリクエスト数の上限。空きが無ければtimeout秒だけ待ち、それでも空かなければ断る
+#(待ち行列を伸ばさずに早く503を返す)。limitが0なら制限なし
+class ConcurrencyGate:
+    def __init__(self, limit, timeout=0.0):
+        self.limit = limit
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(limit) if limit else None
+        self.lock = threading.Lock()
+        self.active = 0
+        self.rejected = 0
+
+    def acquire(self, timeout=None):
+        if self.semaphore is not None and not self.semaphore.acquire(timeout=self.timeout if timeout is None else timeout):
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.active += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        if self.semaphore is not None:
+            self.semaphore.release()
@@ -0,0 +1,352 @@
+import heapq
+import json
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+#道路種別ごとの速度(km/h)。maxspeedタグがあればそちらを使う
+SPEEDS = {
+    'motorway': 100, 'motorway_link': 60,
+    'trunk': 80, 'trunk_link': 50,
+    'primary': 60, 'primary_link': 40,
+    'secondary': 50, 'secondary_link': 40,
+    'tertiary': 40, 'tertiary_link': 30,
+    'unclassified': 30, 'residential': 30, 'living_street': 10, 'service': 20,
+}
+ONEWAY_HIGHWAYS = {'motorway', 'motorway_link'}
+#up_*: 各節点から順位が上の節点への辺、down_*: 順位が上の節点から各節点への辺(indicesは辺の始点)
+#*_middleはショートカット辺が飛ばした節点(元の道路の辺は-1)
+ARRAYS = ('latitude', 'longitude', 'kdtree', 'rank',
+          'up_indptr', 'up_indices', 'up_durations', 'up_distances', 'up_middle',
+          'down_indptr', 'down_indices', 'down_durations', 'down_distances', 'down_middle')
+#KD木の葉に残す最大の節点数(葉の中は全件で距離を計算する)
+LEAF_SIZE = 16
+#縮約時の迂回路(witness)探索で確定させる節点数の上限。小さいほど前処理は速いがショートカットが増える
+WITNESS_SETTLE_LIMIT = 200
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def parse_speed(value, default):
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(mph)?', value or '')
+    if not match:
+        return default
+    speed = float(match.group(1))
+    return speed * 1.609344 if match.group(2) else speed
+
+#OSMのXML(.osm)から車が通れる道を読み、(緯度, 経度)の配列と有向辺(始点, 終点, 速度km/h)を返す
+#PBFはosmium-tool等で先にXMLへ変換しておく(osmium cat city.osm.pbf -o city.osm)
+def read_osm(path):
+    coordinates = {}
+    ways = []
+    for _, element in ET.iterparse(path, events=('end',)):
+        if element.tag == 'node':
+            coordinates[int(element.get('id'))] = (float(element.get('lat')), float(element.get('lon')))
+        elif element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            highway = tags.get('highway')
+            if highway in SPEEDS and tags.get('access') not in ('no', 'private'):
+                refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+                oneway = tags.get('oneway')
+                if oneway is None and (highway in ONEWAY_HIGHWAYS or tags.get('junction') == 'roundabout'):
+                    oneway = 'yes'
+                if oneway == '-1':
+                    refs.reverse()
+                ways.append((refs, oneway in ('yes', 'true', '1', '-1'), parse_speed(tags.get('maxspeed'), SPEEDS[highway])))
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()
+    index = {}
+    sources, targets, speeds = [], [], []
+    for refs, oneway, speed in ways:
+        refs = [ref for ref in refs if ref in coordinates]
+        for a, b in zip(refs[:-1], refs[1:]):
+            a, b = index.setdefault(a, len(index)), index.setdefault(b, len(index))
+            sources.append(a)
+            targets.append(b)
+            speeds.append(speed)
+            if not oneway:
+                sources.append(b)
+                targets.append(a)
+                speeds.append(speed)
+    latitude = np.empty(len(index))
+    longitude = np.empty(len(index))
+    for node_id, i in index.items():
+        latitude[i], longitude[i] = coordinates[node_id]
+    return latitude, longitude, np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64), np.array(speeds)
+
+#最大の連結成分(向きを無視)だけを残す。孤立した道に吸着して経路が見つからないのを防ぐ
+def largest_component(n, sources, targets):
+    neighbours = [[] for _ in range(n)]
+    for a, b in zip(sources.tolist(), targets.tolist()):
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+    component = np.full(n, -1, dtype=np.int64)
+    sizes = []
+    for start in range(n):
+        if component[start] >= 0:
+            continue
+        label = len(sizes)
+        component[start] = label
+        stack = [start]
+        size = 0
+        while stack:
+            node = stack.pop()
+            size += 1
+            for neighbour in neighbours[node]:
+                if component[neighbour] < 0:
+                    component[neighbour] = label
+                    stack.append(neighbour)
+        sizes.append(size)
+    return component == int(np.argmax(sizes)) if sizes else np.zeros(n, dtype=bool)
+
+#KD木は節点の並べ替え(範囲の中央が分割点)だけで表し、木の形は範囲の二分で決まる
+def build_kdtree(x, y):
+    order = np.arange(len(x), dtype=np.int64)
+    stack = [(0, len(x), 0)]
+    while stack:
+        lo, hi, depth = stack.pop()
+        if hi - lo <= LEAF_SIZE:
+            continue
+        mid = (lo + hi) // 2
+        segment = order[lo:hi]
+        values = (x if depth % 2 == 0 else y)[segment]
+        order[lo:hi] = segment[np.argpartition(values, mid - lo)]
+        stack.append((lo, mid, depth + 1))
+        stack.append((mid + 1, hi, depth + 1))
+    return order
+
+#縮約した節点を通らずにsourceからlimit以内で行ける節点までの所要時間(targetsが全部確定したら打ち切る)
+def witness_search(out_edges, source, excluded, targets, limit):
+    durations = {source: 0.0}
+    queue = [(0.0, source)]
+    remaining = len(targets)
+    settled = 0
+    while queue and settled < WITNESS_SETTLE_LIMIT and remaining:
+        duration, node = heapq.heappop(queue)
+        if duration > limit:
+            break
+        if duration > durations[node]:
+            continue
+        settled += 1
+        if node in targets:
+            remaining -= 1
+        for neighbour, (weight, _, _) in out_edges[node].items():
+            candidate = duration + weight
+            if candidate < durations.get(neighbour, limit) and neighbour != excluded:
+                durations[neighbour] = candidate
+                heapq.heappush(queue, (candidate, neighbour))
+    return durations
+
+#nodeを取り除くときに必要なショートカット(迂回路がnodeを通る経路より遅いもの)
+def shortcuts(out_edges, in_edges, node):
+    result = []
+    for source, (weight, distance, _) in in_edges[node].items():
+        targets = [(target, weight + w, distance + d) for target, (w, d, _) in out_edges[node].items() if target != source]
+        if not targets:
+            continue
+        witnesses = witness_search(out_edges, source, node, {target for target, _, _ in targets},
+                                   max(w for _, w, _ in targets))
+        result.extend((source, target, w, d) for target, w, d in targets if witnesses.get(target, float('inf')) > w)
+    return result
+
+#縮約階層(Contraction Hierarchies)の前処理。ショートカットの増減が少ない節点から順に取り除き、
+#取り除いた時点で残っている節点との辺(ショートカットを含む)を、順位が上の節点への辺として残す
+def contract(n, sources, targets, durations, distances):
+    out_edges = [{} for _ in range(n)]
+    in_edges = [{} for _ in range(n)]
+    for a, b, duration, distance in zip(sources.tolist(), targets.tolist(), durations.tolist(), distances.tolist()):
+        if b not in out_edges[a] or duration < out_edges[a][b][0]:
+            out_edges[a][b] = in_edges[b][a] = (duration, distance, -1)
+    deleted = [0] * n
+    #増えるショートカットを重く見て、取り除いた隣の数で縮約する場所を散らす
+    def priority(node, added):
+        return 2 * len(added) - len(in_edges[node]) - len(out_edges[node]) + deleted[node]
+    queue = [(priority(node, shortcuts(out_edges, in_edges, node)), node) for node in range(n)]
+    heapq.heapify(queue)
+    rank = np.empty(n, dtype=np.int64)
+    order = 0
+    while queue:
+        _, node = heapq.heappop(queue)
+        added = shortcuts(out_edges, in_edges, node)
+        #取り除く直前に優先度を計算し直し、次の候補より悪くなっていれば後回しにする(lazy update)
+        current = priority(node, added)
+        if queue and current > queue[0][0]:
+            heapq.heappush(queue, (current, node))
+            continue
+        for source, target, duration, distance in added:
+            if target not in out_edges[source] or duration < out_edges[source][target][0]:
+                out_edges[source][target] = in_edges[target][source] = (duration, distance, node)
+        for target in out_edges[node]:
+            del in_edges[target][node]
+            deleted[target] += 1
+        for source in in_edges[node]:
+            del out_edges[source][node]
+            deleted[source] += 1
+        rank[node] = order
+        order += 1
+    return rank, out_edges, in_edges
+
+def to_csr(edges):
+    indptr = np.zeros(len(edges) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(e) for e in edges])
+    items = [(neighbour,) + value for e in edges for neighbour, value in e.items()]
+    neighbours, durations, distances, middles = zip(*items) if items else ((), (), (), ())
+    return (indptr, np.array(neighbours, dtype=np.int32), np.array(durations, dtype=np.float32),
+            np.array(distances, dtype=np.float32), np.array(middles, dtype=np.int32))
+
+#緯度経度の配列と有向辺(速度km/h)から、最大の連結成分だけを縮約階層にして保存用の配列を作る
+def build(latitude, longitude, sources, targets, speeds):
+    keep = largest_component(len(latitude), sources, targets)
+    renumber = np.cumsum(keep) - 1
+    edges = keep[sources] & keep[targets] & (sources != targets)
+    sources, targets, speeds = renumber[sources[edges]], renumber[targets[edges]], speeds[edges]
+    latitude, longitude = latitude[keep], longitude[keep]
+    distances = haversine(latitude[sources], longitude[sources], latitude[targets], longitude[targets])
+    rank, up, down = contract(len(latitude), sources, targets, distances / (speeds / 3.6), distances)
+    cos_latitude = math.cos(math.radians(float(latitude.mean()))) if len(latitude) else 1.0
+    graph = {'latitude': latitude, 'longitude': longitude, 'rank': rank,
+             'kdtree': build_kdtree(longitude * cos_latitude, latitude)}
+    for prefix, edges in (('up_', up), ('down_', down)):
+        graph.update(zip((prefix + name for name in ('indptr', 'indices', 'durations', 'distances', 'middle')),
+                         to_csr(edges)))
+    graph['meta'] = {'nodes': len(latitude), 'edges': int(len(sources)),
+                     'shortcuts': int((graph['up_middle'] >= 0).sum() + (graph['down_middle'] >= 0).sum()),
+                     'cos_latitude': cos_latitude}
+    return graph
+
+#別ファイルに書いてから置き換える(開いているワーカーのmemmapは古いファイルのまま読める)
+#meta.jsonを最後に置き換えるので、読み込み側はその更新で新しいグラフに切り替える
+def save(graph, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in ARRAYS:
+        path = os.path.join(directory, name + '.npy')
+        np.save(path + '.tmp.npy', graph[name])
+        os.replace(path + '.tmp.npy', path)
+    with open(os.path.join(directory, 'meta.json.tmp'), 'w') as f:
+        json.dump(graph['meta'], f)
+    os.replace(os.path.join(directory, 'meta.json.tmp'), os.path.join(directory, 'meta.json'))
+
+#保存したグラフをmemmapで開く(ワーカーは配列を読み込まずに起動でき、ページはOSが共有する)
+class RoadGraph:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+        self.cos_latitude = meta['cos_latitude']
+        self.nodes = meta['nodes']
+
+    #一番近い節点(KD木の探索。平面近似なので都市規模のグラフ向け)
+    def nearest(self, latitude, longitude):
+        point = (longitude * self.cos_latitude, latitude)
+        best, best_node = float('inf'), -1
+        stack = [(0, self.nodes, 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if bound >= best:
+                continue
+            if hi - lo <= LEAF_SIZE:
+                candidates = np.asarray(self.kdtree[lo:hi])
+                d = ((self.longitude[candidates] * self.cos_latitude - point[0]) ** 2
+                     + (self.latitude[candidates] - point[1]) ** 2)
+                i = int(np.argmin(d))
+                if d[i] < best:
+                    best, best_node = float(d[i]), int(candidates[i])
+                continue
+            mid = (lo + hi) // 2
+            node = int(self.kdtree[mid])
+            x, y = float(self.longitude[node]) * self.cos_latitude, float(self.latitude[node])
+            d = (x - point[0]) ** 2 + (y - point[1]) ** 2
+            if d < best:
+                best, best_node = d, node
+            diff = point[0] - x if depth % 2 == 0 else point[1] - y
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            stack.append((far[0], far[1], depth + 1, diff * diff))
+            stack.append((near[0], near[1], depth + 1, 0.0))
+        return best_node
+
+    #所要時間が最短の経路を縮約階層で探す。source側は順位が上がる辺、target側は順位が上から降りてくる辺を
+    #交互に広げ、両側から届いた節点のうち合計が最小のものを経路の頂点とする
+    #(距離m, 所要時間秒, 節点の一覧)を返し、到達できなければNone
+    def shortest_path(self, source, target):
+        #(広げる辺, 打ち切りの判定に使う逆向きの辺)
+        searches = ((self.up_indptr, self.up_indices, self.up_durations,
+                     self.down_indptr, self.down_indices, self.down_durations),
+                    (self.down_indptr, self.down_indices, self.down_durations,
+                     self.up_indptr, self.up_indices, self.up_durations))
+        tentative = ({source: 0.0}, {target: 0.0})
+        parents = ({source: (-1, -1)}, {target: (-1, -1)})
+        queues = ([(0.0, source)], [(0.0, target)])
+        settled = (set(), set())
+        best, meeting = (0.0, source) if source == target else (float('inf'), -1)
+        while queues[0] or queues[1]:
+            for side in (0, 1):
+                queue, distances, other = queues[side], tentative[side], tentative[1 - side]
+                if queue and queue[0][0] >= best:
+                    queue.clear()
+                if not queue:
+                    continue
+                duration, node = heapq.heappop(queue)
+                if node in settled[side]:
+                    continue
+                settled[side].add(node)
+                indptr, indices, durations, reverse_indptr, reverse_indices, reverse_durations = searches[side]
+                #順位が上の節点からもっと早く来られるなら、ここから先は最短経路にならない(stall-on-demand)
+                start, end = int(reverse_indptr[node]), int(reverse_indptr[node + 1])
+                if any(distances.get(neighbour, duration) + weight < duration for neighbour, weight in
+                       zip(reverse_indices[start:end].tolist(), reverse_durations[start:end].tolist())):
+                    continue
+                start, end = int(indptr[node]), int(indptr[node + 1])
+                for edge, (neighbour, weight) in enumerate(zip(indices[start:end].tolist(),
+                                                               durations[start:end].tolist()), start):
+                    candidate = duration + weight
+                    if candidate < distances.get(neighbour, float('inf')):
+                        distances[neighbour] = candidate
+                        parents[side][neighbour] = (node, edge)
+                        heapq.heappush(queue, (candidate, neighbour))
+                        if neighbour in other and candidate + other[neighbour] < best:
+                            best, meeting = candidate + other[neighbour], neighbour
+        if meeting < 0:
+            return None
+        #頂点から両端へ辿り、ショートカット辺を元の道路の辺に展開する
+        edges = []
+        node = meeting
+        while parents[0][node][0] >= 0:
+            parent, edge = parents[0][node]
+            edges.append(('up', edge, parent, node))
+            node = parent
+        edges.reverse()
+        node = meeting
+        while parents[1][node][0] >= 0:
+            parent, edge = parents[1][node]
+            edges.append(('down', edge, node, parent))
+            node = parent
+        distance = sum(float(getattr(self, side + '_distances')[edge]) for side, edge, _, _ in edges)
+        path = [source]
+        stack = [(a, b, int(getattr(self, side + '_middle')[edge])) for side, edge, a, b in reversed(edges)]
+        while stack:
+            a, b, middle = stack.pop()
+            if middle < 0:
+                path.append(b)
+            else:
+                stack.append((middle, b, self.middle(middle, b)))
+                stack.append((a, middle, self.middle(a, middle)))
+        return distance, best, path
+
+    #辺a→bのショートカットが飛ばした節点(元の道路の辺なら-1)。辺は順位が低い方の節点に入っている
+    def middle(self, a, b):
+        if self.rank[a] < self.rank[b]:
+            start, end = int(self.up_indptr[a]), int(self.up_indptr[a + 1])
+            return int(self.up_middle[start + self.up_indices[start:end].tolist().index(b)])
+        start, end = int(self.down_indptr[b]), int(self.down_indptr[b + 1])
+        return int(self.down_middle[start + self.down_indices[start:end].tolist().index(a)])
+
+    def coordinates(self, nodes):
+        return [[float(longitude), float(latitude)] for latitude, longitude in
+                zip(self.latitude[nodes], self.longitude[nodes])]
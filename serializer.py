@@ -0,0 +1,37 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#日時はFlaskの既定と同じ形式にするためdefaultに回す。dictのキーは数値も許す(標準のjsonと同じ)
+ORJSON_OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+#jsonify・app.json.dumpsの書き出し。orjsonがあればそれを使い、無ければ(または扱えない値なら)標準のjsonにする
+#orjsonはキーを並べ替えず、日本語も\uエスケープせずUTF-8のまま書く
+class JSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def dumps_bytes(self, obj):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS)
+            except TypeError:
+                pass
+        return super().dumps(obj).encode('utf-8')
+
+    #改行区切りのJSON(ndjson)をまとめて書き出す
+    def dumps_lines(self, objs):
+        return b''.join(self.dumps_bytes(obj) + b'\n' for obj in objs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+#列だけを読んだ行(ORMのオブジェクトを作らない)をそのまま辞書にする。キーはselectした列の名前
+def record(row):
+    return dict(zip(row._fields, row))
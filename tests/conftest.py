@@ -0,0 +1,73 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import event
+
+#appはimport時に環境変数から設定を読むので、先に一時ディレクトリのDB等を指定する
+directory = tempfile.mkdtemp(prefix='tests-')
+atexit.register(shutil.rmtree, directory, True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'test.db')
+os.environ['DISTANCE_MATRIX_DIR'] = os.path.join(directory, 'distance_matrix')
+os.environ['ROAD_GRAPH_DIR'] = os.path.join(directory, 'road_graph')
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+os.environ['RATE_LIMIT_READ_RATE'] = '0'
+os.environ['RATE_LIMIT_WRITE_RATE'] = '0'
+os.environ['METRICS_TOKEN'] = 'test-metrics-token'
+
+import app as app_module
+from cache import MemoryCache
+
+PASSWORD = 'test-password'
+
+#テストごとにテーブルとキャッシュを作り直す。gはアプリケーションコンテキストごとなので、
+#テスト中はコンテキストを残さない(残すとログイン中のユーザーがクライアントの間で共有される)
+@pytest.fixture
+def app():
+    with app_module.app.app_context():
+        app_module.db.create_all()
+    app_module.response_cache.backend = MemoryCache()
+    app_module.user_cache.entries.clear()
+    yield app_module
+    with app_module.app.app_context():
+        app_module.db.session.remove()
+        app_module.db.drop_all()
+    shutil.rmtree(os.environ['DISTANCE_MATRIX_DIR'], ignore_errors=True)
+
+def login(app, username):
+    client = app.app.test_client()
+    user = client.post('/users', json={'username': username, 'password': PASSWORD}).get_json()
+    assert client.post('/login', json={'username': username, 'password': PASSWORD}).status_code == 200
+    return client, user['id']
+
+@pytest.fixture
+def client(app):
+    return login(app, 'alice')
+
+#ブロック内で実行されたSQLの文を集める
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __len__(self):
+        return len(self.statements)
+
+@pytest.fixture
+def queries(app):
+    with app.app.app_context():
+        engine = app.db.engine
+    return lambda: QueryCounter(engine)
@@ -0,0 +1,58 @@
+import asyncio
+
+import httpx
+import pytest
+
+from tests.conftest import PASSWORD
+from tests.test_queries import route_item
+
+#ASGIの非同期の読み取りがFlask側と同じ本文・同じETag(レスポンスキャッシュを共有)を返すことを確かめる
+
+@pytest.fixture
+def asgi(app):
+    import asgi
+    return asgi
+
+def run(asgi, scenario):
+    async def main():
+        transport = httpx.ASGITransport(app=asgi.application)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url='http://localhost') as client:
+                await client.post('/users', json={'username': 'alice', 'password': PASSWORD})
+                assert (await client.post('/login', json={'username': 'alice', 'password': PASSWORD})).status_code == 200
+                return await scenario(client)
+        finally:
+            await asgi.engine.dispose()
+    return asyncio.run(main())
+
+def test_get_route_matches_flask(app, asgi):
+    async def scenario(client):
+        response = await client.post('/routes/bulk', json=[route_item(0, 3)])
+        route_id = response.json()['created'][0]['route_id']
+        async_response = await client.get('/routes/%d' % route_id)
+        with app.app.test_request_context():
+            route = app.load_route(route_id)
+            expected = app.route_to_dict(route, route.start_location, route.end_location,
+                                         [(wp.id, wp.way_location) for wp in route.waypoints])
+        return async_response, expected
+    response, expected = run(asgi, scenario)
+    assert response.status_code == 200
+    assert response.json() == expected
+
+def test_get_route_etag_and_shared_cache(app, asgi):
+    async def scenario(client):
+        response = await client.post('/routes/bulk', json=[route_item(0, 1)])
+        route_id = response.json()['created'][0]['route_id']
+        first = await client.get('/routes/%d' % route_id)
+        not_modified = await client.get('/routes/%d' % route_id, headers={'If-None-Match': first.headers['ETag']})
+        return route_id, first, not_modified
+    route_id, first, not_modified = run(asgi, scenario)
+    assert first.status_code == 200
+    assert not_modified.status_code == 304
+    assert not_modified.content == b''
+    #同じキャッシュのエントリなのでFlaskの応答も同じETag・同じ本文になる
+    client = app.app.test_client()
+    client.post('/login', json={'username': 'alice', 'password': PASSWORD})
+    response = client.get('/routes/%d' % route_id)
+    assert response.headers['ETag'] == first.headers['ETag']
+    assert response.data == first.content
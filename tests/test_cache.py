@@ -0,0 +1,19 @@
+from cache import MemoryCache, ResponseCache
+
+def test_generation_counters_are_bounded():
+    cache = ResponseCache(MemoryCache(max_size=3))
+    for index in range(100):
+        cache.invalidate('user:%d' % index)
+    assert len(cache.backend.counters) == 3
+
+#世代番号を追い出しても、無効化する前のキャッシュは読めない
+def test_evicted_generation_does_not_revive_stale_entries():
+    cache = ResponseCache(MemoryCache(max_size=3))
+    cache.set(cache.key('points:1', '/points?'), 'stale')
+    cache.invalidate('points:1')
+    for index in range(2, 10):
+        cache.invalidate('points:%d' % index)
+    assert 'generation:points:1' not in cache.backend.counters
+    assert cache.get(cache.key('points:1', '/points?')) is None
+    cache.set(cache.key('points:1', '/points?'), 'fresh')
+    assert cache.get(cache.key('points:1', '/points?')) == 'fresh'
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+import planner
+from distance_matrix import DistanceMatrixStore
+
+#距離行列は最初のgetで作り、地点がmax_pointsを超えるユーザーは行列を持たない
+
+ROWS = [(1, 35.60, 139.70), (2, 35.61, 139.72), (3, 35.65, 139.75)]
+
+def loader(rows, calls=None):
+    def load(point_ids=None):
+        if calls is not None:
+            calls.append(point_ids)
+        return [row for row in rows if point_ids is None or row[0] in point_ids]
+    return load
+
+def expected(rows):
+    return planner.distance_matrix([row[1] for row in rows], [row[2] for row in rows])
+
+#行列が無ければ追加・削除はDBを読まず何もしない
+def test_add_and_remove_without_matrix_do_nothing(tmp_path):
+    store = DistanceMatrixStore(str(tmp_path), 10)
+    store.add(1, ROWS[:1])
+    store.remove(1, 1)
+    assert not os.path.exists(store._path(1, 'matrix.npy'))
+
+#最初のgetで作り、以降の追加・削除は差分で反映する
+def test_get_builds_lazily_and_tracks_changes(tmp_path):
+    store = DistanceMatrixStore(str(tmp_path), 10)
+    rows = list(ROWS[:2])
+    ids, matrix = store.get(1, loader(rows))
+    assert ids.tolist() == [1, 2]
+    np.testing.assert_allclose(matrix, expected(rows), rtol=1e-5)
+    rows.append(ROWS[2])
+    store.add(1, ROWS[2:])
+    calls = []
+    ids, matrix = store.get(1, loader(rows, calls), [3, 1])
+    assert calls == []
+    np.testing.assert_allclose(matrix, expected([ROWS[2], ROWS[0]]), rtol=1e-5)
+    store.remove(1, 2)
+    assert store.get(1, loader(rows), [2]) is None
+
+#上限を超えると行列を持たず、指定した地点だけで計算する
+def test_users_over_the_limit_keep_no_matrix(tmp_path):
+    store = DistanceMatrixStore(str(tmp_path), 2)
+    rows = list(ROWS[:2])
+    store.get(1, loader(rows))
+    rows.append(ROWS[2])
+    store.add(1, ROWS[2:])
+    assert not os.path.exists(store._path(1, 'matrix.npy'))
+    calls = []
+    ids, matrix = store.get(1, loader(rows, calls), [3, 2])
+    assert calls == [[3, 2]]
+    np.testing.assert_allclose(matrix, expected([ROWS[2], ROWS[1]]), rtol=1e-5)
+    assert store.get(1, loader(rows)) is None
+    #地点が減ったら次のgetで作り直す
+    store.remove(1, 3)
+    rows.pop()
+    ids, matrix = store.get(1, loader(rows))
+    assert ids.tolist() == [1, 2]
+    assert os.path.exists(store._path(1, 'matrix.npy'))
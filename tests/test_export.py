@@ -0,0 +1,20 @@
+import json
+
+from tests.test_queries import create_routes, route_item
+
+#GeoJSONのエクスポートはapp.jsonの書き出しを通す(1件でも一括でも同じ形)
+
+def test_export_uses_app_json(app, client, monkeypatch):
+    client, _ = client
+    route_id, = create_routes(client, [route_item(0, 2)])
+    calls = []
+    dumps = app.app.json.dumps
+    monkeypatch.setattr(app.app.json, 'dumps', lambda obj, **kwargs: calls.append(obj) or dumps(obj, **kwargs))
+    single = client.get('/routes/%d/export?format=geojson' % route_id)
+    bulk = client.get('/routes/export?format=geojson')
+    assert single.status_code == bulk.status_code == 200
+    feature = json.loads(single.data)
+    assert json.loads(bulk.data)['features'] == [feature]
+    features = [call for call in calls if isinstance(call, dict) and call.get('type') == 'Feature']
+    assert [feature['properties']['id'] for feature in features] == [route_id, route_id]
+    assert feature['properties']['names'][0] == 's0'
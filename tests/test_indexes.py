@@ -0,0 +1,45 @@
+#一覧・削除で使う条件がインデックスで引かれる(テーブルを全件走査しない)ことをEXPLAIN QUERY PLANで確かめる
+import pytest
+from sqlalchemy import text
+
+@pytest.fixture(autouse=True)
+def context(app):
+    with app.app.app_context():
+        yield
+
+def query_plan(app, query):
+    statement = query.statement.compile(app.db.engine, compile_kwargs={'literal_binds': True})
+    return [row.detail for row in app.db.session.execute(text('EXPLAIN QUERY PLAN %s' % statement))]
+
+def searches(plan, table):
+    return [detail for detail in plan if detail.startswith('SEARCH %s ' % table) and ' USING ' in detail]
+
+@pytest.mark.parametrize('table, make_query', [
+    ('point', lambda app: app.db.session.query(app.Point.id).filter(app.Point.user_id == 1, app.Point.id > 0).order_by(app.Point.id)),
+    ('waypoint', lambda app: app.db.session.query(app.Waypoint.id).filter(app.Waypoint.route_id.in_([1, 2]))),
+    ('waypoint', lambda app: app.db.session.query(app.Waypoint.route_id).filter(app.Waypoint.waypoint_id == 1)),
+    ('route', lambda app: app.db.session.query(app.Route.id).filter(app.Route.start_point_id == 1)),
+    ('route', lambda app: app.db.session.query(app.Route.id).filter(app.Route.end_point_id == 1)),
+    ('route', lambda app: app.db.session.query(app.Route.id).filter(app.Route.user_id == 1)),
+    ('route_favorite', lambda app: app.db.session.query(app.RouteFavorite.route_id).filter(
+        app.RouteFavorite.user_id == 1, app.RouteFavorite.route_id > 0).order_by(app.RouteFavorite.route_id)),
+    ('route_favorite', lambda app: app.db.session.query(app.RouteFavorite.user_id).filter(app.RouteFavorite.route_id == 1)),
+])
+def test_filter_uses_index(app, table, make_query):
+    plan = query_plan(app, make_query(app))
+    assert searches(plan, table), plan
+    assert not any(detail.startswith('SCAN %s' % table) for detail in plan), plan
+
+def test_popular_routes_read_favorite_count_index(app):
+    query = app.db.session.query(app.Route.id).filter(app.Route.favorite_count > 0).order_by(
+        app.Route.favorite_count.desc(), app.Route.id.desc()).limit(10)
+    plan = query_plan(app, query)
+    assert any('ix_route_favorite_count' in detail for detail in plan), plan
+    assert not any('TEMP B-TREE' in detail for detail in plan), plan
+
+def test_points_list_does_not_sort(app):
+    query = app.db.session.query(app.Point.id, app.Point.name).filter(app.Point.user_id == 1, app.Point.id > 0).order_by(
+        app.Point.id).limit(100)
+    plan = query_plan(app, query)
+    assert searches(plan, 'point'), plan
+    assert not any('TEMP B-TREE' in detail for detail in plan), plan
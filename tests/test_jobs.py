@@ -0,0 +1,34 @@
+import datetime
+
+from sqlalchemy import event, update
+
+from tests.conftest import login
+
+#タイムアウトしたジョブを、候補として読んだ後に他のワーカーが取り出したら、このワーカーは取り出さない
+def test_timed_out_job_is_claimed_once(app):
+    _, user_id = login(app, 'alice')
+    queue, Job = app.job_queue, app.Job
+    long_ago = datetime.datetime.utcnow() - queue.timeout * 2
+    with app.app.app_context():
+        job = Job(user_id=user_id, kind='plan_route', payload='{}', status='running', attempts=1,
+                  run_at=long_ago, created_at=long_ago, started_at=long_ago)
+        app.db.session.add(job)
+        app.db.session.commit()
+        job_id = job.id
+        claimed_elsewhere = []
+
+        #このワーカーの条件付きUPDATEの直前に、他のワーカーが同じジョブを取り出す
+        def other_worker(orm_execute_state):
+            if orm_execute_state.is_update and not claimed_elsewhere:
+                claimed_elsewhere.append(True)
+                with app.db.engine.begin() as connection:
+                    connection.execute(update(Job).where(Job.id == job_id).values(
+                        started_at=datetime.datetime.utcnow(), attempts=Job.attempts + 1))
+
+        event.listen(app.db.session, 'do_orm_execute', other_worker)
+        try:
+            assert queue.claim() is None
+        finally:
+            event.remove(app.db.session, 'do_orm_execute', other_worker)
+        assert claimed_elsewhere
+        assert app.db.session.get(Job, job_id).attempts == 2
@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+AUTHORIZATION = {'Authorization': 'Bearer ' + os.environ['METRICS_TOKEN']}
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong'}])
+def test_metrics_requires_token(app, headers):
+    assert app.app.test_client().get('/metrics', headers=headers).status_code == 404
+
+def test_metrics_with_token(app):
+    response = app.app.test_client().get('/metrics', headers=AUTHORIZATION)
+    assert response.status_code == 200
+    assert b'http_requests_total' in response.data
+
+#トークンなしの?profile=1ではプロファイルを書き出さない
+def test_profile_requires_token(app, client, monkeypatch, tmp_path):
+    client, _ = client
+    monkeypatch.setattr(app, 'PROFILE_ON_REQUEST', True)
+    monkeypatch.setattr(app, 'PROFILE_DIR', str(tmp_path))
+    assert client.get('/points?profile=1').status_code == 200
+    assert list(tmp_path.iterdir()) == []
+    assert client.get('/points?profile=1', headers=AUTHORIZATION).status_code == 200
+    assert len(list(tmp_path.iterdir())) == 1
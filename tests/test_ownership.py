@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import pytest
+
+from tests.conftest import login
+
+#他のユーザーのデータを読んだり変更したりできないことを確かめる
+
+POINT = {'name': 'home', 'address': 'shared address', 'latitude': 35.6, 'longitude': 139.7}
+
+#本文のuser_idは無視し、同じ場所でも他のユーザーの地点は返さない
+def test_create_point_ignores_user_id_in_body(app):
+    alice, alice_id = login(app, 'alice')
+    bob, bob_id = login(app, 'bob')
+    alices = alice.post('/points', json=POINT).get_json()
+    response = bob.post('/points', json=dict(POINT, user_id=alice_id))
+    assert response.status_code == 201
+    assert response.get_json()['id'] != alices['id']
+    assert response.get_json()['user_id'] == bob_id
+    assert alice.post('/points', json=POINT).get_json()['id'] == alices['id']
+
+#ジョブは登録したユーザーの地点・経路にしか作用しない
+def test_jobs_only_touch_the_job_owners_rows(app):
+    alice, alice_id = login(app, 'alice')
+    _, bob_id = login(app, 'bob')
+    point_id = alice.post('/points', json=POINT).get_json()['id']
+    route_id = alice.post('/routes/bulk', json=[{'start_point': POINT, 'end_point': POINT}]).get_json()['created'][0]['route_id']
+    with app.app.app_context():
+        for handler, payload in ((app.delete_point_job, {'point_id': point_id}), (app.plan_route_job, {'route_id': route_id})):
+            with pytest.raises(app.JobError):
+                handler(payload, SimpleNamespace(user_id=bob_id))
+        assert app.db.session.get(app.Point, point_id) is not None
+        assert app.delete_point_job({'point_id': point_id}, SimpleNamespace(user_id=alice_id))['point_id'] == point_id
+
+#他のユーザーの経路は計画できない
+def test_plan_route_of_another_user_is_not_found(app):
+    alice, _ = login(app, 'alice')
+    bob, _ = login(app, 'bob')
+    route_id = alice.post('/routes/bulk', json=[{'start_point': POINT, 'end_point': POINT}]).get_json()['created'][0]['route_id']
+    assert bob.get('/routes/%d/plan' % route_id).status_code == 404
+    assert alice.get('/routes/%d/plan' % route_id).status_code == 200
+
+#他のユーザーの名前やパスワードは変更できない
+def test_update_another_user_is_forbidden(app):
+    alice, alice_id = login(app, 'alice')
+    bob, _ = login(app, 'bob')
+    assert bob.put('/users/%d' % alice_id, json={'username': 'mallory', 'password': 'x'}).status_code == 403
+    with app.app.app_context():
+        assert app.db.session.get(app.User, alice_id).username == 'alice'
+    assert alice.put('/users/%d' % alice_id, json={'username': 'alice2'}).status_code == 200
+
+#他のユーザーの経路はエクスポートできない
+def test_export_route_of_another_user_is_not_found(app):
+    alice, _ = login(app, 'alice')
+    bob, _ = login(app, 'bob')
+    route_id = alice.post('/routes/bulk', json=[{'start_point': POINT, 'end_point': POINT}]).get_json()['created'][0]['route_id']
+    assert bob.get('/routes/%d/export?format=geojson' % route_id).status_code == 404
+    assert alice.get('/routes/%d/export?format=geojson' % route_id).status_code == 200
+
+#他のユーザーの地点は変更も削除もできない
+def test_update_and_delete_point_of_another_user_are_not_found(app):
+    alice, _ = login(app, 'alice')
+    bob, _ = login(app, 'bob')
+    point_id = alice.post('/points', json=POINT).get_json()['id']
+    assert bob.put('/points/%d' % point_id, json={'name': 'stolen'}).status_code == 404
+    assert bob.delete('/points/%d' % point_id).status_code == 404
+    with app.app.app_context():
+        assert app.db.session.get(app.Point, point_id).name == POINT['name']
+    assert alice.delete('/points/%d' % point_id).status_code == 200
+
+#他のユーザーの経路の道のりは返さない(道路データを読む前に断る)
+def test_route_path_of_another_user_is_not_found(app, monkeypatch):
+    alice, _ = login(app, 'alice')
+    bob, _ = login(app, 'bob')
+    route_id = alice.post('/routes/bulk', json=[{'start_point': POINT, 'end_point': POINT}]).get_json()['created'][0]['route_id']
+    monkeypatch.setattr(app, 'current_road_graph', lambda: (1, SimpleNamespace()))
+    assert bob.get('/routes/%d/path' % route_id).status_code == 404
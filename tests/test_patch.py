@@ -0,0 +1,50 @@
+import pytest
+
+from tests.conftest import login
+from tests.test_queries import create_routes, route_item
+
+#PATCH /routes/<id>: GETのETagをそのままIf-Matchに使え、古いETag・他人の経路・不正な操作は受け付けない
+
+def waypoint_ids(client, route_id):
+    return [waypoint['location']['id'] for waypoint in client.get('/routes/%d' % route_id).get_json()['waypoint']]
+
+def test_patch_with_etag_from_get(client):
+    client, _ = client
+    route_id, = create_routes(client, [route_item(0, 2)])
+    etag = client.get('/routes/%d' % route_id).headers['ETag']
+    before = waypoint_ids(client, route_id)
+    response = client.patch('/routes/%d' % route_id, json=[{'op': 'move', 'from': '/waypoints/1', 'path': '/waypoints/0'}],
+                            headers={'If-Match': etag})
+    assert response.status_code == 200
+    assert waypoint_ids(client, route_id) == before[::-1]
+    #PATCHの応答のETagでも続けて更新でき、古いETagは412になる
+    assert client.patch('/routes/%d' % route_id, json=[{'op': 'remove', 'path': '/waypoints/0'}],
+                        headers={'If-Match': etag}).status_code == 412
+    assert client.patch('/routes/%d' % route_id, json=[{'op': 'remove', 'path': '/waypoints/0'}],
+                        headers={'If-Match': response.headers['ETag']}).status_code == 200
+
+def test_patch_etag_of_other_route_does_not_match(client):
+    client, _ = client
+    first, second = create_routes(client, [route_item(0, 1), route_item(1, 1)])
+    etag = client.get('/routes/%d' % first).headers['ETag']
+    assert client.patch('/routes/%d' % second, json=[], headers={'If-Match': etag}).status_code == 412
+
+@pytest.mark.parametrize('operation', [
+    {'op': 'add', 'path': '/waypoints/-', 'value': [1, 2]},
+    {'op': 'replace', 'path': '/start_point_id', 'value': {'id': 1}},
+    {'op': ['add'], 'path': '/waypoints/-', 'value': 1},
+    {'op': 'move', 'path': '/waypoints/0'},
+    'remove',
+])
+def test_patch_rejects_malformed_operations(client, operation):
+    client, _ = client
+    route_id, = create_routes(client, [route_item(0, 1)])
+    assert client.patch('/routes/%d' % route_id, json=[operation], headers={'If-Match': '*'}).status_code == 400
+
+def test_patch_other_users_route(app):
+    alice, _ = login(app, 'alice')
+    bob, _ = login(app, 'bob')
+    route_id, = create_routes(alice, [route_item(0, 1)])
+    response = bob.patch('/routes/%d' % route_id, json=[{'op': 'remove', 'path': '/waypoints/0'}], headers={'If-Match': '*'})
+    assert response.status_code == 404
+    assert len(waypoint_ids(alice, route_id)) == 1
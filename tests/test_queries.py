@@ -0,0 +1,78 @@
+#経路・一覧の取得で、件数によってSQLの回数が増えない(N+1にならない)ことを確かめる
+
+def route_item(index, waypoints):
+    point = lambda name: {'name': name, 'address': 'address %s' % name, 'latitude': 35.6 + index * 0.001,
+                          'longitude': 139.7 + len(name) * 0.001}
+    return {'start_point': point('s%d' % index), 'end_point': point('e%d' % index),
+            'waypoint': [point('w%d-%d' % (index, i)) for i in range(waypoints)]}
+
+def create_routes(client, items):
+    response = client.post('/routes/bulk', json=items)
+    assert response.status_code == 201
+    return [item['route_id'] for item in response.get_json()['created']]
+
+def test_get_route_query_count_does_not_depend_on_waypoints(client, queries):
+    client, _ = client
+    short, long = create_routes(client, [route_item(0, 1), route_item(1, 30)])
+    client.get('/cache/stats')
+    counts = []
+    for route_id, waypoints in ((short, 1), (long, 30)):
+        with queries() as counter:
+            response = client.get('/routes/%d' % route_id)
+        assert response.status_code == 200
+        assert len(response.get_json()['waypoint']) == waypoints
+        counts.append(len(counter))
+    assert counts[0] == counts[1] <= 2
+
+def test_get_route_waypoints_are_ordered(client):
+    client, _ = client
+    route_id, = create_routes(client, [route_item(0, 5)])
+    names = [waypoint['waypoint'] for waypoint in client.get('/routes/%d' % route_id).get_json()['waypoint']]
+    assert names == ['w0-%d' % i for i in range(5)]
+
+def test_list_points_query_count_does_not_depend_on_rows(client, queries):
+    client, _ = client
+    counts = []
+    for routes in (1, 20):
+        create_routes(client, [route_item(len(counts) * 100 + i, 3) for i in range(routes)])
+        client.get('/cache/stats')
+        with queries() as counter:
+            response = client.get('/points?limit=1000')
+        assert response.status_code == 200
+        counts.append(len(counter))
+    assert counts[0] == counts[1] <= 1
+
+def test_favorited_routes_query_count_does_not_depend_on_rows(client, queries):
+    client, user_id = client
+    counts = []
+    for routes in (1, 20):
+        for route_id in create_routes(client, [route_item(len(counts) * 100 + i, 2) for i in range(routes)]):
+            assert client.post('/routes/%d/favorite' % route_id).status_code == 200
+        with queries() as counter:
+            response = client.get('/user/%d/favorited_routes' % user_id)
+        assert response.status_code == 200
+        counts.append(len(counter))
+    assert counts[0] == counts[1] <= 1
+
+def test_batch_get_query_count_does_not_depend_on_routes(client, queries):
+    client, _ = client
+    route_ids = create_routes(client, [route_item(i, 3) for i in range(40)])
+    counts = []
+    for batch in (route_ids[:1], route_ids):
+        client.get('/cache/stats')
+        with queries() as counter:
+            response = client.post('/routes/batch-get', json=batch)
+        assert len(response.get_json()['routes']) == len(batch)
+        counts.append(len(counter))
+    assert counts[0] == counts[1] <= 3
+
+#チャンクに分けても、チャンク1つの時と同じ順番・同じ内容を返す
+def test_batch_get_chunks_in_lists(app, client, monkeypatch):
+    client, _ = client
+    route_ids = create_routes(client, [route_item(i, 3) for i in range(7)])
+    batch = route_ids[::-1] + [10 ** 9]
+    expected = client.post('/routes/batch-get', json=batch).get_json()
+    monkeypatch.setattr(app, 'BULK_LOOKUP_CHUNK', 2)
+    assert client.post('/routes/batch-get', json=batch).get_json() == expected
+    assert expected['missing'] == [10 ** 9]
+    assert [route['id'] for route in expected['routes']] == route_ids[::-1]
@@ -0,0 +1,31 @@
+#周辺検索・範囲検索: 日付変更線をまたぐ範囲と、極を含む円
+
+def add_point(client, name, latitude, longitude):
+    response = client.post('/points', json={'name': name, 'address': name, 'latitude': latitude, 'longitude': longitude})
+    assert response.status_code == 201
+    return response.get_json()['id']
+
+def nearby(client, lat, lng, radius):
+    response = client.get('/points/nearby?lat=%r&lng=%r&radius=%r' % (lat, lng, radius))
+    assert response.status_code == 200
+    return [point['id'] for point in response.get_json()]
+
+def test_nearby_across_antimeridian(client):
+    client, _ = client
+    east = add_point(client, 'east', 10, 179.999)
+    add_point(client, 'far', 10, 170)
+    assert nearby(client, 10, -179.999, 1000) == [east]
+
+def test_bbox_across_antimeridian(client):
+    client, _ = client
+    east = add_point(client, 'east', 10, 179.5)
+    west = add_point(client, 'west', 10, -179.5)
+    add_point(client, 'far', 10, 0)
+    response = client.get('/points/bbox?min_lat=9&min_lng=179&max_lat=11&max_lng=-179')
+    assert sorted(point['id'] for point in response.get_json()) == sorted([east, west])
+
+#極をまたいだ反対側の経度の地点も候補にする
+def test_nearby_circle_covering_pole(client):
+    client, _ = client
+    across = add_point(client, 'across', 89.8, 180)
+    assert nearby(client, 89.5, 0, 100000) == [across]